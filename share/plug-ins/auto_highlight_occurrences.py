@@ -31,6 +31,7 @@ like "TODO", or special comments for instance.
 import GPS
 from gps_utils import *
 from gps_utils.highlighter import Location_Highlighter, OverlayStyle
+from collections import OrderedDict
 import re
 
 GPS.Preference(
@@ -51,14 +52,134 @@ GPS.Preference(
     "Attempt to highlight the word under the cursor.",
     False)
 
+GPS.Preference(
+    "Plugins/auto_highlight_occurrences/delay").create(
+    "Delay", "integer",
+    "How long (in milliseconds) the cursor must rest on an entity before"
+    " its occurrences are highlighted.",
+    100, 0, 2000)
+
 MSG_PREFIX = 'dynamic occurrences '
 # Messages created by this plugin have a category that starts with this
 
 
+class Word_Index(object):
+
+    """
+    The words of a buffer and their position, grouped by line.
+
+    Lines are scanned with a regular expression the first time they are
+    queried, a whole range of lines at once. The index then follows the
+    edits of the buffer: only the lines that were modified are scanned
+    again, so that looking for another word in the same buffer doesn't
+    need to read its text.
+
+    :param GPS.EditorBuffer buffer: the buffer to index.
+    """
+
+    word_re = re.compile(r"[^\W\d_]\w*", re.U)
+    # The identifiers: a letter followed by letters, digits and underscores
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+        # For each line (starting at 0), a dict of the words on that line
+        # to their character offsets, or None if the line must be scanned.
+        self.__lines = [None] * buffer.lines_count()
+
+        self.__gtk_buffer = None
+        self.__handlers = []
+        try:
+            from pygps import get_gtk_buffer
+            self.__gtk_buffer = get_gtk_buffer(buffer)
+            self.__handlers = [
+                self.__gtk_buffer.connect(
+                    "insert-text", self.__on_insert_text),
+                self.__gtk_buffer.connect(
+                    "delete-range", self.__on_delete_range)]
+        except Exception:
+            pass
+
+    @property
+    def tracking(self):
+        """
+        Whether the index is kept up to date when the buffer is edited.
+        """
+        return bool(self.__handlers)
+
+    def detach(self):
+        """
+        Stop following the edits of the buffer.
+        """
+        try:
+            for handler_id in self.__handlers:
+                self.__gtk_buffer.disconnect(handler_id)
+        except Exception:
+            pass   # The buffer was destroyed
+        self.__handlers = []
+
+    def __on_insert_text(self, buf, loc, text, length):
+        line = loc.get_line()
+        self.__lines[line:line + 1] = [None] * (text.count("\n") + 1)
+
+    def __on_delete_range(self, buf, start, end):
+        self.__lines[start.get_line():end.get_line() + 1] = [None]
+
+    def __scan(self, first, last):
+        """
+        Index the lines from first to last, excluded (starting at 0).
+        """
+        b = self.buffer
+        text = b.get_chars(b.at(first + 1, 1), b.at(last, 1).end_of_line())
+        lines = text.decode("utf-8").split("\n")
+
+        for index in range(first, last):
+            words = {}
+            if index - first < len(lines):
+                for m in self.word_re.finditer(lines[index - first]):
+                    words.setdefault(m.group(), []).append(m.start())
+            self.__lines[index] = words
+
+    def query(self, word, from_line, to_line):
+        """
+        Return the occurrences of word between two lines, included.
+
+        :param unicode word: the word to look for.
+        :param integer from_line: the first line.
+        :param integer to_line: the last line.
+        :return: the line and the character offset in that line of each
+           occurrence, sorted.
+        :rtype: list[(integer, integer)]
+        """
+        if to_line > len(self.__lines):
+            self.__lines.extend([None] * (to_line - len(self.__lines)))
+
+        dirty = None   # first line of the current range to scan
+        for index in range(from_line - 1, to_line + 1):
+            if index < to_line and self.__lines[index] is None:
+                if dirty is None:
+                    dirty = index
+            elif dirty is not None:
+                self.__scan(dirty, index)
+                dirty = None
+
+        result = []
+        for index in range(from_line - 1, to_line):
+            for column in self.__lines[index].get(word, ()):
+                result.append((index + 1, column))
+        return result
+
+
 class Current_Entity_Highlighter(Location_Highlighter):
 
     """Class to handle the highlighting of local occurrences."""
 
+    # Occurrences on screen are highlighted first when the cursor moves
+    visible_first = True
+
+    # Maximum number of lists of references kept in the cache
+    max_cached_refs = 32
+
     def __init__(self):
         """
         Initialize a new highlighter. It monitors changes in the current
@@ -71,6 +192,7 @@ class Current_Entity_Highlighter(Location_Highlighter):
         self.highlight_entities = None
         self.highlight_selection = None
         self.highlight_word = None
+        self.delay = None
         self.entity = None
         self.word = None
         self.styles = {
@@ -87,19 +209,65 @@ class Current_Entity_Highlighter(Location_Highlighter):
         self.pref_cache = {}
 
         self.current_buffer = None
+        self.__word_index = None   # the words of the last buffer scanned
+        self.__timeout = None      # the pending GPS.Timeout, if any
+        self.__interrupted = False  # whether highlighting was stopped early
+
+        # The references of the entities highlighted recently, indexed by
+        # (entity, file, xref version, edit counter), least recent first.
+        self.__refs_cache = OrderedDict()
+        self.__xref_version = 0    # incremented when the xref DB changes
+        self.__edits = {}          # number of edits for each file
 
         # Words that should not be highlighted.
         # ??? This should be based on the language
 
         GPS.Hook("preferences_changed").add(self.__on_preferences_changed)
-        GPS.Hook("location_changed").add(self.highlight)
+        GPS.Hook("location_changed").add(self.__on_location_changed)
         GPS.Hook("file_closed").add(self.__on_file_closed)
+        GPS.Hook("buffer_edited").add(self.__on_buffer_edited)
+        GPS.Hook("xref_updated").add(self.__on_xref_updated)
+        GPS.Hook("compilation_finished").add(self.__on_xref_updated)
+
+    def __on_location_changed(self, *args):
+        """
+        Highlight the entity under the cursor once the cursor has rested
+        on it for the delay set in the preferences. Moving the cursor
+        again before that cancels the pending highlighting.
+        """
+        if self.__timeout:
+            self.__timeout.remove()
+            self.__timeout = None
+
+        if self.delay:
+            # Do not keep highlighting an entity the cursor moved away from
+            if self.pending_buffers():
+                self.stop_highlight()
+                self.__interrupted = True
+            self.__timeout = GPS.Timeout(self.delay, self.__on_timeout)
+        else:
+            self.highlight()
+
+    def __on_timeout(self, timeout):
+        self.__timeout = None
+        self.highlight()
+        return False
+
+    def __on_buffer_edited(self, hook, file):
+        self.__edits[file.path] = self.__edits.get(file.path, 0) + 1
+
+    def __on_xref_updated(self, *args):
+        self.__xref_version += 1
+        self.__refs_cache.clear()
 
     def __on_file_closed(self, hook, file):
         if self.current_buffer:
             if self.current_buffer.file() == file:
                 self.current_buffer = None
 
+        if self.__word_index and self.__word_index.buffer.file() == file:
+            self.__set_word_index(None)
+
     def __on_preferences_changed(self, hook_name):
         """
         Called whenever one of the preferences has changed.
@@ -125,6 +293,9 @@ class Current_Entity_Highlighter(Location_Highlighter):
             self.highlight_word = v
             changed = True
 
+        self.delay = GPS.Preference(
+            "Plugins/auto_highlight_occurrences/delay").get()
+
         if changed:
             self.remove_highlight()
             self.highlight()
@@ -134,13 +305,33 @@ class Current_Entity_Highlighter(Location_Highlighter):
             # Compute all refs to the entity immediately, so that we do not
             # have to do any xref query later on when doing the highlighting
             # This query is fast since it only involves a single source file.
+            # The result is cached until the file or the xref database
+            # change, for when the cursor moves back to the same entity.
 
             n = self.entity.name()
+            file = buffer.file()
 
-            return [(n, r) for r in self.entity.references(
-                include_implicit=False,
-                synchronous=True,
-                in_file=buffer.file())]
+            try:
+                decl = self.entity.declaration()
+                key = (n, decl.file().path, decl.line(), decl.column(),
+                       file.path, self.__xref_version,
+                       self.__edits.get(file.path, 0))
+            except Exception:
+                key = None
+
+            refs = self.__refs_cache.pop(key, None)
+            if refs is None:
+                refs = [(n, r) for r in self.entity.references(
+                    include_implicit=False,
+                    synchronous=True,
+                    in_file=file)]
+
+            if key is not None:
+                self.__refs_cache[key] = refs
+                if len(self.__refs_cache) > self.max_cached_refs:
+                    self.__refs_cache.popitem(last=False)
+
+            return refs
 
         else:
             return []   # irrelevant
@@ -152,50 +343,27 @@ class Current_Entity_Highlighter(Location_Highlighter):
             Location_Highlighter.process(self, start, end)
         else:
             buffer = start.buffer()
-            while start < end:
-
-                # Get the string on the line
-                end_loc = start.end_of_line()
-                s = buffer.get_chars(start, end_loc)  # byte-sequence
-                s = s.decode("utf8")  # make unicode-string
-                s_len = len(s)
-
-                # Find the tokens on the current line
-                index = 0
-                visible_column = 0
-
-                while index < s_len:
-                    if s[index].isalpha():
-                        end_index = index + 1
-
-                        while end_index < s_len and (
-                                s[end_index].isalnum() or s[end_index] == '_'):
-                            end_index += 1
-                        if s[index:end_index] == self.word:
-                            self.style.apply(
-                                start=GPS.EditorLocation(
-                                    buffer,
-                                    start.line(),
-                                    start.column() + visible_column),
-                                end=GPS.EditorLocation(
-                                    buffer,
-                                    start.line(),
-                                    start.column() +
-                                    visible_column + len(self.word) - 1))
-
-                        visible_column += end_index - index
-                        index = end_index
-
-                    else:
-                        visible_column += 1
-
-                        if s[index] == '\t':
-                            visible_column = (visible_column +
-                                              8 - (visible_column % 8))
-
-                        index += 1
-
-                start = end_loc + 1
+            if not self.__word_index or self.__word_index.buffer != buffer:
+                self.__set_word_index(Word_Index(buffer))
+
+            ranges = []
+            for line, column in self.__word_index.query(
+                    self.word, start.line(), end.line()):
+                first = buffer.at(line, 1) + column
+                ranges.append((first, first + (len(self.word) - 1)))
+
+            self.style.apply_ranges(ranges)
+
+    def __set_word_index(self, index):
+        """
+        Replace the index of words, and stop following the edits of the
+        buffer it was built for.
+
+        :param Word_Index index: the new index, or None
+        """
+        if self.__word_index:
+            self.__word_index.detach()
+        self.__word_index = index
 
     def highlight(self, *args, **kwargs):
         """
@@ -260,11 +428,15 @@ class Current_Entity_Highlighter(Location_Highlighter):
             word, _, _ = location.get_word()
 
         # Exit if we are highlighting the word or the entity that we were
-        # already highlighting.
+        # already highlighting, unless that was interrupted.
         if (entity and self.entity and self.entity == entity) \
            or (word and self.word and self.word == word):
+            if self.__interrupted and self.current_buffer:
+                self.start_highlight(buffer=self.current_buffer)
+            self.__interrupted = False
             return
 
+        self.__interrupted = False
         self.stop_highlight()
         self.remove_highlight()
 
@@ -294,6 +466,10 @@ class Current_Entity_Highlighter(Location_Highlighter):
             self.set_style(self.styles["text"])
 
         self.current_buffer = buffer
+        if self.__word_index and not self.__word_index.tracking:
+            # The index could not follow the edits since the last time
+            self.__set_word_index(None)
+
         self.start_highlight(buffer=buffer)
 
 
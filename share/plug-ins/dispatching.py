@@ -12,6 +12,8 @@ not known until run time.
 #############################################################################
 
 import GPS
+import os
+import time
 from gps_utils.highlighter import Location_Highlighter, OverlayStyle
 
 GPS.Preference("Plugins/dispatching/color").create(
@@ -30,14 +32,24 @@ less precise too""", 5, 0, 50)
 
 class Dispatching_Highlighter(Location_Highlighter):
 
+    # Highlighting is only refreshed after compilations, not when the cursor
+    # moves, so only highlighting the lines around the cursor is not useful
+    large_files = "disabled"
+
     def __init__(self):
         Location_Highlighter.__init__(self, style=None)
         self.background_color = None
         self.context = None
+
+        # For each open file, the state when its dispatching calls were last
+        # computed: (xref timestamp, line hashes, refs)
+        self.__cache = {}
+        self.__last_update = 0   # when the xref hooks last ran
         self.__on_preferences_changed(hook=None)
         GPS.Hook("preferences_changed").add(self.__on_preferences_changed)
         GPS.Hook("file_edited").add(self.__on_file_edited)
         GPS.Hook("file_changed_on_disk").add(self.__on_file_edited)
+        GPS.Hook("file_closed").add(self.__on_file_closed)
 
         if GPS.Logger("ENTITIES.SQLITE").active:
             GPS.Hook("xref_updated").add(self.__on_compilation_finished)
@@ -50,6 +62,7 @@ class Dispatching_Highlighter(Location_Highlighter):
         GPS.Hook("preferences_changed").remove(self.__on_preferences_changed)
         GPS.Hook("file_edited").remove(self.__on_file_edited)
         GPS.Hook("file_changed_on_disk").remove(self.__on_file_edited)
+        GPS.Hook("file_closed").remove(self.__on_file_closed)
 
         if GPS.Logger("ENTITIES.SQLITE").active:
             GPS.Hook("xref_updated").remove(self.__on_compilation_finished)
@@ -72,7 +85,8 @@ class Dispatching_Highlighter(Location_Highlighter):
 
         if changed:
             self.stop_highlight()
-            self.__on_compilation_finished()
+            for b in GPS.EditorBuffer.list():
+                self.start_highlight(b)  # automatically removes old highlights
 
     def __on_file_edited(self, hook, file):
         # File might have been opened in a QGen browser
@@ -80,15 +94,123 @@ class Dispatching_Highlighter(Location_Highlighter):
         if buffer:
             self.start_highlight(buffer)
 
+    def __on_file_closed(self, hook, file):
+        self.__cache.pop(file.path, None)
+
     def __on_compilation_finished(
             self, hook=None, category="", target_name="",
             mode_name="", status=""):
-        """Re-highlight all editors"""
+        """Re-highlight the parts of editors that changed"""
 
+        self.__last_update = time.time()
+        timestamp = self.__xref_timestamp()
         for b in GPS.EditorBuffer.list():
-            self.start_highlight(b)  # automatically removes old highlights
+            self.__refresh(b, timestamp)
+
+    def __xref_timestamp(self):
+        """
+        The time of the last change to the xref database.
+        """
+        try:
+            return os.path.getmtime(GPS.xref_db())
+        except Exception:
+            return self.__last_update
+
+    def __line_hashes(self, buffer):
+        """
+        :return: the hash of each line of buffer
+        :rtype: list[int]
+        """
+        return [hash(line) for line in buffer.get_chars().split("\n")]
+
+    def __refresh(self, buffer, timestamp):
+        """
+        Highlight the lines of buffer that have changed since its
+        dispatching calls were last computed, and the lines whose
+        dispatching calls are no longer the same.
+
+        :param timestamp: the current xref timestamp
+        """
+        try:
+            path = buffer.file().path
+        except Exception:
+            return
+
+        cached = self.__cache.get(path)
+        if cached is None:
+            self.start_highlight(buffer)
+            return
+
+        if cached[0] == timestamp:
+            # The xref database did not change, and neither did the
+            # dispatching calls. The highlights move with the text.
+            return
+
+        try:
+            old_lines = cached[1]
+            new_lines = self.__line_hashes(buffer)
+        except Exception:
+            return
+
+        # The lines between the common prefix and suffix of the old and new
+        # text have been edited since the last computation.
+        first = 0
+        last = len(new_lines)
+        while (first < min(len(old_lines), last) and
+               old_lines[first] == new_lines[first]):
+            first += 1
+        while (last > first and len(old_lines) - len(new_lines) + last > first
+               and old_lines[len(old_lines) - len(new_lines) + last - 1] ==
+               new_lines[last - 1]):
+            last -= 1
+
+        # Compare the dispatching calls before and after the update of
+        # the database. The lines after the edited lines were shifted.
+        lines = set(range(first + 1, last + 1))
+        shift = len(new_lines) - len(old_lines)
+        old = set((line + shift if line > first else line, col)
+                  for _, line, col in self.__locations(cached[2]))
+        refs = self.__query_refs(buffer)
+        new = set((line, col)
+                  for _, line, col in self.__locations(refs))
+        lines.update(line for line, _ in old ^ new)
+        self.__cache[path] = (timestamp, new_lines, refs)
+
+        if lines:
+            first = max(1, min(lines) - self.context)
+            last = max(lines) + self.context
+            self.start_highlight(buffer, line=(first + last) // 2,
+                                 context=(last - first + 1) // 2)
+
+    def __locations(self, refs):
+        """
+        :return: the name, line and column of each reference
+        :rtype: list[(str, int, int)]
+        """
+        return [(n, r.line(), r.column()) for n, r in refs]
 
     def recompute_refs(self, buffer):
+        try:
+            path = buffer.file().path
+        except Exception:
+            return self.__query_refs(buffer)
+
+        # The dispatching calls only change when the xref database does:
+        # editing the text only moves them, which the highlighter handles
+        # by searching around their original location.
+        timestamp = self.__xref_timestamp()
+        cached = self.__cache.get(path)
+        if cached is not None and cached[0] == timestamp:
+            return cached[2]
+
+        refs = self.__query_refs(buffer)
+        self.__cache[path] = (timestamp, self.__line_hashes(buffer), refs)
+        return refs
+
+    def __query_refs(self, buffer):
+        """
+        Query the xref database for the dispatching calls in buffer.
+        """
         try:
             # Minor optimization to query the names of each entities only once.
             names = dict()
@@ -4,7 +4,7 @@ from . import core_staging
 import os
 import re
 import types
-from workflows.promises import ProcessWrapper, Promise
+from workflows.promises import ProcessWrapper, ProcessScheduler, Promise
 
 
 @core.register_vcs(name='ClearCase Native',
@@ -12,20 +12,26 @@ from workflows.promises import ProcessWrapper, Promise
 class Clearcase(core_staging.Emulate_Staging,
                 core.VCS):
 
-    def _cleartool(self, args, block_exit=False):
+    def _cleartool(self, args, block_exit=False,
+                   priority=ProcessScheduler.INTERACTIVE, dedup=False):
         p = ProcessWrapper(
             ['cleartool'] + args,
             block_exit=block_exit,
+            priority=priority,
+            dedup=dedup,
             directory=self.working_dir.path)
         return p
 
-    @core.run_in_background
-    def async_fetch_status_for_all_files(self):
+    @core.run_in_background(merge=core.merge_identical_requests,
+                            priority=core.from_user_priority)
+    def async_fetch_status_for_all_files(self, from_user=False):
         _re = re.compile(
             '(?P<file>[^@@]+)(?P<sep>@@)?(?P<rev>[^\s]*)(\n|$)')
 
         with self.set_status_for_all_files() as s:
-            p = self._cleartool(['ls', '-short', '.'])
+            p = self._cleartool(['ls', '-short', '.'],
+                                priority=ProcessScheduler.BACKGROUND,
+                                dedup=True)
             while True:
                 line = yield p.wait_line()
                 if line is None:
@@ -45,7 +51,8 @@ class Clearcase(core_staging.Emulate_Staging,
                         status = GPS.VCS2.Status.IGNORED
 
                     s.set_status(
-                        GPS.File(m.group('file')),
+                        core.file_cache.get(
+                            self.working_dir.path, m.group('file')),
                         0,
                         rev,
                         '')  # repo revision
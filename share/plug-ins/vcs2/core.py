@@ -5,9 +5,13 @@ Base type to implement support for new VCS engines in GPS
 import GPS
 import os
 import gps_utils
+import inspect
+import itertools
+import sys
 import workflows
 import time
-from workflows.promises import Promise
+import traceback
+from workflows.promises import Promise, ProcessScheduler
 import types
 
 
@@ -29,7 +33,7 @@ GPS.VCS2.Status = gps_utils.enum(
 # Valid statuses for files (they can be combined)
 
 
-def run_in_background(func):
+def run_in_background(func=None, merge=None, priority=None):
     """
     A decorator to be applied to a method of VCS (below), which monitors
     whether background processing is being done. This is used to avoid
@@ -47,19 +51,55 @@ def run_in_background(func):
             def async_fetch_status_for_files(self):
                 pass
 
+    The workflow runs in time-sliced mode (see `workflows.driver`), so that
+    parsing the output of large commands does not block GPS.
+
+    When `merge` is specified, calls go through the engine's
+    `Request_Queue`: they run one at a time, and a call made while a
+    previous one is still waiting to start is merged with it::
+
+        @vcs2.core.run_in_background(
+            merge=lambda old, new: {'files': old['files'] + new['files']})
+        def _compute_status(self, files):
+            pass
+
+    :param merge: a function that receives the arguments of two calls, as
+      dicts (see `inspect.getcallargs`, without "self"), and returns the
+      arguments of a single call that does the work of both, or None if
+      they cannot be merged.
+    :param priority: the priority of the calls in the queue, either as a
+      constant like `ProcessScheduler.INTERACTIVE`, or as a function that
+      receives the arguments of the call, as for `merge`. Defaults to
+      `ProcessScheduler.BACKGROUND`.
     :return: a function that when executed returns a promise that is resolved
       to the return of `func`. Until this promise is resolved (in the
       background), the VCS engine is marked as busy, and no other command will
       be started.
     """
+    if func is None:
+        return lambda f: run_in_background(f, merge=merge, priority=priority)
 
     def __func(self, *args, **kwargs):
+        if merge is not None:
+            params = inspect.getcallargs(func, self, *args, **kwargs)
+            del params['self']
+            return self.request_queue.submit(func, params, merge, priority)
+
         r = func(self, *args, **kwargs)
         if isinstance(r, types.GeneratorType):
-            self.set_run_in_background(True)
-            promise = workflows.driver(r)
-            promise.then(lambda x: self.set_run_in_background(False),
-                         lambda x: self.set_run_in_background(False))
+            queue = self.request_queue
+            queue.background_started()
+            done = []
+
+            def on_done(x):
+                if not done:
+                    done.append(True)
+                    queue.background_done()
+
+            promise = workflows.driver(
+                _watch_rejections(r, on_done),
+                time_slice=workflows.default_time_slice)
+            promise.then(on_done, on_done)
         else:
             promise = Promise()
             promise.resolve(r)
@@ -67,6 +107,223 @@ def run_in_background(func):
     return __func
 
 
+def _watch_rejections(gen, on_rejected):
+    """
+    A workflow that runs gen, forwarding the values it yields and receives.
+    A workflow is not resumed when a promise it yielded is rejected, so the
+    promise returned by `workflows.driver` is never settled: on_rejected is
+    called with the reason instead. The generators that gen yields are
+    watched in the same way.
+    """
+    value = None
+    exc_info = None
+    while True:
+        try:
+            if exc_info is not None:
+                el = gen.throw(*exc_info)
+            else:
+                el = gen.send(value)
+        except StopIteration:
+            return
+
+        if isinstance(el, Promise):
+            el.then(None, on_rejected)
+        elif isinstance(el, types.GeneratorType):
+            el = _watch_rejections(el, on_rejected)
+
+        exc_info = None
+        try:
+            value = yield el
+        except BaseException:
+            # Raised by the driver, when a generator yielded by gen failed
+            exc_info = sys.exc_info()
+
+
+def merge_identical_requests(old, new):
+    """
+    A `merge` function for `run_in_background`, which only merges calls
+    with the same arguments.
+    """
+    return old if old == new else None
+
+
+def from_user_priority(params):
+    """
+    A `priority` function for `run_in_background`, which runs the calls
+    whose "from_user" argument is True before the background refreshes.
+    """
+    if params.get('from_user'):
+        return ProcessScheduler.INTERACTIVE
+    return ProcessScheduler.BACKGROUND
+
+
+def merge_file_status_requests(old, new):
+    """
+    A `merge` function for `File_Based_VCS._compute_status`. An empty list
+    of arguments means that the status of all files is computed.
+    """
+    all_files = list(old['all_files'])
+    all_files.extend(f for f in new['all_files'] if f not in old['all_files'])
+    if not old['args'] or not new['args']:
+        args = []
+    else:
+        args = list(old['args'])
+        args.extend(a for a in new['args'] if a not in old['args'])
+    return {'all_files': all_files, 'args': args}
+
+
+class _Request(object):
+    """
+    A call waiting in a `Request_Queue`
+    """
+
+    def __init__(self, func, params, merge, priority, seq):
+        self.func = func
+        self.params = params
+        self.merge = merge
+        self.priority = priority
+        self.seq = seq
+        self.promises = []   # resolved with the result of the call
+
+    def key(self):
+        return (self.priority, self.seq)
+
+
+class Request_Queue(object):
+    """
+    The calls to the methods of a VCS engine that were decorated with
+    `run_in_background` and a `merge` function, typically the refreshes
+    of the status of files. They run one at a time, user requests first,
+    and redundant calls are merged while they wait, so that a burst of
+    refreshes (for instance saving several files, or a refresh after each
+    action) only runs the VCS once or twice.
+
+    Other calls start immediately, since they are started by the user
+    and might themselves wait for a refresh.
+    """
+
+    def __init__(self, vcs):
+        self.__vcs = vcs
+        self.__pending = []     # list of _Request, by priority
+        self.__running = None   # the _Request being executed
+        self.__seq = itertools.count()
+        self.__nb_background = 0
+        # Number of calls running in the background, queued or not
+
+    @property
+    def depth(self):
+        """
+        The number of calls waiting to start, for diagnostics.
+        """
+        return len(self.__pending)
+
+    @property
+    def busy(self):
+        """
+        Whether a call is being executed.
+        """
+        return self.__running is not None
+
+    def background_started(self):
+        """
+        Called when a call starts running in the background. The engine is
+        marked as busy until all of them are done.
+        """
+        self.__nb_background += 1
+        if self.__nb_background == 1:
+            self.__vcs.set_run_in_background(True)
+
+    def background_done(self):
+        """
+        Called when a call that was running in the background is done.
+        """
+        self.__nb_background -= 1
+        if self.__nb_background == 0:
+            self.__vcs.set_run_in_background(False)
+
+    def submit(self, func, params, merge, priority=None):
+        """
+        Queue a call to func, or merge it with a pending one.
+
+        :param func: the undecorated method of the VCS engine
+        :param dict params: its arguments, except self
+        :param merge: see `run_in_background`
+        :param priority: see `run_in_background`
+        :return: a promise resolved with the result of the call, once it
+           has been executed.
+        """
+        if priority is None:
+            priority = ProcessScheduler.BACKGROUND
+        elif callable(priority):
+            priority = priority(params)
+
+        promise = Promise()
+
+        for req in self.__pending:
+            if req.func is func:
+                merged = req.merge(req.params, params)
+                if merged is not None:
+                    req.params = merged
+                    req.priority = min(req.priority, priority)
+                    req.promises.append(promise)
+                    self.__pending.sort(key=_Request.key)
+                    GPS.Logger("VCS2").log(
+                        "Merged %s, %d calls waiting" % (
+                            func.__name__, self.depth))
+                    return promise
+
+        req = _Request(func, params, merge, priority, next(self.__seq))
+        req.promises.append(promise)
+        self.__pending.append(req)
+        self.__pending.sort(key=_Request.key)
+        GPS.Logger("VCS2").log(
+            "Queued %s, %d calls waiting" % (func.__name__, self.depth))
+
+        if self.__running is None:
+            self.__start_next()
+        return promise
+
+    def __start_next(self):
+        """
+        Execute the next pending call, if any.
+        """
+        while self.__pending and self.__running is None:
+            req = self.__running = self.__pending.pop(0)
+
+            try:
+                r = req.func(self.__vcs, **req.params)
+            except Exception:
+                self.__running = None
+                for p in req.promises:
+                    p.reject(traceback.format_exc())
+                continue
+
+            if isinstance(r, types.GeneratorType):
+                self.background_started()
+                workflows.driver(
+                    _watch_rejections(
+                        r, lambda x, req=req: self.__on_done(req, x, False)),
+                    time_slice=workflows.default_time_slice).then(
+                        lambda x, req=req: self.__on_done(req, x, True),
+                        lambda x, req=req: self.__on_done(req, x, False))
+            else:
+                self.__running = None
+                for p in req.promises:
+                    p.resolve(r)
+
+    def __on_done(self, req, result, success):
+        if self.__running is not req:
+            return   # already done
+        self.__running = None
+        self.background_done()
+        for p in req.promises:
+            if success:
+                p.resolve(result)
+            else:
+                p.reject(result)
+        self.__start_next()
+
+
 class Profile:
     """
     A Context that runs the function inside the profiler, and display
@@ -104,6 +361,56 @@ class Profile:
             GPS.Logger("GIT").log(s.getvalue())
 
 
+class File_Cache(object):
+    """
+    Interns the GPS.File objects created when parsing the output of VCS
+    tools. Every status refresh sees the same file names again, and
+    reusing the objects avoids creating (and then hashing in the status
+    caches) hundreds of thousands of new ones on large repositories.
+
+    This is a two-generation LRU: files are looked up in the current
+    generation, then in the previous one (and moved back to the current
+    one). When the current generation is full, the previous one is
+    discarded, so at most 2 * max_size files are kept.
+    """
+
+    max_size = 150000
+    """Number of files in each generation"""
+
+    def __init__(self):
+        self.__current = {}    # (working_dir, relative path) -> GPS.File
+        self.__previous = {}
+
+    def get(self, working_dir, relative):
+        """
+        Return the file for a path relative to a working directory.
+
+        :param str working_dir: the root of the repository.
+        :param str relative: a path relative to working_dir. Absolute
+           paths are also supported.
+        :rtype: GPS.File
+        """
+        key = (working_dir, relative)
+        f = self.__current.get(key)
+        if f is None:
+            f = self.__previous.pop(key, None)
+            if f is None:
+                f = GPS.File(os.path.join(working_dir, relative))
+            if len(self.__current) >= self.max_size:
+                self.__previous = self.__current
+                self.__current = {}
+            self.__current[key] = f
+        return f
+
+    def clear(self):
+        self.__current = {}
+        self.__previous = {}
+
+
+file_cache = File_Cache()
+# Shared by all VCS engines
+
+
 class Extension():
     """
     A class similar to core.VCS, which is used to decorate an existing VCS
@@ -156,6 +463,8 @@ class VCS(GPS.VCS2):
         self.working_dir = working_dir
         self.default_status = default_status
         self._extensions = []   # the decorators that apply to self
+        self.request_queue = Request_Queue(self)
+        # the background calls waiting to be executed
 
         # Check which decorators apply
         for d in self._class_extensions:
@@ -398,6 +707,7 @@ class VCS(GPS.VCS2):
         """
 
         vcs = self
+        batch_size = 20000   # statuses sent to GPS at once
 
         class _CM(object):
             def __init__(self):
@@ -428,8 +738,39 @@ class VCS(GPS.VCS2):
                 :param str repo_version:
                 """
                 self._seen.add(file)
-                self._cache.setdefault(
-                    (status, version, repo_version), []).append(file)
+                self.__add((status, version, repo_version), [file])
+
+            def set_status_for_files(
+                    self, files,
+                    status,
+                    version="",
+                    repo_version=""):
+                """
+                Set the same status for several files. This is much faster
+                than calling `set_status` for each file when parsing the
+                output of tools on large repositories.
+
+                :param list(GPS.File) files:
+                :param GPS.VCS2.Status status:
+                :param str version:
+                :param str repo_version:
+                """
+                self._seen.update(files)
+                self.__add((status, version, repo_version), files)
+
+            def __add(self, key, files):
+                """
+                Record the status of files, and send it to GPS once enough
+                files have the same status, so that large repositories do
+                not wait for the end of the parsing.
+                """
+                group = self._cache.get(key)
+                if group is None:
+                    group = self._cache[key] = []
+                group.extend(files)
+                if len(group) >= batch_size:
+                    vcs._set_file_status(group, key[0], key[1], key[2])
+                    self._cache[key] = []
 
             def set_status_for_remaining_files(self, files=set()):
                 """
@@ -440,7 +781,9 @@ class VCS(GPS.VCS2):
                 """
                 GPS.Logger("VCS2").log("Emit file statuses")
                 for s, s_files in self._cache.iteritems():
-                    vcs._set_file_status(s_files, s[0], s[1], s[2])
+                    if s_files:
+                        vcs._set_file_status(s_files, s[0], s[1], s[2])
+                self._cache = {}
                 GPS.Logger("VCS2").log("Done emit file statuses")
 
                 to_set = []
@@ -2,7 +2,7 @@ from . import core, core_staging
 import GPS
 import os
 import re
-from workflows.promises import ProcessWrapper
+from workflows.promises import ProcessWrapper, ProcessScheduler
 
 
 # Match cvs status output to internal status for GPS
@@ -35,7 +35,8 @@ class CVS(core_staging.Emulate_Staging,
         '(?:\s+Repository revision:\s*(?P<rrev>[\d.]+).*)' +
         ')$')
 
-    def _cvs(self, args, block_exit=False, spawn_console=False):
+    def _cvs(self, args, block_exit=False, spawn_console=False,
+             priority=ProcessScheduler.INTERACTIVE, dedup=False):
         """
         Execute cvs with the given arguments.
 
@@ -46,6 +47,8 @@ class CVS(core_staging.Emulate_Staging,
             ['cvs'] + args,
             block_exit=block_exit,
             spawn_console=spawn_console,
+            priority=priority,
+            dedup=dedup,
             directory=self.working_dir.path)
 
     @core.vcs_action(icon='vcs-cloud-symbolic',
@@ -60,10 +63,19 @@ class CVS(core_staging.Emulate_Staging,
     def discover_working_dir(file):
         return core.find_admin_directory(file, 'CVS')
 
-    @core.run_in_background
+    @core.run_in_background(merge=core.merge_file_status_requests)
     def _compute_status(self, all_files, args=[]):
+        # CVS doesn't show path information for the files given on the
+        # command line, so they are looked up by name.
+        paths = set(args)
+        named = {}
+        for f in all_files:
+            if f.path in paths:
+                named.setdefault(os.path.basename(f.path), []).append(f)
+
         with self.set_status_for_all_files(all_files) as s:
-            p = self._cvs(['-f', 'status'] + args)
+            p = self._cvs(['-f', 'status'] + args,
+                          priority=ProcessScheduler.BACKGROUND, dedup=True)
             current_file = None
             dir = None
             while True:
@@ -81,18 +93,12 @@ class CVS(core_staging.Emulate_Staging,
                         s.set_status(current_file, status, rev, repo_rev)
                         current_file = None
 
-                    # CVS doesn't show path information when a list of files is
-                    # given. However, it seems to query the status in the same
-                    # order as on the command line, so we take advantage of
-                    # that.
-
                     f = m.group('file')
                     if dir is not None:
-                        current_file = GPS.File(os.path.join(dir, f))
-                    elif all_files and all_files[0].path.endswith(f):
-                        current_file = all_files[0]
-                    if all_files:
-                        all_files.pop(0)
+                        current_file = core.file_cache.get(
+                            self.working_dir.path, os.path.join(dir, f))
+                    elif named.get(f):
+                        current_file = named[f].pop(0)
 
                     if m.group('deleted'):
                         status = GPS.VCS2.Status.DELETED
@@ -2,7 +2,9 @@ import GPS
 from . import core
 import os
 import re
-from workflows.promises import ProcessWrapper, join, Promise
+import time
+from workflows.promises import ProcessWrapper, ProcessScheduler, join, \
+    Promise
 import datetime
 import types
 import gps_utils
@@ -18,6 +20,181 @@ CAT_SUBMODULES = 'SUBMODULES'
 CAN_RENAME = True
 
 
+class _StatusParser(object):
+    """
+    Parses the output of "git status --porcelain=v2 -z". Records are
+    terminated by NUL characters and file names are not quoted, so any file
+    name is supported. See the git-status manual for the format.
+    """
+
+    _index_status = {
+        'M': GPS.VCS2.Status.STAGED_MODIFIED,
+        'T': GPS.VCS2.Status.STAGED_MODIFIED,
+        'A': GPS.VCS2.Status.STAGED_ADDED,
+        'D': GPS.VCS2.Status.STAGED_DELETED,
+        'R': GPS.VCS2.Status.STAGED_RENAMED,
+        'C': GPS.VCS2.Status.STAGED_COPIED,
+    }
+
+    _worktree_status = {
+        'M': GPS.VCS2.Status.MODIFIED,
+        'T': GPS.VCS2.Status.MODIFIED,
+        'D': GPS.VCS2.Status.DELETED,
+    }
+
+    def __init__(self, root):
+        """
+        :param str root: the working directory, which file names are
+           relative to.
+        """
+        self._root = root
+        self._statuses = {}      # "XY" -> GPS.VCS2.Status
+        self._skip_next = False
+        # Whether the next record is the original name of a renamed file,
+        # which might be in the next chunk of output.
+
+    def _status(self, xy):
+        """
+        The status for the "XY" field of ordinary and renamed entries
+        """
+        status = self._statuses.get(xy)
+        if status is None:
+            status = (self._index_status.get(xy[0], 0) |
+                      self._worktree_status.get(xy[1], 0))
+            self._statuses[xy] = status
+        return status
+
+    def parse(self, records):
+        """
+        Parse a batch of records.
+
+        :param list(str) records: records, without their NUL terminator.
+        :return: the files, grouped by status.
+        :rtype: dict(GPS.VCS2.Status, list(GPS.File))
+        """
+        root = self._root
+        get_file = core.file_cache.get
+        result = {}
+        untracked = []
+        ignored = []
+        conflicts = []
+
+        for rec in records:
+            if self._skip_next:
+                self._skip_next = False
+                continue
+
+            kind = rec[:1]
+            if kind == '?':
+                path = rec[2:]
+                files = untracked
+            elif kind == '!':
+                path = rec[2:]
+                files = ignored
+            elif kind == '1':
+                fields = rec.split(' ', 8)
+                if len(fields) < 9:
+                    continue
+                path = fields[8]
+                files = None
+                status = self._status(fields[1])
+            elif kind == '2':
+                # followed by a record with the original name, which does
+                # not exist anymore
+                self._skip_next = True
+                fields = rec.split(' ', 9)
+                if len(fields) < 10:
+                    continue
+                path = fields[9]
+                files = None
+                status = self._status(fields[1])
+            elif kind == 'u':
+                fields = rec.split(' ', 10)
+                if len(fields) < 11:
+                    continue
+                path = fields[10]
+                files = conflicts
+            else:
+                continue   # headers, empty records
+
+            # Filter some obvious files to speed things up
+            if path.endswith('.o') or path.endswith('.ali'):
+                continue
+
+            if files is None:
+                files = result.setdefault(status, [])
+            files.append(get_file(root, path))
+
+        for status, files in ((GPS.VCS2.Status.UNTRACKED, untracked),
+                              (GPS.VCS2.Status.IGNORED, ignored),
+                              (GPS.VCS2.Status.CONFLICT, conflicts)):
+            if files:
+                result.setdefault(status, []).extend(files)
+
+        return result
+
+
+class _StatusParserV1(_StatusParser):
+    """
+    Parses the output of "git status --porcelain -z", for versions of git
+    older than 2.11 which do not support --porcelain=v2. Renamed and copied
+    entries are followed by a record with the original name.
+    """
+
+    _conflicts = ('DD', 'AU', 'UD', 'UA', 'DU', 'AA', 'UU')
+
+    def parse(self, records):
+        root = self._root
+        get_file = core.file_cache.get
+        result = {}
+
+        for rec in records:
+            if self._skip_next:
+                self._skip_next = False
+                continue
+
+            if len(rec) < 4:
+                continue
+
+            xy = rec[:2]
+            if xy in self._conflicts:
+                status = GPS.VCS2.Status.CONFLICT
+            elif xy == '??':
+                status = GPS.VCS2.Status.UNTRACKED
+            elif xy == '!!':
+                status = GPS.VCS2.Status.IGNORED
+            else:
+                status = self._status(xy)
+                self._skip_next = 'R' in xy or 'C' in xy
+
+            path = rec[3:]
+
+            # Filter some obvious files to speed things up
+            if path.endswith('.o') or path.endswith('.ali'):
+                continue
+
+            result.setdefault(status, []).append(get_file(root, path))
+
+        return result
+
+
+_porcelain_v2 = None
+"""
+Whether git supports "git status --porcelain=v2", which was added in git
+2.11. This is only checked once.
+"""
+
+
+def _merge_status_requests(old, new):
+    """
+    Merge two calls to Git.async_fetch_status_for_all_files
+    """
+    files = set(old['extra_files'])
+    files.update(new['extra_files'])
+    return {'from_user': old['from_user'] or new['from_user'],
+            'extra_files': list(files)}
+
+
 @core.register_vcs(default_status=GPS.VCS2.Status.UNMODIFIED)
 class Git(core.VCS):
 
@@ -26,12 +203,40 @@ class Git(core.VCS):
         # When using "git worktree", ".git" is a file, not a directory
         return core.find_admin_directory(file, '.git', allow_file=True)
 
+    max_status_age = 60
+    """
+    Number of seconds after which "git status" is run on the whole working
+    directory even if the repository seems unchanged, to notice the files
+    modified outside of GPS.
+    """
+
+    max_files_in_status = 100
+    """
+    Above this number of saved files, run "git status" on the whole working
+    directory rather than on each file.
+    """
+
     def __init__(self, *args, **kwargs):
         super(Git, self).__init__(*args, **kwargs)
 
         self._non_default_files = None
         # Files with a non-default status
 
+        self.__git_dirs = None
+        # The git directory and the directory with the refs, which differ
+        # for worktrees.
+
+        self.__signature = None
+        # The state of the repository when "git status" last ran, see
+        # __compute_signature.
+
+        self.__watched = set()
+        # The paths of files with local changes, whose modification time is
+        # part of the signature.
+
+        self.__last_full_status = 0
+        # When "git status" last ran on the whole working directory
+
     def _git(self, args, block_exit=False, **kwargs):
         """
         Return git with the given arguments
@@ -51,59 +256,142 @@ class Git(core.VCS):
         Compute all files under version control
         :param list all_files: will be modified to include the list of files
         """
-        def on_line(line):
-            all_files.append(
-                GPS.File(os.path.join(self.working_dir.path, line)))
-        p = self._git(['ls-tree', '-r', 'HEAD', '--name-only'])
-        yield p.lines.subscribe(on_line)   # wait until p terminates
-
-    def __git_status(self, s):
+        def on_lines(lines):
+            root = self.working_dir.path
+            get_file = core.file_cache.get
+            all_files.extend(get_file(root, line) for line in lines)
+        p = self._git(['ls-tree', '-r', 'HEAD', '--name-only'],
+                      priority=ProcessScheduler.BACKGROUND, dedup=True)
+        yield p.lines_batched.subscribe(on_lines)   # wait until p terminates
+
+    def __git_status(self, s, files=None):
         """
         Run and parse "git status"
         :param s: the result of calling self.set_status_for_all_files
+        :param List(GPS.File) files: if specified, only query the status
+           of these files.
         """
-        def on_line(line):
-            if len(line) > 3:
-                if line[0:2] in ('DD', 'AU', 'UD', 'UA', 'DU', 'AA', 'UU'):
-                    status = GPS.VCS2.Status.CONFLICT
-                else:
-                    status = 0
-
-                    if line[0] == 'M':
-                        status = GPS.VCS2.Status.STAGED_MODIFIED
-                    elif line[0] == 'A':
-                        status = GPS.VCS2.Status.STAGED_ADDED
-                    elif line[0] == 'D':
-                        status = GPS.VCS2.Status.STAGED_DELETED
-                    elif line[0] == 'R':
-                        status = GPS.VCS2.Status.STAGED_RENAMED
-                    elif line[0] == 'C':
-                        status = GPS.VCS2.Status.STAGED_COPIED
-                    elif line[0] == '?':
-                        status = GPS.VCS2.Status.UNTRACKED
-                    elif line[0] == '!':
-                        status = GPS.VCS2.Status.IGNORED
-
-                    if line[1] == 'M':
-                        status = status | GPS.VCS2.Status.MODIFIED
-                    elif line[1] == 'D':
-                        status = status | GPS.VCS2.Status.DELETED
-
-                # Filter some obvious files to speed things up
-                if line[-3:] != '.o' and line[-5:] != '.ali':
-                    s.set_status(
-                        GPS.File(
-                            os.path.join(self.working_dir.path, line[3:])),
-                        status)
-
-        p = self._git(['status', '--porcelain', '--ignored'])
-        yield p.lines.subscribe(on_line)   # wait until p terminates
+        global _porcelain_v2
+        if _porcelain_v2 is None:
+            _, output = yield self._git(['--version']).wait_until_terminate()
+            m = re.search(r'(\d+)\.(\d+)', output)
+            _porcelain_v2 = (m is not None and
+                             (int(m.group(1)), int(m.group(2))) >= (2, 11))
+
+        if _porcelain_v2:
+            parser = _StatusParser(self.working_dir.path)
+            args = ['status', '--porcelain=v2', '-z', '--ignored']
+        else:
+            parser = _StatusParserV1(self.working_dir.path)
+            args = ['status', '--porcelain', '-z', '--ignored']
+
+        watched = set()
+        unwatched = (GPS.VCS2.Status.UNTRACKED, GPS.VCS2.Status.IGNORED)
+
+        def on_records(records):
+            for status, status_files in parser.parse(records).iteritems():
+                s.set_status_for_files(status_files, status)
+                if status not in unwatched:
+                    watched.update(f.path for f in status_files)
+
+        if files is not None:
+            args.append('--')
+            args.extend(f.path for f in files)
+            self.__watched.difference_update(f.path for f in files)
+        else:
+            self.__watched = set()
+
+        p = self._git(args, priority=ProcessScheduler.BACKGROUND,
+                      dedup=True)
+        yield p.records_batched("\0").subscribe(on_records)
+        self.__watched.update(watched)
+
+    def __find_git_dirs(self):
+        """
+        Return the git directory, and the one that contains the refs. For
+        worktrees, ".git" is a file that points to the git directory, which
+        itself points to the main repository.
+
+        :rtype: (str, str)
+        """
+        if self.__git_dirs is None:
+            git_dir = os.path.join(self.working_dir.path, '.git')
+            common_dir = git_dir
+            try:
+                if os.path.isfile(git_dir):
+                    with open(git_dir) as f:
+                        line = f.readline().strip()
+                    if line.startswith('gitdir:'):
+                        git_dir = os.path.join(
+                            self.working_dir.path, line[7:].strip())
+                        common_dir = git_dir
+                    commondir = os.path.join(git_dir, 'commondir')
+                    if os.path.isfile(commondir):
+                        with open(commondir) as f:
+                            common_dir = os.path.join(
+                                git_dir, f.readline().strip())
+            except (IOError, OSError):
+                pass
+            self.__git_dirs = (git_dir, common_dir)
+        return self.__git_dirs
+
+    def __compute_signature(self, exclude=()):
+        """
+        A cheap summary of the state of the repository: the modification
+        times of the index, of HEAD and of the branch it points to, and of
+        the files with local changes. If it has not changed, neither has
+        the output of "git status", except for the files that were saved
+        since then.
+
+        :param exclude: paths of watched files to leave out.
+        :rtype: dict(str, (float, int))
+        """
+        def stat(path):
+            try:
+                st = os.stat(path)
+                return (st.st_mtime, st.st_size)
+            except OSError:
+                return None
+
+        git_dir, common_dir = self.__find_git_dirs()
+        head = os.path.join(git_dir, 'HEAD')
+        paths = [os.path.join(git_dir, 'index'),
+                 head,
+                 os.path.join(common_dir, 'packed-refs')]
+        try:
+            with open(head) as f:
+                line = f.readline().strip()
+            if line.startswith('ref:'):
+                paths.append(os.path.join(common_dir, line[4:].strip()))
+        except IOError:
+            pass
+
+        paths.extend(p for p in self.__watched if p not in exclude)
+        return {p: stat(p) for p in paths}
+
+    def __status_outdated(self, files):
+        """
+        Whether the whole working directory needs to be checked again.
+
+        :param files: the files that were saved, whose status is about to
+           be refreshed anyway. Saving an already modified file changes
+           its modification time, but does not invalidate other statuses.
+        """
+        if (self.__signature is None or
+                time.time() - self.__last_full_status > self.max_status_age):
+            return True
+
+        saved = set(f.path for f in files)
+        previous = {p: st for p, st in self.__signature.iteritems()
+                    if p not in saved}
+        return self.__compute_signature(exclude=saved) != previous
 
     def async_fetch_status_for_files(self, files):
         self.async_fetch_status_for_all_files(
             from_user=False, extra_files=files)
 
-    @core.run_in_background
+    @core.run_in_background(merge=_merge_status_requests,
+                            priority=core.from_user_priority)
     def async_fetch_status_for_all_files(self, from_user, extra_files=[]):
         """
         :param List(GPS.File) extra_files: files for which we need to
@@ -120,8 +408,20 @@ class Git(core.VCS):
             all_files = []   # faster to update than a set
             yield join(self.__git_ls_tree(all_files), self.__git_status(s))
             self._non_default_files = s.files_with_explicit_status
+            self.__last_full_status = time.time()
             files.update(all_files)
 
+        elif (len(files) <= self.max_files_in_status and
+              not self.__status_outdated(files)):
+            # Nothing changed in the repository since the last run, so its
+            # result is still valid, except for the files that were saved
+            # since then.
+            if not files:
+                return
+            yield self.__git_status(s, files)
+            self._non_default_files.difference_update(files)
+            self._non_default_files.update(s.files_with_explicit_status)
+
         else:
             # Reuse caches: we do not need to recompute the full list of files
             # for git, since this will not change without also changing the
@@ -133,13 +433,14 @@ class Git(core.VCS):
             # a "reset" or a "commit").
 
             yield self.__git_status(s)
+            self.__last_full_status = time.time()
             nondefault = s.files_with_explicit_status
             now_default = self._non_default_files.difference(nondefault)
             self._non_default_files = nondefault
-            for f in now_default:
-                s.set_status(f, self.default_status)
+            s.set_status_for_files(list(now_default), self.default_status)
 
         s.set_status_for_remaining_files(files)
+        self.__signature = self.__compute_signature()
 
     @core.run_in_background
     def __action_then_update_status(self, params, files=[]):
@@ -218,37 +519,47 @@ class Git(core.VCS):
              filter_switch,
 
              '--max-count=%d' % max_lines if not branch_commits_only else '',
-             '%s' % for_file.path if for_file else ''])
+             '%s' % for_file.path if for_file else ''],
+            dedup=True)
 
         children = {}   # number of children for each sha1
         result = []
         count = 0
+        done = False
 
-        while True:
-            line = yield p.wait_line()
-            if line is None or '@@' not in line:
+        while not done:
+            lines = yield p.read_lines()
+            if lines is None:
                 GPS.Logger("GIT").log("finished git-status")
                 break
 
-            id, parents, author, branches, date, subject = line.split('@@')
-            parents = parents.split()
-            branches = None if not branches else branches.split(',')
-            current = (id, author, date, subject, parents, branches)
-
-            if branch_commits_only:
-                for pa in parents:
-                    children[pa] = children.setdefault(pa, 0) + 1
-
-                # Count only relevant commits
-                if (len(parents) > 1 or
-                        branches is not None or
-                        id not in children or
-                        children[id] > 1):
-                    count += 1
-
-            result.append(current)
-            if count >= max_lines:
-                break
+            for line in lines:
+                if '@@' not in line:
+                    GPS.Logger("GIT").log("finished git-status")
+                    done = True
+                    break
+
+                id, parents, author, branches, date, subject = \
+                    line.split('@@')
+                parents = parents.split()
+                branches = None if not branches else branches.split(',')
+                current = (id, author, date, subject, parents, branches)
+
+                if branch_commits_only:
+                    for pa in parents:
+                        children[pa] = children.setdefault(pa, 0) + 1
+
+                    # Count only relevant commits
+                    if (len(parents) > 1 or
+                            branches is not None or
+                            id not in children or
+                            children[id] > 1):
+                        count += 1
+
+                result.append(current)
+                if count >= max_lines:
+                    done = True
+                    break
 
         GPS.Logger("GIT").log(
             "done parsing git-log (%s lines)" % (len(result), ))
@@ -288,27 +599,28 @@ class Git(core.VCS):
                     id, '\n'.join(header), '\n'.join(message))
 
         while True:
-            line = yield p.wait_line()
-            if line is None:
+            lines = yield p.read_lines()
+            if lines is None:
                 _emit()
                 break
 
-            if line.startswith('commit '):
-                _emit()
-                id = line[7:]
-                message = []
-                header = [line]
-                in_header = True
-
-            elif in_header:
-                if not line:
-                    in_header = False
-                    message = ['']
-                else:
-                    header.append(line)
+            for line in lines:
+                if line.startswith('commit '):
+                    _emit()
+                    id = line[7:]
+                    message = []
+                    header = [line]
+                    in_header = True
+
+                elif in_header:
+                    if not line:
+                        in_header = False
+                        message = ['']
+                    else:
+                        header.append(line)
 
-            else:
-                message.append(line)
+                else:
+                    message.append(line)
 
     @core.run_in_background
     def async_view_file(self, visitor, ref, file):
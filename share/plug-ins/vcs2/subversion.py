@@ -2,7 +2,7 @@ from . import core, core_staging
 import GPS
 import re
 import os
-from workflows.promises import ProcessWrapper
+from workflows.promises import ProcessWrapper, ProcessScheduler
 
 
 CAT_BRANCHES = 'BRANCHES'
@@ -23,7 +23,8 @@ class SVN(core_staging.Emulate_Staging,
     def discover_working_dir(file):
         return core.find_admin_directory(file, '.svn')
 
-    def _svn(self, args, block_exit=False, spawn_console=False):
+    def _svn(self, args, block_exit=False, spawn_console=False,
+             priority=ProcessScheduler.INTERACTIVE, dedup=False):
         """
         Execute svn with the given arguments
         """
@@ -31,6 +32,8 @@ class SVN(core_staging.Emulate_Staging,
             ['svn', '--non-interactive'] + args,
             block_exit=block_exit,
             spawn_console=spawn_console,
+            priority=priority,
+            dedup=dedup,
             directory=self.working_dir.path)
 
     @core.vcs_action(icon='vcs-cloud-symbolic',
@@ -41,12 +44,14 @@ class SVN(core_staging.Emulate_Staging,
         p = self._svn(['update'], spawn_console='')
         yield p.wait_until_terminate()
 
-    @core.run_in_background
+    @core.run_in_background(merge=core.merge_file_status_requests)
     def _compute_status(self, all_files, args=[]):
         with self.set_status_for_all_files(all_files) as s:
             p = self._svn(
                 # -u: Compare with server (slower but more helpful)
-                ['status', '-v', '-u'] + args)
+                ['status', '-v', '-u'] + args,
+                priority=ProcessScheduler.BACKGROUND,
+                dedup=True)
 
             while True:
                 line = yield p.wait_line()
@@ -55,7 +60,8 @@ class SVN(core_staging.Emulate_Staging,
 
                 m = self.__re_status.search(line)
                 if m:
-                    f = os.path.join(self.working_dir.path, m.group('file'))
+                    f = core.file_cache.get(
+                        self.working_dir.path, m.group('file'))
                     rev = m.group('rev')   # current checkout
                     rrev = m.group('lastcommit')  # only if we use '-u'
 
@@ -102,7 +108,7 @@ class SVN(core_staging.Emulate_Staging,
                     if line[7] == '*':   # Only if we use -u
                         status = status | GPS.VCS2.Status.NEEDS_UPDATE
 
-                    s.set_status(GPS.File(f), status, rev, rrev)
+                    s.set_status(f, status, rev, rrev)
 
     @core.run_in_background
     def commit_staged_files(self, message):
@@ -156,7 +162,7 @@ class SVN(core_staging.Emulate_Staging,
                             self.current[3] += '\n'
                         self.current[3] += line   # subject
 
-        p = self._svn(['log', '--non-interactive'] + args)
+        p = self._svn(['log', '--non-interactive'] + args, dedup=True)
         return p.lines.flatMap(line_to_block())
 
     @core.run_in_background
@@ -4,8 +4,10 @@ files.
 """
 
 import GPS
+import re
 import time
 import traceback
+from bisect import bisect_left, bisect_right
 
 try:
     from gi.repository import GLib
@@ -14,6 +16,79 @@ except:
     gobject_available = 0
 
 
+###############
+# Large files #
+###############
+
+GPS.Preference("Editor/Large files/size").create(
+    "Size threshold", "integer",
+    """Editors with more characters than this are handled as large files: \
+syntax highlighting is only done for the visible lines, and other \
+highlighters only process the lines around the cursor, or are disabled""",
+    5000000, 0, 2000000000)
+
+GPS.Preference("Editor/Large files/line_length").create(
+    "Line length threshold", "integer",
+    """Lines longer than this are not syntax highlighted in large files. \
+Editors whose lines are this long on average, like minified or generated \
+files, are also handled as large files""",
+    10000, 80, 2000000000)
+
+GPS.Preference("Editor/Large files/context").create(
+    "Context lines", "integer",
+    """In large files, the number of lines before and after the cursor \
+processed by highlighters such as the highlighting of occurrences""",
+    200, 0, 100000)
+
+
+def max_line_length():
+    """
+    :return: the length of the longest lines that are syntax highlighted
+       in large files.
+    :rtype: int
+    """
+    return GPS.Preference("Editor/Large files/line_length").get()
+
+
+def is_large_buffer(buffer):
+    """
+    Whether buffer is a large file. Highlighters should only do a limited
+    amount of work in such buffers, so that editing stays responsive.
+
+    :param GPS.EditorBuffer buffer: the buffer to test.
+    :rtype: boolean
+    """
+    size = buffer.characters_count()
+    return (size > GPS.Preference("Editor/Large files/size").get() or
+            size > max_line_length() * buffer.lines_count())
+
+
+def visible_lines(buffer):
+    """
+    The range of lines visible in the current view of buffer.
+
+    :param GPS.EditorBuffer buffer: the buffer.
+    :return: the first and last visible lines, starting at 1, or None if
+       buffer has no view, or it is not displayed yet.
+    :rtype: (int, int)|None
+    """
+    try:
+        from gi.repository import Gtk
+        from pygps import get_widgets_by_type
+        view = get_widgets_by_type(Gtk.TextView,
+                                   buffer.current_view().pywidget())[0]
+    except Exception:
+        return None
+
+    rect = view.get_visible_rect()
+    if rect.height <= 1:
+        return None
+
+    first, _ = view.get_line_at_y(rect.y)
+    last, _ = view.get_line_at_y(rect.y + rect.height)
+    return first.get_line() + 1, last.get_line() + 1
+
+
 class OverlayStyle(object):
 
     """
@@ -116,8 +191,45 @@ class OverlayStyle(object):
         :param GPS.EditorLocation end: end of highlighted region.
         """
         buffer = start.buffer()
+        self.__apply(buffer, self.__create_style(buffer), start, end)
+
+    def apply_ranges(self, ranges):
+        """
+        Apply the highlighting to several parts of a buffer at once. Ranges
+        that overlap or touch are merged first, so that fewer overlays or
+        messages are created. Messages never span several lines.
+
+        :param ranges: the start and end of each region, as in apply. They
+           must all be in the same buffer.
+        :type ranges: list[(GPS.EditorLocation, GPS.EditorLocation)]
+        """
+        if not ranges:
+            return
+
+        spans = sorted(((s.offset(), e.offset(), s, e) for s, e in ranges),
+                       key=lambda span: span[:2])
+        use_messages = self.use_messages()
+        merged = []
+
+        for start_offset, end_offset, start, end in spans:
+            if merged and start_offset <= merged[-1][1] + 1 and (
+                    not use_messages or
+                    end.line() == merged[-1][2].line()):
+                if end_offset > merged[-1][1]:
+                    merged[-1][1] = end_offset
+                    merged[-1][3] = end
+            else:
+                merged.append([start_offset, end_offset, start, end])
+
+        buffer = merged[0][2].buffer()
         over = self.__create_style(buffer)
+        for _, _, start, end in merged:
+            self.__apply(buffer, over, start, end)
 
+    def __apply(self, buffer, over, start, end):
+        """
+        Apply the overlay or style over to a region of buffer.
+        """
         if self.use_messages():
             msg = GPS.Message(
                 category=self.name,
@@ -189,23 +301,40 @@ class Background_Highlighter(object):
         e.start_highlight(buffer1)   # start highlighting a first buffer
         e.start_highlight(buffer2)   # start highlighting a second buffer
 
+    All instances are run by a single :class:`Highlighter_Scheduler`, which
+    shares the time available in each iteration of the main loop between
+    them.
+
     :param OverlayStyle style: style to use for highlighting.
     """
-    # Interval in milliseconds between two batches.
-    # This is only used when gobject is not available
-    timeout_ms = 40
+    # Time, in seconds, that processing a batch of lines should take
+    time_budget = 0.005
 
-    # Number of lines to process at each iteration
+    # Number of lines in the first batch. The size of the following batches
+    # adapts to the measured cost of processing a line, so that a batch
+    # takes about time_budget.
     batch_size = 20
 
+    # Maximum number of lines in a batch
+    max_batch_size = 2000
+
+    # If True, the lines visible in the editor below the cursor are
+    # processed before those above it, rather than after.
+    visible_first = False
+
     # If True, highlighting is always done in the
     # foreground. This is for testsuite purposes
     synchronous = False
 
+    # How large files are highlighted (see is_large_buffer): "context" only
+    # processes the lines around the cursor, "disabled" doesn't highlight
+    # them at all, and "full" handles them as any other buffer.
+    large_files = "context"
+
     def __init__(self, style):
-        self.__source_id = None  # The gtk source_id used for background
-        # or the GPS.Timeout instance
         self.__buffers = []      # The list of buffers to highlight
+        self.__batch_size = self.batch_size
+        self.__line_cost = None  # Average time to process a line
         self.terminated = False
 
         self.style = style
@@ -217,7 +346,6 @@ class Background_Highlighter(object):
             self.__on_lines_folded_or_unfolded)
 
     def __del__(self):
-        self.__source_id = None  # Don't try to kill the idle, GPS is quitting
         self.stop_highlight()
         GPS.Hook("before_exit_action_hook").remove(self.__before_exit)
         GPS.Hook("file_closed").remove(self.__on_file_closed)
@@ -231,7 +359,6 @@ class Background_Highlighter(object):
         Called when GPS is about to exit
         """
         self.terminated = True
-        self.__source_id = None  # Don't try to kill the idle, GPS is quitting
         self.stop_highlight()
         return True
 
@@ -282,6 +409,14 @@ class Background_Highlighter(object):
                 if b[0] == buffer:
                     return
 
+            if self.large_files != "full" and is_large_buffer(buffer):
+                if self.large_files == "disabled":
+                    return
+                large_context = GPS.Preference(
+                    "Editor/Large files/context").get()
+                context = (large_context if context is None
+                           else min(context, large_context))
+
             end_line = buffer.lines_count()
             if context is not None:
                 start_line = max(0, line - context)
@@ -289,29 +424,33 @@ class Background_Highlighter(object):
             else:
                 start_line = 0
 
+            # Lines before this one are processed first, going down from
+            # the cursor line: only the cursor line itself, or the visible
+            # lines from the cursor to the bottom of the view.
+            down_first = line + 1
+            if self.visible_first:
+                visible = visible_lines(buffer)
+                if visible and visible[0] <= line <= visible[1]:
+                    down_first = max(down_first,
+                                     min(end_line, visible[1] + 1))
+
             # push at the back, so that we do not change the current buffer,
             # in case the user has computed data for it (see
             # Location_Highlighter)
             self.__buffers.append(
-                (buffer, line, line + 1, start_line, end_line))
+                (buffer, line - 1, line, start_line, end_line, down_first))
 
             if self.style and self.style.use_messages():
                 self.style.remove(buffer)
 
             if self.synchronous:
                 self.on_start_buffer(buffer)
-                while self.__do_highlight():
+                while self.do_batch():
                     pass
 
-            elif self.__source_id is None:
-                if gobject_available:
-                    self.__source_id = GLib.idle_add(
-                        self.__do_highlight)  # , priority=GLib.PRIORITY_LOW)
-                else:
-                    self.__source_id = GPS.Timeout(
-                        self.timeout_ms, self.__do_highlight)
-
+            elif len(self.__buffers) == 1:
                 self.on_start_buffer(buffer)
+                scheduler.add(self)
 
     def __on_file_closed(self, hook, file):
         for b in self.__buffers:
@@ -346,19 +485,24 @@ class Background_Highlighter(object):
         """
 
         if buffer is not None:
-            for b in self.__buffers:
+            for index, b in enumerate(self.__buffers):
                 if b[0] == buffer:
-                    self.__buffers.remove(b)
+                    self.__buffers.pop(index)
+                    if index == 0 and self.__buffers:
+                        self.on_start_buffer(self.__buffers[0][0])
                     return
 
-        elif self.__source_id:
-            if gobject_available:
-                GLib.source_remove(self.__source_id)
-            else:
-                self.__source_id.remove()
-            self.__source_id = None
-
+        else:
             self.__buffers = []
+            scheduler.remove(self)
+
+    def pending_buffers(self):
+        """
+        :return: the buffers that remain to be highlighted, starting with
+           the one being processed.
+        :rtype: list[GPS.EditorBuffer]
+        """
+        return [b[0] for b in self.__buffers]
 
     def remove_highlight(self, buffer=None):
         """
@@ -382,70 +526,82 @@ class Background_Highlighter(object):
         """
         pass
 
-    def __do_highlight(self, *args, **kwargs):
+    def __process_lines(self, buffer, from_line, to_line):
         """
-        The function called at regular intervals, and that computes
-        the range of lines to highlight.
+        Process a batch of lines, and adapt the size of the next batches to
+        the time it took.
         """
-        if self.terminated:
-            return False
+        start = time.time()
+        f = buffer.at(from_line, 1)
+
+        # Do not process if the line is folded
+        if not (from_line > 1 and f.offset() == 0):
+            e = buffer.at(to_line, 1).end_of_line()
+            if self.style:
+                self.style.remove(f, e)
+            self.process(f, e)
+
+        cost = (time.time() - start) / (to_line - from_line + 1)
+        self.__line_cost = (cost if self.__line_cost is None
+                            else (self.__line_cost + cost) / 2)
+        self.__batch_size = max(1, min(
+            self.max_batch_size,
+            int(self.time_budget / max(self.__line_cost, 1e-6))))
+
+    def do_batch(self):
+        """
+        Process the next range of lines to highlight. This is called by the
+        scheduler.
 
-        if not self.__buffers:
-            self.stop_highlight()
+        :return: whether there remain lines to highlight.
+        :rtype: boolean
+        """
+        if self.terminated or not self.__buffers:
             return False
 
         try:
             (buffer, min_line, max_line,
-             start_line, end_line) = self.__buffers[0]
+             start_line, end_line, down_first) = self.__buffers[0]
 
             changed = False
 
-            if min_line >= start_line:
-                from_line = max(start_line, min_line - self.batch_size)
-
-                f = buffer.at(from_line, 1)
-
-                # Do not process if the line is folded
-                if not (from_line > 1 and f.offset() == 0):
-                    e = buffer.at(min_line, 1).end_of_line()
-                    if self.style:
-                        self.style.remove(f, e)
-
-                    self.process(f, e)
+            if max_line < down_first:
+                to_line = min(down_first - 1, max_line + self.__batch_size)
+                try:
+                    self.__process_lines(buffer, max_line, to_line)
+                    max_line = to_line + 1
+                except Exception:
+                    # An invalid location, go on with the other lines
+                    down_first = max_line
+                changed = True
 
+            elif min_line >= start_line:
+                from_line = max(start_line, min_line - self.__batch_size)
+                self.__process_lines(buffer, from_line, min_line)
                 min_line = from_line - 1
                 changed = True
 
             elif max_line < end_line:
-                to_line = min(end_line - 1, max_line + self.batch_size)
+                to_line = min(end_line - 1, max_line + self.__batch_size)
 
                 # It is possible that the buffer has been changed so that one
                 # of the locations is now invalid, so we just protect.
                 try:
-                    f = buffer.at(max_line, 1)
-
-                    # Do not process if the line is folded
-                    if not (max_line > 1 and f.offset() == 0):
-                        e = buffer.at(to_line, 1).end_of_line()
-
-                        if self.style:
-                            self.style.remove(f, e)
-                        self.process(f, e)
-
+                    self.__process_lines(buffer, max_line, to_line)
                     max_line = to_line + 1
                     changed = True
                 except:
                     pass
 
             if changed:
-                self.__buffers[0] = (
-                    buffer, min_line, max_line, start_line, end_line)
+                self.__buffers[0] = (buffer, min_line, max_line,
+                                     start_line, end_line, down_first)
             else:
                 self.__buffers.pop(0)
                 if self.__buffers:
                     self.on_start_buffer(self.__buffers[0][0])
 
-            return True
+            return bool(self.__buffers)
 
         except Exception as e:
             GPS.Logger("HIGHLIGHTER").log("Unexpected exception: %s" % e)
@@ -454,6 +610,143 @@ class Background_Highlighter(object):
             return False
 
 
+class Highlighter_Scheduler(object):
+
+    """
+    Runs the batches of all the instances of :class:`Background_Highlighter`
+    from a single background callback, so that they do not compete for the
+    main loop.
+
+    In each iteration of the main loop, highlighters whose current buffer is
+    visible are run first, in turn, until frame_budget is spent. The others,
+    including those whose buffer has no view yet, only get the remaining
+    time.
+
+    Work is cancelled for the buffers that are no longer shown: those that
+    had a view and no longer have any, or that were destroyed. Buffers that
+    have never had a view are kept, since they may simply not be displayed
+    yet.
+    """
+
+    # Time, in seconds, spent highlighting in each iteration of the main loop
+    frame_budget = 0.01
+
+    # Interval in milliseconds between two iterations.
+    # This is only used when gobject is not available
+    timeout_ms = 40
+
+    def __init__(self):
+        self.__source_id = None  # The gtk source_id used for background
+        # or the GPS.Timeout instance
+        self.__highlighters = []  # The highlighters with pending work
+        self.__shown = set()      # The files whose buffer has had a view
+        GPS.Hook("file_closed").add(self.__on_file_closed)
+
+    def __on_file_closed(self, hook, file):
+        self.__shown.discard(file)
+
+    def add(self, highlighter):
+        """
+        Run highlighter until it has processed all its buffers.
+
+        :param Background_Highlighter highlighter: the highlighter.
+        """
+        if highlighter not in self.__highlighters:
+            self.__highlighters.append(highlighter)
+
+        if self.__source_id is None:
+            if gobject_available:
+                self.__source_id = GLib.idle_add(self.__run)
+            else:
+                self.__source_id = GPS.Timeout(self.timeout_ms, self.__run)
+
+    def remove(self, highlighter):
+        """
+        Stop running highlighter. The background callback itself stops at
+        its next iteration if there is nothing left to do.
+
+        :param Background_Highlighter highlighter: the highlighter.
+        """
+        if highlighter in self.__highlighters:
+            self.__highlighters.remove(highlighter)
+
+    def __cancel_hidden(self, highlighter):
+        """
+        Stop highlighting the buffers of highlighter that are no longer
+        shown.
+
+        :param Background_Highlighter highlighter: the highlighter.
+        """
+        for buffer in highlighter.pending_buffers():
+            try:
+                file = buffer.file()
+                shown = bool(buffer.views())
+            except Exception:
+                highlighter.stop_highlight(buffer)   # destroyed
+                continue
+
+            if shown:
+                self.__shown.add(file)
+            elif file in self.__shown:
+                highlighter.stop_highlight(buffer)
+
+    def __is_visible(self, highlighter):
+        """
+        Whether the buffer being processed by highlighter is visible.
+
+        :param Background_Highlighter highlighter: the highlighter.
+        :rtype: boolean
+        """
+        pending = highlighter.pending_buffers()
+        if not pending:
+            return False
+
+        try:
+            from pygps import is_editor_visible
+            return is_editor_visible(pending[0])
+        except Exception:
+            return False
+
+    def __run(self, *args):
+        """
+        The background callback.
+        """
+        deadline = time.time() + self.frame_budget
+        for highlighter in self.__highlighters:
+            self.__cancel_hidden(highlighter)
+
+        visible = [h for h in self.__highlighters if self.__is_visible(h)]
+        others = [h for h in self.__highlighters if h not in visible]
+
+        for group in (visible, others):
+            while group:
+                for highlighter in list(group):
+                    if not highlighter.do_batch():
+                        group.remove(highlighter)
+                        self.remove(highlighter)
+
+                    if time.time() >= deadline:
+                        return self.__continue()
+
+        return self.__continue()
+
+    def __continue(self):
+        """
+        Return whether the background callback should run again.
+        """
+        self.__highlighters = [
+            h for h in self.__highlighters if h.pending_buffers()]
+
+        if not self.__highlighters:
+            self.__source_id = None
+            return False
+        return True
+
+
+scheduler = Highlighter_Scheduler()
+"""The scheduler that runs all Background_Highlighter instances"""
+
+
 class On_The_Fly_Highlighter(Background_Highlighter):
 
     """
@@ -538,6 +831,129 @@ class On_The_Fly_Highlighter(Background_Highlighter):
             self.start_highlight(buffer, context=self.context_lines)
 
 
+class Reference_Index(object):
+
+    """
+    The references to entities in a buffer, grouped by line and sorted, so
+    that the references in a range of lines are found with a binary search.
+
+    The index follows the insertion and deletion of text in the buffer, see
+    insert_lines and delete_lines, so that it doesn't have to be rebuilt
+    after each edit.
+
+    :param refs: a list of (name, GPS.FileLocation), as returned by
+       :func:`Location_Highlighter.recompute_refs`.
+    """
+
+    def __init__(self, refs=()):
+        buckets = {}
+        for name, ref in refs:
+            buckets.setdefault(ref.line(), []).append(
+                (ref.column(), name, ref))
+
+        self.__lines = sorted(buckets)  # the lines that have references
+        self.__buckets = [sorted(buckets[line], key=lambda r: r[0])
+                          for line in self.__lines]
+
+    def __len__(self):
+        return sum(len(b) for b in self.__buckets)
+
+    def query(self, from_line, to_line):
+        """
+        Return the references between two lines, included.
+
+        :param integer from_line: the first line.
+        :param integer to_line: the last line.
+        :return: a list of (line, column, name, ref) sorted by location,
+           where line is the current line of ref.
+        :rtype: list[(integer, integer, str, GPS.FileLocation)]
+        """
+        result = []
+        for index in range(bisect_left(self.__lines, from_line),
+                           bisect_right(self.__lines, to_line)):
+            line = self.__lines[index]
+            result.extend((line, column, name, ref)
+                          for column, name, ref in self.__buckets[index])
+        return result
+
+    def insert_lines(self, line, nb_lines, column, end_column):
+        """
+        Update the index when text is inserted in the buffer. The references
+        that follow the insertion on the same line move with the text.
+
+        :param integer line: the line where the text was inserted.
+        :param integer nb_lines: the number of new lines.
+        :param integer column: the column where the text was inserted.
+        :param integer end_column: the column, on line + nb_lines, of the
+           character that followed the insertion.
+        """
+        lines = self.__lines
+        index = bisect_left(lines, line)
+        moved = []
+
+        if index < len(lines) and lines[index] == line:
+            bucket = self.__buckets[index]
+            split = bisect_left(bucket, (column, ))
+            moved = [(c - column + end_column, name, ref)
+                     for c, name, ref in bucket[split:]]
+            del bucket[split:]
+            if bucket:
+                index += 1
+            else:
+                del lines[index]
+                del self.__buckets[index]
+
+        if nb_lines:
+            lines[index:] = [n + nb_lines for n in lines[index:]]
+
+        if moved:
+            if index > 0 and lines[index - 1] == line + nb_lines:
+                self.__buckets[index - 1].extend(moved)
+            else:
+                lines.insert(index, line + nb_lines)
+                self.__buckets.insert(index, moved)
+
+    def delete_lines(self, line, nb_lines, column, end_column):
+        """
+        Update the index when text is deleted from the buffer. The references
+        in that text are removed, and those that follow it on its last line
+        move with the text.
+
+        :param integer line: the line where the deleted text started.
+        :param integer nb_lines: the number of deleted newlines.
+        :param integer column: the column where the deleted text started.
+        :param integer end_column: the column, on line + nb_lines, of the
+           character that followed the deleted text.
+        """
+        lines = self.__lines
+        start = bisect_left(lines, line)
+        end = bisect_right(lines, line + nb_lines)
+        if start == end:
+            if nb_lines:
+                lines[start:] = [n - nb_lines for n in lines[start:]]
+            return
+
+        kept = []
+        if lines[start] == line:
+            bucket = self.__buckets[start]
+            kept = bucket[:bisect_left(bucket, (column, ))]
+
+        if lines[end - 1] == line + nb_lines:
+            bucket = self.__buckets[end - 1]
+            kept.extend((c - end_column + column, name, ref)
+                        for c, name, ref in
+                        bucket[bisect_left(bucket, (end_column, )):])
+
+        del lines[start:end]
+        del self.__buckets[start:end]
+        if nb_lines:
+            lines[start:] = [n - nb_lines for n in lines[start:]]
+
+        if kept:
+            lines.insert(start, line)
+            self.__buckets.insert(start, kept)
+
+
 class Location_Highlighter(Background_Highlighter):
     """
     An abstract class that can be used to implement highlighter related to
@@ -559,8 +975,9 @@ class Location_Highlighter(Background_Highlighter):
 
     def __init__(self, style, context=2):
         Background_Highlighter.__init__(self, style)
-        self._refs = []  # list of (entity, ref) in the current buffer
+        self._refs = Reference_Index()  # the refs in the current buffer
         self.context = context
+        self.__tracked = None    # (gtk buffer, handler ids) for self._refs
 
     def recompute_refs(self, buffer):
         """
@@ -576,20 +993,61 @@ class Location_Highlighter(Background_Highlighter):
         return []
 
     def on_start_buffer(self, buffer):  # overriding
-        # ??? Should use a more efficient data structure where we can
-        # easily find the references within a given range.
-        self._refs = self.recompute_refs(buffer=buffer)
+        self._refs = Reference_Index(self.recompute_refs(buffer=buffer))
+        self.__track_edits(buffer)
+
+    def __track_edits(self, buffer):
+        """
+        Keep self._refs up to date when text is added to or removed from
+        buffer.
+        """
+        if self.__tracked:
+            gtk_buffer, ids = self.__tracked
+            self.__tracked = None
+            try:
+                for handler_id in ids:
+                    gtk_buffer.disconnect(handler_id)
+            except Exception:
+                pass   # The buffer was destroyed
+
+        try:
+            from pygps import get_gtk_buffer
+            gtk_buffer = get_gtk_buffer(buffer)
+        except Exception:
+            return
+
+        def on_insert_text(buf, loc, text, length):
+            if isinstance(text, str):
+                text = text.decode("utf-8")
+            column = loc.get_line_offset() + 1
+            nb_lines = text.count("\n")
+            if nb_lines:
+                end_column = len(text) - text.rfind("\n")
+            else:
+                end_column = column + len(text)
+            self._refs.insert_lines(
+                loc.get_line() + 1, nb_lines, column, end_column)
+
+        def on_delete_range(buf, start, end):
+            self._refs.delete_lines(
+                start.get_line() + 1, end.get_line() - start.get_line(),
+                start.get_line_offset() + 1, end.get_line_offset() + 1)
+
+        self.__tracked = (gtk_buffer, [
+            gtk_buffer.connect("insert-text", on_insert_text),
+            gtk_buffer.connect("delete-range", on_delete_range)])
 
     def process(self, start, end):  # overriding
         ed = start.buffer()
 
-        s = GPS.FileLocation(ed.file(), start.line(), start.column())
-        e = GPS.FileLocation(ed.file(), end.line(), end.column())
+        s = (start.line(), start.column())
+        e = (end.line(), end.column())
+        ranges = []
 
-        for entity_name, ref in self._refs:
-            if s <= ref <= e:
+        for line, column, entity_name, _ in self._refs.query(s[0], e[0]):
+            if s <= (line, column) <= e:
                 u = entity_name.decode("utf-8").lower()
-                s2 = ed.at(ref.line(), ref.column())
+                s2 = ed.at(line, column)
 
                 try:
                     e2 = s2 + (len(u) - 1)
@@ -599,32 +1057,75 @@ class Location_Highlighter(Background_Highlighter):
 
                 b = ed.get_chars(s2, e2).decode("utf-8").lower()
                 if b == u:
-                    self.style.apply(s2, e2)
+                    ranges.append((s2, e2))
 
                 elif self.context > 0:
                     for c in range(1, self.context + 1):
                         # Search after original xref line (same column)
                         try:
                             s2 = GPS.EditorLocation(
-                                ed, ref.line() + c, ref.column())
+                                ed, line + c, column)
                             e2 = s2 + (len(u) - 1)
                             b = ed.get_chars(s2, e2).decode("utf-8").lower()
                             if b == u:
-                                self.style.apply(s2, e2)
+                                ranges.append((s2, e2))
                                 break
 
                             # Search before original xref line
                             s2 = GPS.EditorLocation(
-                                ed, ref.line() - c, ref.column())
+                                ed, line - c, column)
                             e2 = s2 + (len(u) - 1)
                             b = ed.get_chars(s2, e2).decode("utf-8").lower()
                             if b == u:
-                                self.style.apply(s2, e2)
+                                ranges.append((s2, e2))
                                 break
                         except:
                             # An invalid location ?
                             continue
 
+        self.style.apply_ranges(ranges)
+
+
+def find_all(pattern, start, end, overlap=0):
+    """
+    Find all the matches of a regular expression in part of an editor. The
+    text is fetched and searched at once, rather than through one
+    :func:`GPS.EditorLocation.search` per match.
+
+    :param pattern: a compiled regular expression
+    :param GPS.EditorLocation start: start of the region to search.
+    :param GPS.EditorLocation end: end of the region to search.
+    :param int overlap: the number of characters after end that matches
+       starting in the region may extend to. Matches that start after end
+       are ignored.
+    :return: the first and last characters of each non-empty match.
+    :rtype: list[(GPS.EditorLocation, GPS.EditorLocation)]
+    """
+    limit = None
+    if overlap:
+        limit = end.offset() - start.offset() + 1
+        end = end + overlap
+
+    text = start.buffer().get_chars(start, end).decode("utf-8")
+    result = []
+
+    # Locations are computed relative to the previous match, to move by the
+    # smallest number of characters.
+    loc = start
+    offset = 0
+
+    for m in pattern.finditer(text):
+        if limit is not None and m.start() >= limit:
+            break
+        if m.end() > m.start():
+            first = loc + (m.start() - offset)
+            last = first + (m.end() - 1 - m.start())
+            result.append((first, last))
+            loc = last
+            offset = m.end() - 1
+
+    return result
+
 
 class Regexp_Highlighter(On_The_Fly_Highlighter):
 
@@ -673,10 +1174,22 @@ class Regexp_Highlighter(On_The_Fly_Highlighter):
 
     def __init__(self, regexp, style, context_lines=0):
         self.regexp = regexp
+
+        # Match in Python when possible. GPS.EditorLocation.search is only
+        # used for the regular expressions that Python doesn't support.
+        try:
+            self.__pattern = re.compile(regexp, re.M | re.I | re.U)
+        except re.error:
+            self.__pattern = None
+
         On_The_Fly_Highlighter.__init__(
             self, context_lines=context_lines, style=style)
 
     def process(self, start, end):
+        if self.__pattern is not None:
+            self.style.apply_ranges(find_all(self.__pattern, start, end))
+            return
+
         while True:
             start = start.search(
                 self.regexp, regexp=True, dialog_on_failure=False)
@@ -702,17 +1215,38 @@ class Text_Highlighter(On_The_Fly_Highlighter):
     """
 
     def __init__(self, text, style, whole_word=False, context_lines=0):
-        self.text = text
-        self.whole_word = whole_word
+        self.__text = text
+        self.__whole_word = whole_word
+        self.__compile()
         On_The_Fly_Highlighter.__init__(
             self, context_lines=context_lines, style=style)
 
+    @property
+    def text(self):
+        return self.__text
+
+    @text.setter
+    def text(self, text):
+        self.__text = text
+        self.__compile()
+
+    @property
+    def whole_word(self):
+        return self.__whole_word
+
+    @whole_word.setter
+    def whole_word(self, whole_word):
+        self.__whole_word = whole_word
+        self.__compile()
+
+    def __compile(self):
+        pattern = re.escape(self.__text)
+        if self.__whole_word:
+            pattern = r"\b%s\b" % pattern
+        self.__pattern = re.compile(pattern, re.I | re.U)
+
     def process(self, start, end):
-        while True:
-            start = start.search(
-                self.text, regexp=False, dialog_on_failure=False,
-                whole_word=self.whole_word)
-            if not start or start[0] > end:
-                return
-            self.style.apply(start[0], start[1] - 1)
-            start = start[1] + 1
+        # Occurrences that start before end are highlighted in full. The
+        # extra character is needed to check the end of a whole word.
+        self.style.apply_ranges(find_all(
+            self.__pattern, start, end, overlap=len(self.__text) + 1))
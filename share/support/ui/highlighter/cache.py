@@ -0,0 +1,130 @@
+"""
+A persistent cache of the tokens of highlighted buffers.
+
+Reopening a large file that hasn't changed since it was last highlighted
+reuses the spans and the stacks of highlighters computed at that time, rather
+than running the regular expressions again.
+
+Each entry is stored in its own file, named after its key, in the cache
+directory. The modification time of these files records when they were last
+used, and the least recently used entries are evicted when the cache grows
+past its limits.
+
+This module does not depend on GPS.
+"""
+
+import os
+import pickle
+import tempfile
+import time
+
+FORMAT_VERSION = 1
+"""Change this when the format of entries changes, to invalidate them"""
+
+
+class HighlightCache(object):
+    """
+    An LRU cache of tokenized buffers, stored in a directory.
+    """
+
+    max_entries = 64
+    """Maximum number of buffers in the cache"""
+
+    max_size = 256 * 1024 * 1024
+    """Maximum total size of the cache, in bytes"""
+
+    tmp_max_age = 3600
+    """
+    Temporary files older than this many seconds were left behind by a GPS
+    that stopped while storing an entry, and are removed.
+    """
+
+    def __init__(self, directory):
+        """
+        :param str directory: where the entries are stored. It is created
+          when the first entry is stored.
+        """
+        self.directory = directory
+
+    def __path(self, key):
+        return os.path.join(self.directory, "%s.v%d" % (key, FORMAT_VERSION))
+
+    def get(self, key):
+        """
+        Return the value stored for key, or None.
+
+        :param str key: a hash identifying the highlighter and the text
+        """
+        path = self.__path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path, None)
+            return value
+        except Exception:
+            # A corrupted or truncated entry: forget about it
+            self.__remove(path)
+            return None
+
+    def put(self, key, value):
+        """
+        Store value for key, and evict the least recently used entries if
+        the cache is too large. Errors are ignored, since the cache is only
+        an optimization.
+
+        :param str key: a hash identifying the highlighter and the text
+        :param value: any picklable object
+        """
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            # Write to a temporary file first, so that other GPS instances
+            # never read a partial entry.
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, 2)
+            os.rename(tmp, self.__path(key))
+        except Exception:
+            return
+
+        self.__evict()
+
+    def __evict(self):
+        """
+        Remove the least recently used entries, until the cache is within
+        its limits.
+        """
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            # Recent temporary files are entries being written, possibly by
+            # another GPS instance.
+            if name.endswith(".tmp"):
+                if now - st.st_mtime > self.tmp_max_age:
+                    self.__remove(path)
+                continue
+
+            entries.append((st.st_mtime, st.st_size, path))
+
+        entries.sort(reverse=True)
+        total = 0
+        for num, (_, size, path) in enumerate(entries):
+            total += size
+            if num >= self.max_entries or total > self.max_size:
+                self.__remove(path)
+
+    def __remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
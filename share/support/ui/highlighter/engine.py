@@ -1,21 +1,38 @@
 import GPS
 from modules import Module
+from gps_utils.highlighter import is_large_buffer, max_line_length, \
+    visible_lines
 
 try:
     # While building the doc, we might not have gi.repository
     from gi.repository import Gtk, GLib, Gdk, Pango
-    from pygps import get_gtk_buffer, is_editor_visible
+    from pygps import get_gtk_buffer, is_editor_visible, get_widgets_by_type
 except ImportError:
     pass
 
+import hashlib
+import os
 import re
+from array import array
+from bisect import bisect_right
 from time import time
 
+from highlighter.cache import HighlightCache
+from highlighter.stacks import HighlighterStacks, ListHighlighterStacks
+from highlighter.stats import HighlighterStats
+from highlighter.worker import tokenizer_pool
+
 
 class HighlighterModule(Module):
     highlighters = {}
     preferences = {}
 
+    cache = None
+    """
+    The tokens of large buffers, indexed by the highlighter and the text.
+    :type: HighlightCache
+    """
+
     def init_highlighting(self, f):
         highlighter = self.highlighters.get(f.language(), None)
         if isinstance(highlighter, Highlighter):
@@ -24,9 +41,12 @@ class HighlighterModule(Module):
                 gtk_ed = get_gtk_buffer(ed)
                 if not gtk_ed.highlighting_initialized:
                     highlighter.init_highlighting(ed)
-                    highlighter.gtk_highlight(gtk_ed)
+                    highlighter.gtk_highlight(gtk_ed, get_visible_lines(ed))
 
     def setup(self):
+        HighlighterModule.cache = HighlightCache(
+            os.path.join(GPS.get_home_dir(), "highlighter_cache"))
+
         for ed in GPS.EditorBuffer.list():
             if is_editor_visible(ed):
                 self.init_highlighting(ed.file())
@@ -97,6 +117,49 @@ def iter_eq(iter_1, iter_2):
     return iter_1.to_tuple() == iter_2.to_tuple()
 
 
+def get_visible_lines(ed):
+    """
+    Return the range of lines currently visible in the view of ed, or None
+    if the view has not been allocated yet.
+
+    :type ed: GPS.EditorBuffer
+    :rtype: (int, int)|None
+    """
+    visible = visible_lines(ed)
+    return (visible[0] - 1, visible[1] - 1) if visible else None
+
+
+def merge_spans(spans):
+    """
+    Return the union of the given spans, as a tuple of spans that do not
+    overlap when they have the same tag, sorted by offset.
+
+    :type spans: list[(Gtk.TextTag, int, int)]
+    :rtype: tuple[(Gtk.TextTag, int, int)]
+    """
+    if len(spans) < 2:
+        return tuple(spans)
+
+    by_tag = {}
+    for tag, start, end in spans:
+        by_tag.setdefault(tag, []).append((start, end))
+
+    result = []
+    for tag, ranges in by_tag.items():
+        ranges.sort()
+        cur_start, cur_end = ranges[0]
+        for start, end in ranges[1:]:
+            if start > cur_end:
+                result.append((tag, cur_start, cur_end))
+                cur_start, cur_end = start, end
+            else:
+                cur_end = max(cur_end, end)
+        result.append((tag, cur_start, cur_end))
+
+    result.sort(key=lambda span: (span[1], span[2], id(span[0])))
+    return tuple(result)
+
+
 def tag_to_str(gtk_tag):
     return "<TextTag {0}>".format(gtk_tag.props.name)
 
@@ -293,63 +356,21 @@ class RegionRef(BaseMatcher):
 ########################
 
 
-class HighlighterStacks(object):
+class DetachedStacks(object):
+    """
+    A stand-in for HighlighterStacks that doesn't record anything. It is used
+    to highlight a range of lines speculatively, starting from the given
+    stack, without corrupting the stacks of the buffer.
+    """
 
-    def __init__(self):
-        # The stack of highlighter at (0, 0) is necessarily the empty stack,
-        # so the stack list comes prepopulated with one empty stack
-        self.stacks_list = [()]
+    def __init__(self, stack):
+        self.stack = tuple(stack)
 
     def set(self, index, stack):
-        """
-        Set the stack of highlighters for line index. Returns true if the
-        previous stack is the same as the stack argument.
-
-        :type index: int
-        :type stack: tuple[Struct]
-        @rtype:      bool
-        """
-        assert 0 <= index <= len(self.stacks_list)
-
-        tpstack = tuple(stack)
-        if index == len(self.stacks_list):
-            self.stacks_list.append(tpstack)
-            return False
-        else:
-            current_stack = self.stacks_list[index]
-            self.stacks_list[index] = tpstack
-            return tpstack == current_stack
+        return False
 
     def get(self, start_line):
-        """
-        :type start_line: int
-        @rtype:           tuple[Struct]|None
-        """
-        if start_line < len(self.stacks_list):
-            return self.stacks_list[start_line][:]
-        else:
-            return None
-
-    def insert_newlines(self, nb_lines, after_line):
-        """
-        :type after_line: int
-        :type nb_lines:   int
-        """
-        for _ in range(nb_lines):
-            self.stacks_list.insert(after_line + 1, ())
-
-    def delete_lines(self, nb_deleted_lines, at_line):
-        """
-        :param nb_deleted_lines: int
-        :param at_line: int
-        """
-        del self.stacks_list[at_line + 1:at_line + nb_deleted_lines + 1]
-
-    def __str__(self):
-        return "{0}".format(
-            "\n".join(["{0}\t{1}".format(num, [c for c in stack])
-                       for num, stack in enumerate(self.stacks_list)])
-        )
+        return self.stack
 
 
 class SubHighlighter(object):
@@ -390,8 +411,110 @@ class SubHighlighter(object):
         return self.__str__()
 
 
+class TagResolver(dict):
+    """
+    Maps the keys returned by Highlighter.tokenize to the tags of a given
+    buffer.
+    """
+
+    def __init__(self, gtk_ed):
+        super(TagResolver, self).__init__()
+        self.gtk_ed = gtk_ed
+
+    def __missing__(self, key):
+        if key is None:
+            tag = None
+        elif isinstance(key, SubHighlighter):
+            tag = (key.parent_cat.init_tag(self.gtk_ed)
+                   if key.parent_cat else None)
+        else:
+            tag = key.init_tag(self.gtk_ed)
+
+        self[key] = tag
+        return tag
+
+
+class TokenizerJob(object):
+    """
+    The tokenization of the end of a buffer by a worker process. Its tokens
+    are consumed by the background highlighting as the frontier moves.
+    """
+
+    def __init__(self, start_line, base_offset):
+        self.id = None
+        self.start_line = start_line
+        self.base_offset = base_offset  # Offset of the start of the snapshot
+        self.line_delta = 0       # Lines added before the snapshot since
+        self.valid_until = None   # First line that was edited since
+
+        self.spans = None   # array of (key, start, end), sorted by start
+        self.runs = None    # list of (line, stack) where the stack changes
+        self.cursor = 0     # Index of the next span to apply in spans
+        self.run_index = 0  # Index of the run of the last consumed line
+        self.carry = []     # (key, end) of spans that go past the last chunk
+
+    def stack_at(self, line):
+        """
+        Return the stack of the given line, as a list of key indexes.
+        Lines must be queried in increasing order.
+
+        :param int line: a line number in the buffer
+        :rtype: list[int]
+        """
+        line -= self.line_delta
+        while (self.run_index + 1 < len(self.runs)
+               and self.runs[self.run_index + 1][0] <= line):
+            self.run_index += 1
+        return self.runs[self.run_index][1]
+
+
 class Highlighter(object):
 
+    incremental_threshold = 3000
+    """
+    Buffers with more lines than this are highlighted in the background:
+    the visible lines are highlighted first, and the rest of the buffer is
+    then processed in idle chunks.
+    """
+
+    stacks_threshold = 100000
+    """
+    Buffers with more lines than this store the stacks of highlighters of
+    their lines in a HighlighterStacks, which uses much less memory. The
+    others use a ListHighlighterStacks, where reading the stack of a line,
+    as highlighting does for every line, is faster.
+    """
+
+    chunk_lines = 200
+    """Number of lines highlighted at a time during background highlighting"""
+
+    chunk_time_budget = 0.02
+    """
+    Time, in seconds, that background highlighting may use in a single idle
+    callback before giving control back to the main loop.
+    """
+
+    worker_threshold = 1000000
+    """
+    When more than this number of characters remain to be highlighted in
+    the background, they are tokenized by a worker process, and the main
+    loop only applies the resulting tags. None disables workers.
+    """
+
+    cache_min_size = 200000
+    """
+    The tokens of buffers that have at least this number of characters are
+    stored in HighlighterModule.cache, so that they are not computed again
+    when the same text is highlighted later. None disables the cache.
+    """
+
+    cache_max_size = 10000000
+    """
+    Buffers that have more than this number of characters are not cached:
+    the key of an entry is a hash of the whole text, computed before the
+    buffer is highlighted.
+    """
+
     def __init__(self, spec=(), igncase=False):
         """
         :type spec: Iterable[BaseMatcher]
@@ -399,16 +522,113 @@ class Highlighter(object):
         """
         self.root_highlighter = SubHighlighter(spec, igncase=igncase)
         self.sync_stop = False
+        self.__keys = None
+        self.__fingerprint = None
+        self.stats = HighlighterStats()
+
+    def keys(self):
+        """
+        Return the list of the sub highlighters and matchers reachable from
+        the root highlighter, and a dict mapping each of them to its index
+        in the list. The order is deterministic, so worker processes compute
+        the same indexes.
 
-    def highlight_info_gen(self, gtk_ed, start_line, end_line=0):
+        :rtype: (list[SubHighlighter|Matcher], dict)
+        """
+        if self.__keys is None:
+            keys = []
+            index = {}
+            todo = [self.root_highlighter]
+
+            while todo:
+                hl = todo.pop(0)
+                if hl not in index:
+                    index[hl] = len(keys)
+                    keys.append(hl)
+
+                    for m in hl.matchers:
+                        if m is not None and m not in index:
+                            index[m] = len(keys)
+                            keys.append(m)
+                            if isinstance(m, RegionMatcher):
+                                todo.append(m.subhighlighter)
+
+            self.__keys = (keys, index)
+        return self.__keys
+
+    def fingerprint(self):
+        """
+        Return a hash of the patterns and styles of this highlighter, which
+        identifies the tokens it computes.
+
+        :rtype: str
+        """
+        if self.__fingerprint is None:
+            parts = []
+            for key in self.keys()[0]:
+                if isinstance(key, SubHighlighter):
+                    parts.append((key.pattern.pattern, key.pattern.flags))
+                else:
+                    parts.append((type(key).__name__,
+                                  getattr(key.tag, "style_id", None)))
+            self.__fingerprint = hashlib.sha1(repr(parts)).hexdigest()
+        return self.__fingerprint
+
+    def language(self):
+        """
+        Return the language this highlighter is registered for
+        """
+        for lang, hl in HighlighterModule.highlighters.items():
+            if hl is self:
+                return lang
+        return None
+
+    def tokenize_snapshot(self, text, start_line, stack):
+        """
+        Tokenize text, in a worker process.
+
+        :param unicode text: the text to highlight, starting at the
+          beginning of start_line.
+        :param list[int] stack: the stack of highlighters at the beginning
+          of text, as indexes in keys().
+        :return: the (key index, start, end) triplets of the spans, sorted
+          by start offset, in a flat array of integers, and the list of
+          (line, stack) for the lines where the stack changes.
+        :rtype: (array, list[(int, list[int])])
+        """
+        keys, index = self.keys()
+        runs = [(start_line, list(stack))]
+
+        def set_stack(line, subhl_stack):
+            ids = [index[hl] for hl in subhl_stack]
+            if runs[-1][1] != ids:
+                runs.append((line, ids))
+            return False
+
+        results = self.tokenize(text, start_line, [keys[i] for i in stack],
+                                set_stack, start_line + text.count("\n"))
+        results.sort(key=lambda r: r[1])
+
+        spans = array("i")
+        for key, start, end in results:
+            spans.extend((-1 if key is None else index[key], start, end))
+        return spans, runs
+
+    def highlight_info_gen(self, gtk_ed, start_line, end_line=0, stacks=None,
+                           record=None):
         """
         Returns a generator that will highlight the buffer, one token at a
         time, every time the generator is consumed.
 
         :type gtk_ed: Gtk.TextBuffer
         :type start_line: int
+        :param HighlighterStacks|ListHighlighterStacks|DetachedStacks stacks:
+          the stacks to read and update, defaults to the stacks of gtk_ed.
+        :param array|None record: if not None, the (key index, start, end)
+          triplets of the spans are appended to it, see keys().
         """
-        self.sync_stop = False
+        if stacks is None:
+            stacks = gtk_ed.stacks
 
         start = gtk_ed.get_iter_at_line(start_line)
         ":type: Gtk.TextIter"
@@ -421,32 +641,69 @@ class Highlighter(object):
         strn = gtk_ed.get_text(start, end, True).decode('utf-8')
         ":type: unicode"
 
-        current_line = start_line
-
         if start_line == 0:
             subhl_stack = [self.root_highlighter]
-            gtk_ed.stacks.set(0, subhl_stack)
+            stacks.set(0, subhl_stack)
         else:
-            subhl_stack = list(gtk_ed.stacks.get(start_line))
+            subhl_stack = list(stacks.get(start_line))
+
+        t = time()
+        results = self.tokenize(strn, start_line, subhl_stack, stacks.set,
+                                end.get_line())
+        self.stats.record_tokenize(len(results) - 1, time() - t,
+                                   self.sync_stop)
+
+        start_offset = start.get_offset()
+        if record is not None:
+            self.__record(record, results, start_offset)
+
+        tags = TagResolver(gtk_ed)
+        return [(tags[key], start_offset + start, start_offset + end)
+                for key, start, end in results]
+
+    def __record(self, record, results, start_offset):
+        """
+        Append the spans in results to record, see highlight_info_gen.
+        """
+        _, index = self.keys()
+        for key, start, end in sorted(results, key=lambda r: r[1]):
+            if key is not None and start < end:
+                record.extend(
+                    (index[key], start_offset + start, start_offset + end))
+
+    def tokenize(self, strn, start_line, subhl_stack, set_stack, last_line):
+        """
+        The state machine behind highlight_info_gen. It doesn't depend on
+        Gtk, so that it can also run in a worker process.
+
+        :param unicode strn: the text to highlight, which starts at the
+          beginning of start_line.
+        :param list[SubHighlighter] subhl_stack: the stack of highlighters
+          at the beginning of strn. It is modified in place.
+        :param set_stack: called with a line number and the stack of
+          highlighters at the beginning of that line. If it returns True,
+          the stack hasn't changed, so the rest of the text is in sync and
+          highlighting stops there.
+        :param int last_line: the line at the end of strn.
+        :return: a list of (key, start, end) with offsets in strn, where key
+          is the Matcher, or the SubHighlighter of the region, whose tag
+          applies to the span, or None. The last element ends at the end of
+          the highlighted text.
+        :rtype: list[(Matcher|SubHighlighter|None, int, int)]
+        """
+        self.sync_stop = False
 
+        current_line = start_line
         match_offset = 0
         last_start_offset = 0
         results = []
-        hl_tags = {}
         rstarts = []
-        start_offset = start.get_offset()
-        end_offset = end.get_offset()
+        end_offset = len(strn)
 
         while subhl_stack:
             hl = subhl_stack[-1]
             matches = hl.pattern.finditer(strn, match_offset)
 
-            # Cache tags
-            tags = hl_tags.get(hl, None)
-            if not tags:
-                tags = hl.get_tags_list(gtk_ed)
-                hl_tags[hl] = tags
-
             pop_stack = True
             met_stop_pattern = False
 
@@ -456,27 +713,26 @@ class Highlighter(object):
                 i = [j for j in range(1, len(hl.matchers) + 1)
                      if m.span(j) != null_span][0]
 
-                matcher, tag = hl.matchers[i - 1], tags[i - 1]
+                matcher = hl.matchers[i - 1]
                 start_line += strn.count("\n",
                                          last_start_offset, m.start(i))
                 last_start_offset = m.start(i)
-                tk_start_offset = start_offset + m.start(i)
-                tk_end_offset = start_offset + m.end(i)
+                tk_start_offset = m.start(i)
+                tk_end_offset = m.end(i)
 
                 if start_line > current_line:
                     for l in range(current_line + 1, start_line):
-                        gtk_ed.stacks.set(l, subhl_stack)
+                        set_stack(l, subhl_stack)
                     current_line = start_line
 
                     # We exit because the stack we're setting is == to the
-                    # existing one, so the buffer is synced
-                    if gtk_ed.stacks.set(current_line, subhl_stack):
-                        endi = gtk_ed.get_iter_at_line(current_line)
-                        endi.backward_char()
-                        endo = endi.get_offset()
-                        rstart = rstarts.pop() if rstarts else start_offset
-                        results.append((subhl_stack[-1].gtk_tag, rstart,
-                                        endo))
+                    # existing one, so the buffer is synced. The last span
+                    # includes the newline before current_line, whose tag
+                    # is the one of the unchanged stack.
+                    if set_stack(current_line, subhl_stack):
+                        endo = strn.rfind("\n", 0, tk_start_offset) + 1
+                        rstart = rstarts.pop() if rstarts else 0
+                        results.append((subhl_stack[-1], rstart, endo))
                         self.sync_stop = True
                         return results
 
@@ -484,12 +740,11 @@ class Highlighter(object):
                 # return to the parent highlighter after having yielded the
                 # location of the region stop-pattern.
                 if not matcher:
-                    assert isinstance(hl.gtk_tag, Gtk.TextTag)
                     # If the region has no region start, we are
                     # rehighlighting a region that was previously created,
                     # and has no stored region start.
-                    rstart = rstarts.pop() if rstarts else start_offset
-                    results.append((hl.gtk_tag, rstart, tk_end_offset))
+                    rstart = rstarts.pop() if rstarts else 0
+                    results.append((hl, rstart, tk_end_offset))
                     match_offset = m.end(i)
                     met_stop_pattern = True
                     break
@@ -502,10 +757,7 @@ class Highlighter(object):
                     pop_stack = False
                     break
 
-                if tag:
-                    results.append((tag, tk_start_offset, tk_end_offset))
-                else:
-                    assert False
+                results.append((matcher, tk_start_offset, tk_end_offset))
 
             # If a region highlighter is stacked, we haven't met it's stop
             # pattern, but yet exhausted the matcher, and we didn't just put
@@ -513,8 +765,8 @@ class Highlighter(object):
             # so we can highlight to the end of the buffer with this region's
             # tag
             if len(subhl_stack) > 1 and not met_stop_pattern and pop_stack:
-                rstart = rstarts.pop() if rstarts else start_offset
-                results.append((hl.gtk_tag, rstart, end_offset))
+                rstart = rstarts.pop() if rstarts else 0
+                results.append((hl, rstart, end_offset))
                 # We break out of the while loop to keep the stack intact
                 break
 
@@ -528,69 +780,663 @@ class Highlighter(object):
         # of the buffer (didn't meet a stop pattern, or is the top level hl).
         #  In this case, we want to set the stack correctly for the remaining
         #  lines
-        for l in range(current_line + 1, end.get_line() + 1):
-            gtk_ed.stacks.set(l, subhl_stack)
+        for l in range(current_line + 1, last_line + 1):
+            set_stack(l, subhl_stack)
 
         results.append((None, end_offset, end_offset))
         return results
 
-    def highlight_gen(self, gtk_ed, start_line=-1):
+    def highlight_gen(self, gtk_ed, start_line=-1, end_line=0):
         """
         :type gtk_ed: Gtk.TextBuffer
         :type start_line: int
+        :param int end_line: when rehighlighting from start_line, do not go
+          past this line.
         """
-        # t = time()
-        start_it = gtk_ed.get_start_iter()
-        end_it = gtk_ed.get_start_iter()
+        t = time()
 
         if start_line == -1:
-            for tag, start, end in self.highlight_info_gen(gtk_ed, 0):
-                if tag:
-                    start_it.set_offset(start)
-                    end_it.set_offset(end)
-                    gtk_ed.apply_tag(tag, start_it, end_it)
+            self.__apply_tags(gtk_ed, self.highlight_info_gen(
+                gtk_ed, 0, record=gtk_ed.token_record))
+            self.__store_tokens(gtk_ed)
+            self.stats.record_full(gtk_ed.get_line_count(), time() - t)
         else:
-            st_iter = gtk_ed.get_iter_at_line(start_line)
-            actions_list = self.highlight_info_gen(gtk_ed, start_line,
-                                                   start_line + 1000)
+            max_line = start_line + 1000
+            actions_list = self.highlight_info_gen(
+                gtk_ed, start_line,
+                min(end_line, max_line) if end_line else max_line)
 
             # if not self.sync_stop:
             #     actions_list = self.highlight_info_gen(gtk_ed, start_line)
 
+            self.__update_tags(gtk_ed, actions_list, start_line)
+            self.stats.record_incremental(start_line, time() - t)
+
+    def __apply_tags(self, gtk_ed, actions_list, clear_from=None):
+        """
+        Apply the tags computed by highlight_info_gen.
+
+        :type gtk_ed: Gtk.TextBuffer
+        :param int|None clear_from: if not None, all the tags between the
+          start of this line and the end of the highlighted region are
+          removed first.
+        """
+        start_it = gtk_ed.get_start_iter()
+        end_it = gtk_ed.get_start_iter()
+
+        if clear_from is not None:
+            st_iter = gtk_ed.get_iter_at_line(clear_from)
             end_it.set_offset(actions_list[-1][2])
             gtk_ed.remove_all_tags(st_iter, end_it)
 
-            for tag, start, end in actions_list:
+        for tag, start, end in actions_list:
+            if tag:
                 start_it.set_offset(start)
                 end_it.set_offset(end)
-                if tag:
-                    gtk_ed.apply_tag(tag, start_it, end_it)
+                gtk_ed.apply_tag(tag, start_it, end_it)
+
+    def __update_tags(self, gtk_ed, actions_list, start_line):
+        """
+        Apply the tags computed by highlight_info_gen when rehighlighting
+        from start_line, only touching the spans that changed.
+
+        gtk_ed.line_spans records, for each line, the spans applied the last
+        time the line was rehighlighted, relative to the start of the line,
+        or None if they are unknown (the line was edited, was only
+        highlighted as part of the whole buffer, or was not rehighlighted up
+        to its end). All the tags of unknown lines are removed and
+        reapplied.
 
-        # print time() - t
+        :type gtk_ed: Gtk.TextBuffer
+        :type start_line: int
+        """
+        start_it = gtk_ed.get_iter_at_line(start_line)
+        end_it = gtk_ed.get_iter_at_offset(actions_list[-1][2])
+        base = start_it.get_offset()
+        text = gtk_ed.get_text(start_it, end_it, True).decode('utf-8')
+
+        # The lines covered by the rehighlighted region, and their offsets
+        # relative to base.
+        nb_lines = end_it.get_line() - start_line + 1
+        if end_it.starts_line() and nb_lines > 1:
+            nb_lines -= 1
+
+        line_starts = [0]
+        pos = text.find("\n")
+        while pos != -1:
+            line_starts.append(pos + 1)
+            pos = text.find("\n", pos + 1)
+        line_starts.append(len(text))
+
+        # The region ends at the start of a line, or after the newline of
+        # the line where the stack was synced, unless tokenization stopped
+        # inside its last line. The spans of that line are then still
+        # unknown afterwards, and its end is left untouched.
+        partial = nb_lines == len(line_starts) - 1 and not end_it.is_end()
+
+        new_spans = [[] for _ in range(nb_lines)]
+        for tag, start, end in actions_list:
+            if tag and start < end:
+                start -= base
+                end -= base
+                i = bisect_right(line_starts, start) - 1
+                while i < nb_lines:
+                    ls, le = line_starts[i], line_starts[i + 1]
+                    new_spans[i].append(
+                        (tag, max(start, ls) - ls, min(end, le) - ls))
+                    if end <= le:
+                        break
+                    i += 1
+
+        line_spans = gtk_ed.line_spans
+        if len(line_spans) < start_line + nb_lines:
+            line_spans.extend(
+                [None] * (start_line + nb_lines - len(line_spans)))
+        if partial:
+            line_spans[start_line + nb_lines - 1] = None
+        nb_known = nb_lines - 1 if partial else nb_lines
+
+        # When no line is known, as after the whole buffer was highlighted,
+        # applying the tags line by line would only make more calls to Gtk.
+        if line_spans[start_line:start_line + nb_lines].count(None) == \
+                nb_lines:
+            self.__apply_tags(gtk_ed, actions_list, clear_from=start_line)
+            for i in range(nb_known):
+                line_spans[start_line + i] = merge_spans(new_spans[i])
+            return
 
-    def gtk_highlight(self, gtk_ed):
-        self.highlight_gen(gtk_ed, -1)
+        start_it = gtk_ed.get_start_iter()
+        to_add = []
+        unknown_from = None
+
+        for i in range(nb_lines + 1):
+            spans = merge_spans(new_spans[i]) if i < nb_lines else None
+            old_spans = line_spans[start_line + i] if i < nb_lines else ()
+
+            if old_spans is None:
+                if unknown_from is None:
+                    unknown_from = i
+                to_add.extend((tag, base + line_starts[i] + s,
+                               base + line_starts[i] + e)
+                              for tag, s, e in spans)
+
+            else:
+                if unknown_from is not None:
+                    start_it.set_offset(base + line_starts[unknown_from])
+                    end_it.set_offset(base + line_starts[i])
+                    gtk_ed.remove_all_tags(start_it, end_it)
+                    unknown_from = None
+
+                if i < nb_lines and spans != old_spans:
+                    spans_set, old_set = set(spans), set(old_spans)
+                    ls = base + line_starts[i]
+                    le = (base + line_starts[i + 1]
+                          if partial and i == nb_lines - 1 else None)
+
+                    for tag, s, e in old_set - spans_set:
+                        if le is not None:
+                            if ls + s >= le:
+                                continue
+                            e = min(e, le - ls)
+                        start_it.set_offset(ls + s)
+                        end_it.set_offset(ls + e)
+                        gtk_ed.remove_tag(tag, start_it, end_it)
+
+                    to_add.extend((tag, ls + s, ls + e)
+                                  for tag, s, e in spans_set - old_set)
+
+            if i < nb_known:
+                line_spans[start_line + i] = spans
+
+        self.__apply_tags(gtk_ed, to_add)
+
+    def gtk_highlight(self, gtk_ed, visible=None):
+        """
+        Highlight the whole buffer. Buffers that have more than
+        incremental_threshold lines are highlighted in the background, see
+        highlight_incrementally.
+
+        The tokens of large buffers are stored in HighlighterModule.cache,
+        and reused when the same text is highlighted again.
+
+        :type gtk_ed: Gtk.TextBuffer
+        :param (int, int)|None visible: the range of visible lines
+        """
+        if gtk_ed.large_file:
+            gtk_ed.large_blocks = set()
+            self.highlight_visible(gtk_ed, visible)
+            return
+
+        t = time()
+        cached = self.__cached_tokens(gtk_ed)
+
+        if gtk_ed.get_line_count() > self.incremental_threshold:
+            self.highlight_incrementally(gtk_ed, visible, cached)
+        elif cached:
+            gtk_ed.stacks.set(0, [self.root_highlighter])
+            self.__apply_tags(gtk_ed, self.__take_tokens(gtk_ed, cached, 0, 0))
+            self.stats.record_full(gtk_ed.get_line_count(), time() - t)
+        else:
+            self.highlight_gen(gtk_ed, -1)
+
+    def __cached_tokens(self, gtk_ed):
+        """
+        Look up the tokens of gtk_ed in the cache. On a cache miss, start
+        recording the tokens of gtk_ed in gtk_ed.token_record, so that they
+        are stored once the whole buffer is highlighted.
+
+        :type gtk_ed: Gtk.TextBuffer
+        :return: a job that holds the cached tokens, or None
+        :rtype: TokenizerJob|None
+        """
+        gtk_ed.token_record = None
+        cache = HighlighterModule.cache
+
+        size = gtk_ed.get_char_count()
+        if cache is None or self.cache_min_size is None or \
+                size < self.cache_min_size or size > self.cache_max_size:
+            return None
 
-    def gtk_highlight_region(self, gtk_ed, start_line):
-        self.highlight_gen(gtk_ed, start_line)
+        key = hashlib.sha1(self.fingerprint())
+        key.update(gtk_ed.get_text(gtk_ed.get_start_iter(),
+                                   gtk_ed.get_end_iter(), True))
+        gtk_ed.token_key = key.hexdigest()
+
+        value = cache.get(gtk_ed.token_key)
+        if value is None:
+            gtk_ed.token_record = array("i")
+            return None
+
+        job = TokenizerJob(0, 0)
+        job.spans, job.runs = value
+        return job
+
+    def __store_tokens(self, gtk_ed):
+        """
+        Store the tokens recorded while highlighting the whole buffer in the
+        cache, unless the buffer was modified in the meantime.
+
+        :type gtk_ed: Gtk.TextBuffer
+        """
+        if gtk_ed.token_record is None or HighlighterModule.cache is None:
+            return
+
+        _, index = self.keys()
+        runs = []
+        line = 0
+        for stack, length in gtk_ed.stacks.runs():
+            runs.append((line, [index[hl] for hl in stack]))
+            line += length
+
+        HighlighterModule.cache.put(gtk_ed.token_key,
+                                    (gtk_ed.token_record, runs))
+        gtk_ed.token_record = None
+
+    def gtk_highlight_region(self, gtk_ed, start_line, end_line=0):
+        self.highlight_gen(gtk_ed, start_line, end_line)
+
+    def highlight_visible(self, gtk_ed, visible):
+        """
+        Highlight the visible lines of a large file (see
+        gps_utils.highlighter.is_large_buffer), which is never highlighted
+        as a whole.
+
+        The buffer is split in blocks of chunk_lines lines, which are each
+        highlighted independently from the root highlighter, since the
+        stacks of the lines before them are unknown. gtk_ed.large_blocks is
+        the set of blocks already highlighted.
+
+        :type gtk_ed: Gtk.TextBuffer
+        :param (int, int)|None visible: the range of visible lines
+        """
+        if not visible:
+            return
+
+        first, last = visible
+        nb_lines = gtk_ed.get_line_count()
+        max_length = max_line_length()
+
+        for block in range(first // self.chunk_lines,
+                           last // self.chunk_lines + 1):
+            start_line = block * self.chunk_lines
+            if block in gtk_ed.large_blocks or start_line >= nb_lines:
+                continue
+
+            gtk_ed.large_blocks.add(block)
+            end_line = min(start_line + self.chunk_lines, nb_lines)
+            gtk_ed.remove_all_tags(gtk_ed.get_iter_at_line(start_line),
+                                   gtk_ed.get_iter_at_line(end_line)
+                                   if end_line < nb_lines
+                                   else gtk_ed.get_end_iter())
+
+            # Lines that are too long, typically in minified files, are not
+            # highlighted at all.
+            run_start = start_line
+            for line in range(start_line, end_line + 1):
+                if line == end_line or gtk_ed.get_iter_at_line(
+                        line).get_chars_in_line() > max_length:
+                    if run_start < line:
+                        self.__apply_tags(gtk_ed, self.highlight_info_gen(
+                            gtk_ed, run_start, line,
+                            stacks=DetachedStacks([self.root_highlighter])))
+                    run_start = line + 1
+
+    def highlight_incrementally(self, gtk_ed, visible=None, job=None):
+        """
+        Highlight the visible lines of the buffer immediately, and the rest
+        of the buffer in idle chunks.
+
+        The lines before gtk_ed.highlight_frontier are highlighted, and their
+        stacks, as well as the stack of the frontier line, are up to date.
+        The frontier is None once the whole buffer has been processed.
+
+        If the visible lines are too far from the top of the buffer, they
+        are highlighted speculatively, starting from an empty stack, and
+        rehighlighted when the background pass reaches them.
+
+        :type gtk_ed: Gtk.TextBuffer
+        :param (int, int)|None visible: the range of visible lines
+        :param TokenizerJob|None job: tokens that are already known for the
+          whole buffer.
+        """
+        if gtk_ed.idle_highlight_id:
+            GLib.source_remove(gtk_ed.idle_highlight_id)
+            gtk_ed.idle_highlight_id = None
+
+        if gtk_ed.tokenizer_job:
+            tokenizer_pool.cancel(gtk_ed.tokenizer_job.id)
+
+        gtk_ed.tokenizer_job = job
+        gtk_ed.stacks.set(0, [self.root_highlighter])
+        gtk_ed.highlight_frontier = 0
+        gtk_ed.highlight_time = 0.0
+        gtk_ed.speculative_lines = None
+
+        if visible:
+            first, last = visible
+            if last < self.incremental_threshold:
+                self.__highlight_chunk(gtk_ed, last + 1)
+            else:
+                self.__apply_tags(gtk_ed, self.highlight_info_gen(
+                    gtk_ed, first, last + 1,
+                    stacks=DetachedStacks([self.root_highlighter])))
+                gtk_ed.speculative_lines = (first, last + 1)
+
+        if gtk_ed.highlight_frontier is not None:
+            gtk_ed.idle_highlight_id = GLib.idle_add(
+                self.__highlight_idle, gtk_ed)
+
+    def __highlight_chunk(self, gtk_ed, end_line):
+        """
+        Highlight the lines from the frontier to end_line, and move the
+        frontier accordingly.
+
+        :type gtk_ed: Gtk.TextBuffer
+        :type end_line: int
+        """
+        t = time()
+        start_line = gtk_ed.highlight_frontier
+
+        # Use the tokens computed by a worker process when they are still
+        # valid for this chunk.
+        job = gtk_ed.tokenizer_job
+        if job and job.spans is not None:
+            _, index = self.keys()
+            stack = [index[hl] for hl in gtk_ed.stacks.get(start_line)]
+
+            if job.valid_until is not None:
+                end_line = min(end_line, job.valid_until)
+
+            if end_line <= start_line or job.stack_at(start_line) != stack:
+                gtk_ed.tokenizer_job = job = None
+                end_line = start_line + self.chunk_lines
+        else:
+            job = None
+
+        if end_line >= gtk_ed.get_line_count():
+            end_line = 0
+
+        if job:
+            actions_list = self.__take_tokens(gtk_ed, job, start_line,
+                                              end_line)
+            if end_line == 0 or end_line == job.valid_until:
+                gtk_ed.tokenizer_job = None
+        else:
+            actions_list = self.highlight_info_gen(
+                gtk_ed, start_line, end_line, record=gtk_ed.token_record)
+
+        # Tags applied speculatively have to be removed first
+        spec = gtk_ed.speculative_lines
+        if spec and start_line < spec[1] and (
+                end_line == 0 or end_line > spec[0]):
+            self.__apply_tags(gtk_ed, actions_list, start_line)
+        else:
+            self.__apply_tags(gtk_ed, actions_list)
+
+        gtk_ed.highlight_frontier = end_line if end_line else None
+        if not end_line:
+            self.__store_tokens(gtk_ed)
+
+        gtk_ed.highlight_time += time() - t
+        if not end_line:
+            self.stats.record_full(gtk_ed.get_line_count(),
+                                   gtk_ed.highlight_time)
+
+    def __highlight_idle(self, gtk_ed):
+        """
+        Idle callback for the background highlighting of gtk_ed
+        """
+        deadline = time() + self.chunk_time_budget
+
+        while gtk_ed.highlight_frontier is not None:
+            if time() > deadline:
+                return True
+
+            if not gtk_ed.tokenizer_job:
+                self.__submit_job(gtk_ed)
+
+            if gtk_ed.tokenizer_job and gtk_ed.tokenizer_job.spans is None:
+                # Wait for the worker, __on_tokenized will resume
+                gtk_ed.idle_highlight_id = None
+                return False
+
+            self.__highlight_chunk(
+                gtk_ed, gtk_ed.highlight_frontier + self.chunk_lines)
+
+        gtk_ed.idle_highlight_id = None
+        gtk_ed.speculative_lines = None
+        return False
+
+    def __resume(self, gtk_ed):
+        """
+        Restart the background highlighting of gtk_ed, unless it is already
+        running or finished.
+        """
+        if gtk_ed.highlight_frontier is not None and \
+                not gtk_ed.idle_highlight_id:
+            gtk_ed.idle_highlight_id = GLib.idle_add(
+                self.__highlight_idle, gtk_ed)
+
+    def __submit_job(self, gtk_ed):
+        """
+        Tokenize the rest of the buffer, from the frontier, in a worker
+        process, if it is large enough.
+
+        :type gtk_ed: Gtk.TextBuffer
+        """
+        if self.worker_threshold is None or not gtk_ed.use_workers \
+                or not tokenizer_pool.enabled:
+            return
+
+        frontier = gtk_ed.highlight_frontier
+        start = gtk_ed.get_iter_at_line(frontier)
+        end = gtk_ed.get_end_iter()
+        language = self.language()
+
+        if language is None or \
+                end.get_offset() - start.get_offset() < self.worker_threshold:
+            return
+
+        if frontier == 0:
+            gtk_ed.stacks.set(0, [self.root_highlighter])
+
+        _, index = self.keys()
+        job = TokenizerJob(frontier, start.get_offset())
+        job.id = tokenizer_pool.submit(
+            language,
+            gtk_ed.get_text(start, end, True).decode('utf-8'),
+            frontier,
+            [index[hl] for hl in gtk_ed.stacks.get(frontier)],
+            lambda result: self.__on_tokenized(gtk_ed, job, result))
+
+        if job.id is not None:
+            gtk_ed.tokenizer_job = job
+
+    def __on_tokenized(self, gtk_ed, job, result):
+        """
+        Called when a worker process has tokenized the text of job
+        """
+        if gtk_ed.tokenizer_job is not job:
+            return
+
+        if result is None:
+            # Tokenize the rest of this buffer in GPS
+            gtk_ed.tokenizer_job = None
+            gtk_ed.use_workers = False
+        else:
+            job.spans, job.runs = result
+
+        self.__resume(gtk_ed)
+
+    def __take_tokens(self, gtk_ed, job, start_line, end_line):
+        """
+        Return the tags computed by a worker process for the lines from
+        start_line to end_line, in the same format as highlight_info_gen,
+        and set the stacks of these lines.
+
+        :type gtk_ed: Gtk.TextBuffer
+        :type job: TokenizerJob
+        """
+        keys, _ = self.keys()
+        tags = TagResolver(gtk_ed)
+        base = job.base_offset
+        record = gtk_ed.token_record
+
+        if end_line == 0:
+            last_line = gtk_ed.get_line_count() - 1
+            chunk_end = gtk_ed.get_end_iter().get_offset()
+        else:
+            last_line = end_line
+            chunk_end = gtk_ed.get_iter_at_line(end_line).get_offset()
+
+        chunk_start = gtk_ed.get_iter_at_line(start_line).get_offset() - base
+        limit = chunk_end - base
+        valid_end = None
+        if job.valid_until is not None:
+            valid_end = (gtk_ed.get_iter_at_line(job.valid_until).get_offset()
+                         - base)
+
+        actions_list = []
+        carry = []
+
+        def add(key, start, end):
+            if valid_end is not None:
+                end = min(end, valid_end)
+
+            # Spans do not go past the chunk, like in highlight_info_gen
+            if end > limit:
+                carry.append((key, end))
+                end = limit
+
+            if start < end:
+                actions_list.append((tags[keys[key]], base + start,
+                                     base + end))
+                if record is not None:
+                    record.extend((key, base + start, base + end))
+
+        for key, end in job.carry:
+            add(key, chunk_start, end)
+
+        spans = job.spans
+        i = job.cursor
+        while i < len(spans) and spans[i + 1] < limit:
+            if spans[i] >= 0:
+                add(spans[i], spans[i + 1], spans[i + 2])
+            i += 3
+
+        job.cursor = i
+        job.carry = carry
+
+        for line in range(start_line + 1, last_line + 1):
+            gtk_ed.stacks.set(line, [keys[k] for k in job.stack_at(line)])
+
+        actions_list.append((None, chunk_end, chunk_end))
+        return actions_list
 
     def init_highlighting(self, ed):
         gtk_ed = get_gtk_buffer(ed)
         gtk_ed.highlighting_initialized = True
-        gtk_ed.stacks = HighlighterStacks()
+        gtk_ed.stacks = (
+            HighlighterStacks()
+            if gtk_ed.get_line_count() > self.stacks_threshold
+            else ListHighlighterStacks())
+        gtk_ed.highlight_frontier = None
+        gtk_ed.speculative_lines = None
+        gtk_ed.line_spans = [None] * gtk_ed.get_line_count()
+        gtk_ed.tokenizer_job = None
+        gtk_ed.use_workers = True
+        gtk_ed.token_record = None
+        gtk_ed.highlight_time = 0.0
+        gtk_ed.large_file = is_large_buffer(ed)
+        gtk_ed.large_blocks = set()
 
         if not hasattr(gtk_ed, "idle_highlight_id"):
             gtk_ed.idle_highlight_id = None
 
+        def highlight_visible_idle():
+            gtk_ed.idle_highlight_id = None
+            self.highlight_visible(gtk_ed, get_visible_lines(ed))
+            return False
+
+        def schedule_highlight_visible(*args):
+            if not gtk_ed.idle_highlight_id:
+                gtk_ed.idle_highlight_id = GLib.idle_add(
+                    highlight_visible_idle)
+
+        if gtk_ed.large_file:
+            # Only the visible lines of large files are highlighted, so
+            # highlight the lines that become visible when scrolling.
+            try:
+                view = get_widgets_by_type(Gtk.TextView,
+                                           ed.current_view().pywidget())[0]
+                view.get_vadjustment().connect(
+                    "value-changed", schedule_highlight_visible)
+            except Exception:
+                pass
+
         def action_handler(loc):
             """:type loc: Gtk.TextIter"""
-            if gtk_ed.idle_highlight_id:
-                GLib.source_remove(gtk_ed.idle_highlight_id)
+            line = loc.get_line()
+            frontier = gtk_ed.highlight_frontier
+
+            if gtk_ed.large_file:
+                # Blocks are no longer aligned on chunk_lines after an
+                # edit, rehighlight the visible ones.
+                gtk_ed.large_blocks.clear()
+                schedule_highlight_visible()
+
+            elif frontier is None:
+                self.gtk_highlight_region(gtk_ed, line)
+
+            # Background highlighting is in progress: only rehighlight the
+            # lines it has already processed, it will take care of the rest
+            else:
+                if line < frontier:
+                    self.gtk_highlight_region(gtk_ed, line, frontier)
+                self.__resume(gtk_ed)
+
+        def shift_lines(buf, line, nb_lines, nb_chars):
+            """
+            Keep track of the lines known to the background highlighting,
+            and of the spans applied on each line, when nb_lines and
+            nb_chars are added (or removed, if negative) after line.
+            """
+            # The tokens of an edited buffer are not worth caching
+            buf.token_record = None
+
+            job = buf.tokenizer_job
+            frontier = buf.highlight_frontier
+
+            if job and frontier is not None:
+                # Tokens after an edit are no longer valid
+                if line >= frontier:
+                    job.valid_until = (line if job.valid_until is None
+                                       else min(line, job.valid_until))
+
+                # Tokens are moved by edits before them
+                elif nb_lines >= 0 or line - nb_lines < frontier:
+                    job.base_offset += nb_chars
+                    job.line_delta += nb_lines
+                    if job.valid_until is not None:
+                        job.valid_until += nb_lines
 
-            # Highlight all the rest of the buffer
-            # TODO: Highlight N lines synchronously, and if there are any
-            # TODO: remaining, the rest in async
-            self.gtk_highlight_region(gtk_ed, loc.get_line())
+                else:
+                    tokenizer_pool.cancel(job.id)
+                    buf.tokenizer_job = None
+
+            if nb_lines >= 0:
+                buf.line_spans[line:line + 1] = [None] * (nb_lines + 1)
+            else:
+                buf.line_spans[line:line - nb_lines + 1] = [None]
+
+            spec = buf.speculative_lines
+            if spec and line < spec[0]:
+                buf.speculative_lines = (max(line, spec[0] + nb_lines),
+                                         max(line, spec[1] + nb_lines))
+
+            frontier = buf.highlight_frontier
+            if frontier is not None and line < frontier:
+                buf.highlight_frontier = max(line, frontier + nb_lines)
 
         # noinspection PyUnusedLocal
         def highlighting_insert_text_before(buf, loc, text, length):
@@ -600,17 +1446,29 @@ class Highlighter(object):
         def highlighting_insert_text(buf, loc, text, length):
             nb_new_lines = len(text.split("\n")) - 1
             itr = buf.iter_from_tuple(buf.insert_loc)
-            buf.stacks.insert_newlines(nb_new_lines, itr.get_line())
+            line = itr.get_line()
+
+            # Stacks are only known up to the frontier
+            if buf.highlight_frontier is None or line < buf.highlight_frontier:
+                buf.stacks.insert_newlines(nb_new_lines, line)
+
+            shift_lines(buf, line, nb_new_lines, len(text.decode('utf-8')))
             action_handler(itr)
 
         def highlighting_delete_range_before(buf, loc, end):
             buf.nb_deleted_lines = len(
                 buf.get_text(loc, end, True).split("\n")
             ) - 1
+            buf.nb_deleted_chars = end.get_offset() - loc.get_offset()
 
         # noinspection PyUnusedLocal
         def highlighting_delete_range(buf, loc, end):
-            buf.stacks.delete_lines(buf.nb_deleted_lines, loc.get_line())
+            line = loc.get_line()
+            if buf.highlight_frontier is None or line < buf.highlight_frontier:
+                buf.stacks.delete_lines(buf.nb_deleted_lines, line)
+
+            shift_lines(buf, line, -buf.nb_deleted_lines,
+                        -buf.nb_deleted_chars)
             action_handler(loc)
 
         gtk_ed.connect_after("insert-text", highlighting_insert_text)
@@ -367,4 +367,6 @@ def register_highlighter(language, spec, igncase=False):
     :param tuple spec: The spec of the highlighter.
     """
     from highlighter.engine import Highlighter, HighlighterModule
-    HighlighterModule.highlighters[language] = Highlighter(spec, igncase)
+    highlighter = Highlighter(spec, igncase)
+    highlighter.stats.language = language
+    HighlighterModule.highlighters[language] = highlighter
@@ -0,0 +1,442 @@
+"""
+Storage for the per-line stacks of highlighters.
+
+The highlighting engine records, for every line of a buffer, the stack of
+sub-highlighters that is active at the start of that line, so that it can
+restart highlighting from any line after an edit.
+
+:class:`ListHighlighterStacks` stores one stack per line in a list. Reading
+the stack of a line, which highlighting does for every line, is as fast as
+it can be, but the memory used grows with the number of lines.
+
+Most consecutive lines share the same stack, and a buffer only ever uses a
+handful of distinct stacks, so :class:`HighlighterStacks` interns the stacks
+and stores them as runs of lines, in a treap ordered by line number. All
+operations are in logarithmic time in the number of runs, which is itself
+much smaller than the number of lines, but each access walks the tree. It
+is only worth it for buffers with many lines (see
+highlighter.engine.Highlighter.stacks_threshold).
+
+This module does not depend on GPS, see stacks_benchmark.py.
+"""
+
+import random
+
+
+class _Run(object):
+    """
+    A node of the treap: a run of consecutive lines that share the same
+    stack.
+    """
+
+    __slots__ = ("stack", "length", "size", "prio", "left", "right")
+
+    def __init__(self, stack, length, prio=None):
+        self.stack = stack
+        self.length = length   # number of lines in this run
+        self.size = length     # number of lines in this subtree
+        self.prio = random.random() if prio is None else prio
+        self.left = None
+        self.right = None
+
+    def update(self):
+        self.size = (self.length +
+                     (self.left.size if self.left else 0) +
+                     (self.right.size if self.right else 0))
+
+
+def _size(node):
+    return node.size if node else 0
+
+
+def _split(node, k):
+    """
+    Split the tree into a tree holding the first k lines, and a tree
+    holding the remaining ones. A run is split in two if needed.
+
+    :type node: _Run|None
+    :type k: int
+    :rtype: (_Run|None, _Run|None)
+    """
+    if node is None:
+        return None, None
+
+    left_size = _size(node.left)
+
+    if k <= left_size:
+        left, node.left = _split(node.left, k)
+        node.update()
+        return left, node
+
+    elif k >= left_size + node.length:
+        node.right, right = _split(node.right, k - left_size - node.length)
+        node.update()
+        return node, right
+
+    else:
+        # Split the run itself. Reusing the priority of node keeps the heap
+        # property, since the children of node have a lower priority.
+        offset = k - left_size
+        right = _Run(node.stack, node.length - offset, node.prio)
+        right.right = node.right
+        right.update()
+        node.right = None
+        node.length = offset
+        node.update()
+        return node, right
+
+
+def _merge(left, right):
+    """
+    Concatenate two trees.
+
+    :type left: _Run|None
+    :type right: _Run|None
+    :rtype: _Run|None
+    """
+    if left is None:
+        return right
+    if right is None:
+        return left
+
+    if left.prio >= right.prio:
+        left.right = _merge(left.right, right)
+        left.update()
+        return left
+    else:
+        right.left = _merge(left, right.left)
+        right.update()
+        return right
+
+
+def _first(node):
+    while node.left:
+        node = node.left
+    return node
+
+
+def _last(node):
+    while node.right:
+        node = node.right
+    return node
+
+
+def _grow_last(node, nb_lines):
+    """
+    Add nb_lines to the last run of the tree.
+    """
+    while node:
+        node.size += nb_lines
+        if not node.right:
+            node.length += nb_lines
+        node = node.right
+
+
+def _join(left, right):
+    """
+    Concatenate two trees, coalescing the last run of left and the first
+    run of right if they have the same stack.
+    """
+    if left and right:
+        first = _first(right)
+        if _last(left).stack is first.stack:
+            nb_lines = first.length
+            _, right = _split(right, nb_lines)
+            _grow_last(left, nb_lines)
+    return _merge(left, right)
+
+
+class ListHighlighterStacks(object):
+    """
+    The stacks of highlighters for each line of a buffer, one per line.
+    """
+
+    def __init__(self):
+        # The stack of highlighter at (0, 0) is necessarily the empty stack,
+        # so the stack list comes prepopulated with one empty stack
+        self.stacks_list = [()]
+
+    def __len__(self):
+        return len(self.stacks_list)
+
+    def set(self, index, stack):
+        """
+        Set the stack of highlighters for line index. Returns true if the
+        previous stack is the same as the stack argument.
+
+        :type index: int
+        :type stack: tuple[Struct]
+        @rtype:      bool
+        """
+        assert 0 <= index <= len(self.stacks_list)
+
+        tpstack = tuple(stack)
+        if index == len(self.stacks_list):
+            self.stacks_list.append(tpstack)
+            return False
+        else:
+            current_stack = self.stacks_list[index]
+            self.stacks_list[index] = tpstack
+            return tpstack == current_stack
+
+    def get(self, start_line):
+        """
+        :type start_line: int
+        @rtype:           tuple[Struct]|None
+        """
+        if 0 <= start_line < len(self.stacks_list):
+            return self.stacks_list[start_line]
+        else:
+            return None
+
+    def insert_newlines(self, nb_lines, after_line):
+        """
+        :type after_line: int
+        :type nb_lines:   int
+        """
+        if nb_lines > 0:
+            self.stacks_list[after_line + 1:after_line + 1] = \
+                [()] * nb_lines
+
+    def delete_lines(self, nb_deleted_lines, at_line):
+        """
+        :param nb_deleted_lines: int
+        :param at_line: int
+        """
+        del self.stacks_list[at_line + 1:at_line + nb_deleted_lines + 1]
+
+    def runs(self):
+        """
+        Return the list of runs of lines that have the same stack, as
+        (stack, number of lines) tuples.
+
+        :rtype: list[(tuple[Struct], int)]
+        """
+        result = []
+        for stack in self.stacks_list:
+            if result and result[-1][0] == stack:
+                result[-1] = (stack, result[-1][1] + 1)
+            else:
+                result.append((stack, 1))
+        return result
+
+    def __str__(self):
+        return "{0}".format(
+            "\n".join(["{0}\t{1}".format(num, [c for c in stack])
+                       for num, stack in enumerate(self.stacks_list)])
+        )
+
+
+class HighlighterStacks(object):
+    """
+    The stacks of highlighters for each line of a buffer.
+
+    The last run of lines is kept out of the tree, so that appending lines,
+    which is what highlighting a whole buffer does, is in constant time.
+    """
+
+    def __init__(self):
+        self.interned = {}
+        self.root = None
+
+        # The stack of highlighter at (0, 0) is necessarily the empty stack,
+        # so the stacks come prepopulated with one empty stack
+        self.tail_stack = self.intern(())
+        self.tail_length = 1
+
+    def intern(self, stack):
+        """
+        Return the unique instance of the tuple equal to stack.
+
+        :type stack: tuple[Struct]
+        :rtype: tuple[Struct]
+        """
+        return self.interned.setdefault(stack, stack)
+
+    def __len__(self):
+        return _size(self.root) + self.tail_length
+
+    def __flush_tail(self):
+        """
+        Move the last run of lines into the tree
+        """
+        if self.tail_length:
+            self.root = _join(
+                self.root, _Run(self.tail_stack, self.tail_length))
+            self.tail_length = 0
+
+    def set(self, index, stack):
+        """
+        Set the stack of highlighters for line index. Returns true if the
+        previous stack is the same as the stack argument.
+
+        :type index: int
+        :type stack: tuple[Struct]
+        @rtype:      bool
+        """
+        length = len(self)
+        assert 0 <= index <= length
+
+        tpstack = self.intern(tuple(stack))
+        tree_size = _size(self.root)
+
+        if index == length:
+            if tpstack is not self.tail_stack:
+                self.__flush_tail()
+                self.tail_stack = tpstack
+            self.tail_length += 1
+            return False
+
+        elif index >= tree_size:
+            if tpstack is self.tail_stack:
+                return True
+            self.__flush_tail()
+
+        else:
+            path, offset = self.__locate(index)
+            node = path[-1]
+            if tpstack is node.stack:
+                return True
+
+            # Rehighlighting typically sets consecutive lines to the stack
+            # of the previous line: move the boundary between the two runs
+            # rather than splitting the run.
+            if offset == 0 and node.length > 1 and \
+                    self.__extend_previous(path, tpstack):
+                return False
+
+        left, right = _split(self.root, index)
+        _, right = _split(right, 1)
+        self.root = _join(_join(left, _Run(tpstack, 1)), right)
+        return False
+
+    def __locate(self, index):
+        """
+        Return the path from the root to the run of the tree that contains
+        line index, and the offset of that line in the run.
+
+        :type index: int
+        :rtype: (list[_Run], int)
+        """
+        path = []
+        node = self.root
+        while True:
+            path.append(node)
+            left_size = _size(node.left)
+            if index < left_size:
+                node = node.left
+            elif index < left_size + node.length:
+                return path, index - left_size
+            else:
+                index -= left_size + node.length
+                node = node.right
+
+    def __extend_previous(self, path, stack):
+        """
+        If the run preceding the last run of path has the given stack, move
+        the first line of the last run of path to it. Return whether the
+        line was moved.
+
+        :type path: list[_Run]
+        :type stack: tuple[Struct]
+        :rtype: bool
+        """
+        node = path[-1]
+
+        if node.left:
+            # The previous run is the last one of the left subtree, whose
+            # size grows by one, while the size of node doesn't change.
+            previous = _last(node.left)
+            if previous.stack is not stack:
+                return False
+            _grow_last(node.left, 1)
+
+        else:
+            # The previous run is the closest ancestor whose right subtree
+            # contains node. The size of the nodes below it decreases by one.
+            for j in range(len(path) - 2, -1, -1):
+                if path[j].right is path[j + 1]:
+                    break
+            else:
+                return False
+
+            previous = path[j]
+            if previous.stack is not stack:
+                return False
+            previous.length += 1
+            for n in path[j + 1:]:
+                n.size -= 1
+
+        node.length -= 1
+        return True
+
+    def get(self, start_line):
+        """
+        :type start_line: int
+        @rtype:           tuple[Struct]|None
+        """
+        if start_line < 0 or start_line >= len(self):
+            return None
+
+        if start_line >= _size(self.root):
+            return self.tail_stack
+
+        return self.__locate(start_line)[0][-1].stack
+
+    def insert_newlines(self, nb_lines, after_line):
+        """
+        :type after_line: int
+        :type nb_lines:   int
+        """
+        if nb_lines <= 0:
+            return
+
+        self.__flush_tail()
+        left, right = _split(self.root, min(after_line + 1, len(self)))
+        self.root = _join(_join(left, _Run(self.intern(()), nb_lines)), right)
+
+    def delete_lines(self, nb_deleted_lines, at_line):
+        """
+        :param nb_deleted_lines: int
+        :param at_line: int
+        """
+        start = at_line + 1
+        end = min(start + nb_deleted_lines, len(self))
+        if start >= end:
+            return
+
+        self.__flush_tail()
+        left, right = _split(self.root, start)
+        _, right = _split(right, end - start)
+        self.root = _join(left, right)
+
+    def runs(self):
+        """
+        Return the list of runs, as (stack, number of lines) tuples.
+
+        :rtype: list[(tuple[Struct], int)]
+        """
+        result = []
+        todo = []
+        node = self.root
+        while todo or node:
+            if node:
+                todo.append(node)
+                node = node.left
+            else:
+                node = todo.pop()
+                result.append((node.stack, node.length))
+                node = node.right
+
+        if self.tail_length:
+            result.append((self.tail_stack, self.tail_length))
+        return result
+
+    def __str__(self):
+        lines = []
+        num = 0
+        for stack, length in self.runs():
+            lines.append("{0}-{1}\t{2}".format(
+                num, num + length - 1, [c for c in stack]))
+            num += length
+        return "\n".join(lines)
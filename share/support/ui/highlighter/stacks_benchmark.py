@@ -0,0 +1,127 @@
+"""
+Micro-benchmark comparing highlighter.stacks.HighlighterStacks with the
+list-based ListHighlighterStacks. It doesn't need GPS to run::
+
+    cd share/support/ui
+    python -m highlighter.stacks_benchmark [nb_lines]
+
+Each scenario reports the time taken by each implementation, and the
+approximate memory used to store the stacks of a buffer.
+"""
+
+from __future__ import print_function
+
+import random
+import sys
+from time import time
+
+from highlighter.stacks import HighlighterStacks, ListHighlighterStacks, \
+    _Run
+
+
+class Highlighter(object):
+    """Stand-in for a SubHighlighter, only used as an element of stacks"""
+    pass
+
+
+ROOT = Highlighter()
+COMMENT = Highlighter()
+STRING = Highlighter()
+
+
+def buffer_stacks(nb_lines):
+    """
+    Return a list of stacks, one per line, that resemble those of a real
+    source file: mostly the root stack, with a few multi-line regions.
+
+    :rtype: list[list[Highlighter]]
+    """
+    rand = random.Random(nb_lines)
+    result = []
+    while len(result) < nb_lines:
+        result.extend([[ROOT]] * rand.randint(5, 60))
+        result.extend([[ROOT, rand.choice((COMMENT, STRING))]] *
+                      rand.randint(1, 10))
+    return result[:nb_lines]
+
+
+def highlight_all(store, lines):
+    """Record the stacks for all lines, as a full highlight does"""
+    for num, stack in enumerate(lines):
+        store.set(num, stack)
+
+
+def paste(store, lines, at_line, nb_lines):
+    """Insert nb_lines after at_line, and record their stacks"""
+    store.insert_newlines(nb_lines, at_line)
+    for num in range(at_line + 1, at_line + nb_lines + 1):
+        store.set(num, lines[num % len(lines)])
+
+
+def delete(store, at_line, nb_lines):
+    store.delete_lines(nb_lines, at_line)
+
+
+def get_all(store):
+    for num in range(len(store)):
+        store.get(num)
+
+
+def memory_usage(store):
+    """
+    Approximate number of bytes used by store, counting shared objects once.
+
+    :rtype: int
+    """
+    if isinstance(store, ListHighlighterStacks):
+        tuples = {id(t): t for t in store.stacks_list}
+        return (sys.getsizeof(store.stacks_list) +
+                sum(sys.getsizeof(t) for t in tuples.values()))
+    else:
+        nb_runs = len(store.runs())
+        return (nb_runs * sys.getsizeof(_Run((), 1)) +
+                sys.getsizeof(store.interned) +
+                sum(sys.getsizeof(t) for t in store.interned))
+
+
+def timed(fn, *args):
+    start = time()
+    fn(*args)
+    return time() - start
+
+
+def run(nb_lines):
+    lines = buffer_stacks(nb_lines)
+    rand = random.Random(0)
+    edits = [rand.randint(0, nb_lines // 2) for _ in range(100)]
+    results = []
+
+    for cls in (ListHighlighterStacks, HighlighterStacks):
+        store = cls()
+        timings = [("highlight %d lines" % nb_lines,
+                    timed(highlight_all, store, lines))]
+        memory = memory_usage(store)
+        timings.append(("get every line", timed(get_all, store)))
+
+        timings.append(("paste 5000 lines x 10", timed(
+            lambda: [paste(store, lines, at, 5000) for at in edits[:10]])))
+        timings.append(("delete 5000 lines x 10", timed(
+            lambda: [delete(store, at, 5000) for at in edits[:10]])))
+        timings.append(("type newline x 100", timed(
+            lambda: [paste(store, lines, at, 1) for at in edits])))
+        timings.append(("rehighlight line x 100", timed(
+            lambda: [store.set(at, [ROOT, COMMENT]) for at in edits])))
+        results.append((cls.__name__, timings, memory))
+
+    old_name, old_timings, old_memory = results[0]
+    new_name, new_timings, new_memory = results[1]
+
+    print("%-28s %14s %14s" % ("", old_name, new_name))
+    for (label, old), (_, new) in zip(old_timings, new_timings):
+        print("%-28s %13.4fs %13.4fs" % (label, old, new))
+    print("%-28s %13dK %13dK" % (
+        "memory", old_memory // 1024, new_memory // 1024))
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,116 @@
+"""
+Instrumentation of the highlighting engine.
+
+Each :class:`highlighter.engine.Highlighter` keeps a :class:`HighlighterStats`
+that records how long it takes to tokenize and highlight buffers. These are
+displayed in the Messages view by the "highlighter statistics" action, and
+every measurement is logged when the HIGHLIGHTER.STATS trace is active. This
+helps find the languages whose spec is expensive to match.
+"""
+
+import GPS
+from gps_utils import interactive
+
+logger = GPS.Logger("HIGHLIGHTER.STATS")
+
+
+class HighlighterStats(object):
+    """
+    The measurements for one highlighter.
+    """
+
+    def __init__(self, language=None):
+        self.language = language
+
+        self.tokenize_count = 0
+        self.tokenize_time = 0.0
+        self.tokens = 0
+        self.sync_stops = 0
+        """
+        Number of times highlighting stopped early, because the stack of
+        highlighters was the same as before an edit.
+        """
+
+        self.full_count = 0
+        self.full_time = 0.0
+        self.incremental_count = 0
+        self.incremental_time = 0.0
+
+    def record_tokenize(self, nb_tokens, elapsed, sync_stop):
+        """
+        Record a run of the state machine, see Highlighter.tokenize.
+
+        :param int nb_tokens: the number of spans computed
+        :param float elapsed: the time taken, in seconds
+        :param bool sync_stop: whether the sync-stop shortcut was hit
+        """
+        self.tokenize_count += 1
+        self.tokenize_time += elapsed
+        self.tokens += nb_tokens
+        if sync_stop:
+            self.sync_stops += 1
+
+    def record_full(self, nb_lines, elapsed):
+        """
+        Record the highlighting of a whole buffer. For buffers highlighted
+        in the background, elapsed only counts the time spent in GPS.
+
+        :param int nb_lines: the number of lines of the buffer
+        :param float elapsed: the time taken, in seconds
+        """
+        self.full_count += 1
+        self.full_time += elapsed
+        if logger.active:
+            logger.log("%s: highlighted %d lines in %.3fs" % (
+                self.language, nb_lines, elapsed))
+
+    def record_incremental(self, start_line, elapsed):
+        """
+        Record the rehighlighting of a buffer after an edit.
+
+        :param int start_line: the line from which the buffer was
+          rehighlighted
+        :param float elapsed: the time taken, in seconds
+        """
+        self.incremental_count += 1
+        self.incremental_time += elapsed
+        if logger.active:
+            logger.log("%s: rehighlighted from line %d in %.4fs" % (
+                self.language, start_line + 1, elapsed))
+
+    @property
+    def tokens_per_second(self):
+        return self.tokens / self.tokenize_time if self.tokenize_time else 0.0
+
+    def summary(self):
+        """
+        Return a one line description of the measurements.
+
+        :rtype: str
+        """
+        return (
+            "%-16s %10.0f tokens/s  full: %4d x %8.4fs"
+            "  incremental: %6d x %8.4fs  sync-stops: %d/%d") % (
+            self.language,
+            self.tokens_per_second,
+            self.full_count,
+            self.full_time / self.full_count if self.full_count else 0.0,
+            self.incremental_count,
+            (self.incremental_time / self.incremental_count
+             if self.incremental_count else 0.0),
+            self.sync_stops, self.tokenize_count)
+
+
+@interactive("Editor", name="highlighter statistics",
+             description="Display, in the Messages view, the time spent by"
+                         " the highlighter of each language")
+def show_statistics():
+    from highlighter.engine import HighlighterModule
+
+    lines = ["Highlighter statistics (average times):"]
+    for language, hl in sorted(HighlighterModule.highlighters.items()):
+        if hl.stats.tokenize_count:
+            lines.append(hl.stats.summary())
+
+    GPS.Console("Messages").write("\n".join(lines) + "\n")
+    logger.log("\n".join(lines))
@@ -0,0 +1,112 @@
+"""
+Micro-benchmark comparing the two ways of applying the tags when a buffer
+is rehighlighted after an edit: removing all the tags of the region and
+applying them again, as was done before, or only touching the spans that
+changed on each line, as Highlighter.highlight_gen now does. It needs a
+real editor, so open a large source file and, from the GPS Python console::
+
+    import highlighter.update_benchmark
+    highlighter.update_benchmark.run()
+
+Results are written to the Messages view.
+"""
+
+import random
+from time import time
+
+import GPS
+from pygps import get_gtk_buffer
+from highlighter.engine import HighlighterModule
+
+
+class NeverSynced(object):
+    """
+    Wraps the stacks of a buffer so that rehighlighting never stops early,
+    as when an edit opens a comment or a string.
+    """
+
+    def __init__(self, stacks):
+        self.stacks = stacks
+
+    def get(self, start_line):
+        return self.stacks.get(start_line)
+
+    def set(self, index, stack):
+        self.stacks.set(index, stack)
+        return False
+
+
+def remove_apply(highlighter, gtk_ed, line, end_line):
+    """The previous implementation of highlight_gen"""
+    actions_list = highlighter.highlight_info_gen(
+        gtk_ed, line, end_line, stacks=gtk_ed.stacks)
+    highlighter._Highlighter__apply_tags(gtk_ed, actions_list,
+                                         clear_from=line)
+
+
+def diff(highlighter, gtk_ed, line, end_line):
+    highlighter.highlight_gen(gtk_ed, line, end_line)
+
+
+def forget_spans(gtk_ed):
+    gtk_ed.line_spans = [None] * gtk_ed.get_line_count()
+
+
+def run(nb_edits=100, nb_lines=1000):
+    """
+    Rehighlight the current editor from nb_edits random lines, and report
+    the average time taken by each implementation.
+
+    :param int nb_lines: the number of lines rehighlighted when the stack
+      of highlighters does not get in sync.
+    """
+    ed = GPS.EditorBuffer.get()
+    highlighter = HighlighterModule.highlighters.get(ed.file().language())
+    gtk_ed = get_gtk_buffer(ed)
+    count = gtk_ed.get_line_count()
+    if highlighter is None or count < 2 * nb_lines:
+        GPS.Console("Messages").write(
+            "update_benchmark needs a highlighted file of %d lines\n"
+            % (2 * nb_lines))
+        return
+
+    rand = random.Random(0)
+    lines = [rand.randint(1, count - nb_lines - 1) for _ in range(nb_edits)]
+    stacks = gtk_ed.stacks
+
+    def timed(fn, end_line, never_synced=False, cold=False):
+        elapsed = 0.0
+        try:
+            if never_synced:
+                gtk_ed.stacks = NeverSynced(stacks)
+            for line in lines:
+                if cold:
+                    forget_spans(gtk_ed)
+                start = time()
+                fn(highlighter, gtk_ed, line, end_line(line))
+                elapsed += time() - start
+        finally:
+            gtk_ed.stacks = stacks
+        return elapsed / len(lines)
+
+    scenarios = [
+        ("in sync after one line", {}),
+        ("%d lines, spans unknown" % nb_lines,
+         {"never_synced": True, "cold": True}),
+        ("%d lines, spans known" % nb_lines, {"never_synced": True}),
+    ]
+
+    result = ["%-32s %14s %14s" % ("", "remove/apply", "diff")]
+    for label, kwargs in scenarios:
+        old = timed(remove_apply, lambda line: line + nb_lines, **kwargs)
+        if not kwargs.get("cold"):
+            # Record the spans of the lines first, as the previous
+            # rehighlighting of these lines would have.
+            timed(diff, lambda line: line + nb_lines, **kwargs)
+        new = timed(diff, lambda line: line + nb_lines, **kwargs)
+        result.append("%-32s %13.2fms %13.2fms" % (
+            label, old * 1000, new * 1000))
+
+    forget_spans(gtk_ed)
+    result = "\n".join(result)
+    GPS.Console("Messages").write(result + "\n")
@@ -0,0 +1,236 @@
+"""
+A pool of worker processes that run the highlighting state machine
+(:func:`highlighter.engine.Highlighter.tokenize`) out of the GPS process,
+so that colorizing very large buffers doesn't block the user interface.
+
+Workers are forked on demand, so they already know about all the
+highlighters registered so far. They are sent a snapshot of the text to
+highlight, and return the tokens as compact arrays. Results are read from
+the GLib main loop, which doesn't need Python threads to run.
+
+This is only available on Linux, where processes are forked.
+"""
+
+import sys
+from itertools import count
+from time import time
+
+try:
+    import multiprocessing
+    from gi.repository import GLib
+    available = sys.platform.startswith("linux")
+except ImportError:
+    available = False
+
+
+def _serve(conn):
+    """
+    The main loop of a worker process.
+
+    :param multiprocessing.Connection conn: the connection to GPS
+    """
+    from highlighter.engine import HighlighterModule
+
+    while True:
+        try:
+            job_id, language, text, start_line, stack = conn.recv()
+        except EOFError:
+            return
+
+        try:
+            result = HighlighterModule.highlighters[language] \
+                .tokenize_snapshot(text, start_line, stack)
+        except Exception:
+            result = None
+
+        conn.send((job_id, result))
+
+
+def _fail_later(callback):
+    """
+    Call callback with None from the main loop. Like results, failures are
+    reported asynchronously, even when submitting a job fails.
+    """
+    def fail():
+        callback(None)
+        return False
+
+    GLib.idle_add(fail)
+
+
+class _Worker(object):
+
+    def __init__(self, pool):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve,
+                                               args=(child_conn, ))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+        self.job = None   # The job being processed, if any
+        self.watch_id = GLib.io_add_watch(
+            self.conn.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, pool._on_result, self)
+
+    def stop(self):
+        GLib.source_remove(self.watch_id)
+        self.conn.close()
+        self.process.terminate()
+
+
+class TokenizerPool(object):
+    """
+    Dispatches tokenization jobs to a bounded number of worker processes.
+    """
+
+    size = 2
+    """Maximum number of worker processes"""
+
+    max_failures = 3
+    """
+    Number of consecutive failures to start a worker, or to get a result
+    from it, after which workers are disabled for retry_delay seconds.
+    """
+
+    retry_delay = 60
+    """Number of seconds before workers are tried again"""
+
+    def __init__(self):
+        self.__workers = []
+        self.__queue = []    # list of jobs waiting for a worker
+        self.__ids = count()
+        self.__failures = 0
+        self.__disabled_until = 0
+
+    @property
+    def enabled(self):
+        """Whether jobs can be submitted"""
+        return available and time() >= self.__disabled_until
+
+    def submit(self, language, text, start_line, stack, callback):
+        """
+        Tokenize text in a worker process.
+
+        :param str language: the language of the highlighter to use
+        :param unicode text: the text to highlight, starting at the
+           beginning of start_line.
+        :param list[int] stack: the stack of highlighters at the start of
+           text, as indexes in Highlighter.keys().
+        :param callback: called with the result of
+           Highlighter.tokenize_snapshot, or None if it failed.
+        :return: the id of the job, or None if workers are not available.
+        """
+        if not self.enabled:
+            return None
+
+        job_id = next(self.__ids)
+        self.__queue.append(
+            (job_id, (job_id, language, text, start_line, stack), callback))
+        self.__dispatch()
+        return job_id
+
+    def cancel(self, job_id):
+        """
+        Cancel a job. Its callback will not be called. A worker that is
+        processing the job is killed, so that it is free for the next jobs.
+        """
+        self.__queue = [job for job in self.__queue if job[0] != job_id]
+        for w in self.__workers:
+            if w.job and w.job[0] == job_id:
+                w.stop()
+                self.__workers.remove(w)
+                self.__dispatch()
+                return
+
+    def __dispatch(self):
+        while self.__queue:
+            idle = [w for w in self.__workers if w.job is None]
+            if idle:
+                worker = idle[0]
+            elif len(self.__workers) < self.size:
+                try:
+                    worker = _Worker(self)
+                except Exception:
+                    # Fail the job rather than retrying at once, which
+                    # would likely fail again.
+                    self.__failed(None, self.__queue.pop(0)[2])
+                    continue
+                self.__workers.append(worker)
+            else:
+                return
+
+            job_id, message, callback = self.__queue.pop(0)
+            worker.job = (job_id, callback)
+            try:
+                worker.conn.send(message)
+            except Exception:
+                self.__failed(worker, callback)
+
+    def _on_result(self, fd, condition, worker):
+        """
+        Called from the main loop when a worker has sent a result, or died.
+        """
+        if worker not in self.__workers:
+            return False   # killed by cancel
+
+        job_id, callback = worker.job or (None, None)
+
+        try:
+            if not condition & GLib.IO_IN:
+                raise EOFError()
+            received_id, result = worker.conn.recv()
+            assert received_id == job_id
+        except Exception:
+            self.__failed(worker, callback)
+            self.__dispatch()
+            return False
+
+        self.__failures = 0
+        worker.job = None
+        self.__dispatch()
+        if callback:
+            callback(result)
+        return True
+
+    def __failed(self, worker, callback):
+        """
+        Stop a worker that died, and fail its job. After too many failures
+        in a row, all workers are disabled for a while.
+
+        :param _Worker|None worker: None if the worker could not be started
+        :param callback: the callback of the job, if any
+        """
+        if worker is not None:
+            worker.stop()
+            self.__workers.remove(worker)
+
+        self.__failures += 1
+        if self.__failures >= self.max_failures:
+            self.__disable()
+
+        if callback:
+            _fail_later(callback)
+
+    def __disable(self):
+        """
+        Stop all workers for retry_delay seconds, and fail the jobs that
+        were waiting for them.
+        """
+        self.__failures = 0
+        self.__disabled_until = time() + self.retry_delay
+        callbacks = [callback for _, _, callback in self.__queue]
+
+        for w in self.__workers:
+            if w.job and w.job[1]:
+                callbacks.append(w.job[1])
+            w.stop()
+
+        self.__workers = []
+        self.__queue = []
+
+        for callback in callbacks:
+            _fail_later(callback)
+
+
+tokenizer_pool = TokenizerPool()
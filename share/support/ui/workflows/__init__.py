@@ -117,10 +117,13 @@ is executed.
 
 import inspect
 import sys
+import time
 import GPS
 import workflows.promises as promises
 import traceback
 import types
+from gi.repository import GLib
+from workflows.promises import run_in_pool
 
 # A table of all registered workflows
 registered_workflows = {}
@@ -133,6 +136,36 @@ workflows_target_name_set = set()
 # Table of exit handlers for build targets implemented via workflows
 exit_handlers_table = {}
 
+# Time, in milliseconds, a workflow can run before `checkpoint()` lets GPS
+# process pending events.
+default_time_slice = 20
+
+
+class _Checkpoint(object):
+    """The type of the value returned by `checkpoint()`"""
+    pass
+
+
+_CHECKPOINT = _Checkpoint()
+
+
+def checkpoint():
+    """
+    Let GPS process pending events if the workflow has been running for
+    too long. This is meant for workflows that do a lot of processing
+    between two promises, for instance parsing a large output::
+
+        def parse(lines):
+            for line in lines:
+                ...   # do something with the line
+                yield workflows.checkpoint()
+
+    The workflow is resumed immediately if it has been running for less
+    than its time slice (see `driver`, this is `default_time_slice` by
+    default). Otherwise it is resumed in an idle callback.
+    """
+    return _CHECKPOINT
+
 
 def run_registered_workflows(workflow_name, target_name, main_name):
     """ Find workflow and run it with the driver.
@@ -182,7 +215,7 @@ def peel_traceback_to(tb, frame):
     return tb
 
 
-def driver(gen_inst):
+def driver(gen_inst, time_slice=None):
     """
     This is the main driver for workflows. You can pass your worklow (which is
     a python generator instance) to it and it will execute it.
@@ -214,6 +247,14 @@ def driver(gen_inst):
     Generators can throw exceptions: these will be propagated to the generator
     that spawned them.
 
+    A workflow only lets GPS process events while it waits for a promise, or
+    when it yields `checkpoint()` after having run for too long.
+
+    :param int time_slice: if specified, the workflow runs in time-sliced
+      mode: when it has been running for more than this many milliseconds,
+      it is resumed from an idle callback the next time it yields anything
+      or one of its generators terminates, rather than only on checkpoints.
+
     :return: a promise, that will be resolved when the workflow has finished
       executing. This can in general be ignored, since as described above
       `driver` will automatically chain things. In some contexts it might be
@@ -226,10 +267,28 @@ def driver(gen_inst):
     # original generator and the last one is the most recently spawned one.
     gen_stack = [gen_inst]
 
+    # When the workflow must let GPS process events. This is None while it
+    # is waiting, and is shared with the calls to resume made when a
+    # promise is already resolved.
+    deadline = [None]
+
+    def resume_later(return_val):
+        """Resume execution for this workflow in an idle callback."""
+        def on_idle():
+            resume(return_val)
+            return False
+
+        GLib.idle_add(on_idle)
+
     def resume(return_val=None):
         """Resume execution for this workflow."""
         el = None
         exc_info = None
+        check_time = False
+
+        if deadline[0] is None:
+            deadline[0] = time.time() + (
+                time_slice or default_time_slice) / 1000.0
 
         while gen_stack:
             gen = gen_stack[-1]
@@ -286,15 +345,33 @@ def driver(gen_inst):
                 # If the last generator yielded a promise, schedule to resume
                 # its execution when the promise is ready.
                 # ??? Should we connect to reject to cancel the whole workflow?
+                # A promise that is already resolved resumes the workflow in
+                # the same time slice.
+                pending = el._state == promises.Promise.PENDING
                 el.then(resume)
+                if pending:
+                    deadline[0] = None
                 return
+            elif el is _CHECKPOINT:
+                el = None
+                check_time = True
 
             # Clean state for the next round.
             return_val = el
             exc_info = None
 
+            if ((check_time or time_slice) and gen_stack and
+                    time.time() >= deadline[0]):
+                # Let GPS process events before the next round.
+                deadline[0] = None
+                resume_later(return_val)
+                return
+
+            check_time = False
+
         # If we reach this point, there's nothing to execute anymore: just log
         # any uncaught exception.
+        deadline[0] = None
         if exc_info is not None:
             message = (
                 'Uncaught exception in workflows:\n'
@@ -316,7 +393,7 @@ def driver(gen_inst):
     return promise
 
 
-def run_as_workflow(workflow):
+def run_as_workflow(workflow=None, time_slice=None):
     """
     Decorator used to run a function as a worfklow.
     This is a way to make a function run in the background automatically.
@@ -340,17 +417,27 @@ def run_as_workflow(workflow):
     will start running an external process and parse all its lines. But the
     call to `my_function()` returns immediately, and thus GPS is not blocked.
 
+    The decorator also accepts a time slice, see `driver`::
+
+        @run_as_workflow(time_slice=20)
+        def my_function():
+            ...
+
     :param workflow: the function to be run as a workflow.
        The workflow has potentially not finished running when this function
        returns.
        This also works for standard functions
+    :param int time_slice: run the workflow in time-sliced mode.
     :return: either the result of workflow, or a promise that will resolve
        to that result eventually.
     """
+    if workflow is None:
+        return lambda wf: run_as_workflow(wf, time_slice=time_slice)
+
     def internal_run_as_wf(*args, **kwargs):
         r = workflow(*args, **kwargs)
         if isinstance(r, types.GeneratorType):
-            return driver(r)
+            return driver(r, time_slice=time_slice)
         else:
             return r
 
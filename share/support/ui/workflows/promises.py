@@ -7,12 +7,71 @@ import time
 from time_utils import *
 
 import GPS
+import collections
+import heapq
+import itertools
 import re
+import sys
+import traceback
 import types
 from pygps import process_all_events
 from gi.repository import GLib
 import workflows
 
+try:
+    import multiprocessing
+    _can_fork = sys.platform.startswith("linux")
+except ImportError:
+    _can_fork = False
+
+
+# The promises that have just been settled, and whose callbacks have not
+# been called yet, as (callbacks, state, value). Callbacks are called from a
+# loop rather than recursively, so that long chains of promises do not
+# exhaust the stack.
+_settled = collections.deque()
+_draining = [False]
+
+
+def _drain():
+    """
+    Call the callbacks of settled promises, until there are none left.
+    If a callback raises an exception, it is propagated, and the remaining
+    callbacks are called from an idle callback.
+    """
+    if _draining[0]:
+        return False   # Will be handled by the loop below
+
+    _draining[0] = True
+    try:
+        while _settled:
+            callbacks, state, value = _settled.popleft()
+            for index, (success, failure, ret) in enumerate(callbacks):
+                try:
+                    _call(state, value, success, failure, ret)
+                except BaseException:
+                    if index + 1 < len(callbacks):
+                        _settled.appendleft(
+                            (callbacks[index + 1:], state, value))
+                    raise
+    finally:
+        _draining[0] = False
+        if _settled:
+            GLib.idle_add(_drain)
+
+    return False
+
+
+def _call(state, value, success, failure, ret):
+    """
+    Call the callback registered by `Promise.then` for the new state of the
+    promise, and settle ret with its result.
+    """
+    if state == Promise.RESOLVED:
+        ret.resolve(success(value) if success else value)
+    else:
+        ret.reject(failure(value) if failure else value)
+
 
 class Promise(object):
     """
@@ -67,11 +126,14 @@ class Promise(object):
     RESOLVED = 0
     REJECTED = 1
 
+    __slots__ = ("_state", "_result", "_callbacks")
+
     def __init__(self):
-        self.__success = []  # Called when the promise is resolved
-        self.__failure = []  # Called when the promise is rejected
-        self.__result = None   # The result of the promise
         self._state = Promise.PENDING
+        self._result = None   # The result of the promise
+
+        # (success, failure, promise returned by then) for each call to then
+        self._callbacks = []
 
     def then(self, success=None, failure=None):
         """
@@ -107,23 +169,39 @@ class Promise(object):
            return value of on_promise1_done.
            If `success` also return a promise, the value of that promise will
            be used to resolve the result of `then`.
+
+        Callbacks are called from a loop rather than recursively: when a
+        promise is settled (or `then` is called on a settled promise) from
+        another callback, its callbacks are only called after that callback
+        returns.
         """
         ret = Promise()
+        if self._state == Promise.PENDING:
+            self._callbacks.append((success, failure, ret))
+        else:
+            # Called immediately, unless we are already calling the
+            # callbacks of another promise.
+            _settled.append(
+                ([(success, failure, ret)], self._state, self._result))
+            _drain()
+        return ret
 
-        def __fullfill(value):
-            ret.resolve(success(value) if success else value)
+    def __settle(self, state, result):
+        """
+        Set the state of the promise, and call the callbacks set by the user.
+        """
+        self._state = state
+        self._result = result  # in case we call then() later
+        callbacks = self._callbacks
 
-        def __reject(reason):
-            ret.reject(failure(reason) if failure else reason)
+        # Release all listeners, for garbage collecting, since the state of
+        # the promise can't change anymore, and listeners are only called
+        # once.
+        self._callbacks = None
 
-        if self._state == Promise.RESOLVED:
-            __fullfill(self.__result)
-        elif self._state == Promise.REJECTED:
-            __reject(self.__result)
-        else:
-            self.__success.append(__fullfill)
-            self.__failure.append(__reject)
-        return ret
+        if callbacks:
+            _settled.append((callbacks, state, result))
+            _drain()
 
     def resolve(self, result=None):
         """
@@ -136,16 +214,7 @@ class Promise(object):
             if isinstance(result, Promise):
                 result.then(self.resolve, self.reject)
             else:
-                self._state = Promise.RESOLVED
-                self.__result = result  # in case we call then() later
-                for s in self.__success:
-                    s(result)
-
-                # Release all listeners, for garbage collecting, since the
-                # state of the promise can't change anymore, and listeners are
-                # only called once.
-                self.__success = None
-                self.__failure = None
+                self.__settle(Promise.RESOLVED, result)
 
     def reject(self, reason=None):
         """
@@ -153,13 +222,7 @@ class Promise(object):
         callbacks. `reason` should not be a Promise.
         """
         if self._state == Promise.PENDING:
-            self._state = Promise.REJECTED
-            self.__result = reason
-            for s in self.__failure:
-                s(reason)
-
-            self.__success = None
-            self.__failure = None
+            self.__settle(Promise.REJECTED, reason)
 
 
 class Stream(Promise):
@@ -171,6 +234,8 @@ class Stream(Promise):
     compatible with the workflow framework.
     """
 
+    __slots__ = ("_onnext", )
+
     def __init__(self):
         super(Stream, self).__init__()
         self._onnext = []
@@ -200,6 +265,23 @@ class Stream(Promise):
         for cb in self._onnext:
             cb(value)
 
+    def emit_batch(self, values):
+        """
+        Emit one event for each of the values, in order. This is faster than
+        calling `emit` for each value.
+
+        :param list values: the values to emit.
+        """
+        callbacks = self._onnext
+        if len(callbacks) == 1:
+            cb = callbacks[0]
+            for value in values:
+                cb(value)
+        else:
+            for value in values:
+                for cb in callbacks:
+                    cb(value)
+
     def resolve(self, result=None):
         self._onnext = []
         super(Stream, self).resolve(result)
@@ -218,10 +300,11 @@ class Stream(Promise):
         :returntype: a Stream
         """
         out = Stream()
+        emit = out.emit
         self.subscribe(
-            onnext=lambda value: out.emit(transform(value)),
-            oncompleted=lambda value: out.resolve(value),
-            onerror=lambda reason: out.reject(reason))
+            onnext=lambda value: emit(transform(value)),
+            oncompleted=out.resolve,
+            onerror=out.reject)
         return out
 
     def flatMap(self, transform):
@@ -426,6 +509,242 @@ def hook(hook_name):
     return p
 
 
+class _LineSplitter(object):
+    """
+    Splits the output of a process into lines, as it is received in chunks.
+    The cost is proportional to the size of each chunk, whatever the number
+    of lines it contains: the output is never searched or copied again once
+    its lines have been returned.
+    """
+
+    def __init__(self, separator="\n"):
+        """
+        :param str separator: the character that terminates each line, for
+           instance "\0" for the output of "git status -z".
+        """
+        self.__separator = separator
+        self.__partial = []   # the chunks for the current incomplete line
+
+    def split(self, output):
+        """
+        Return the lines completed by output, without their separator.
+
+        :param str output: the next chunk of output.
+        :rtype: list[str]
+        """
+        sep = self.__separator
+        if sep not in output:
+            if output:
+                self.__partial.append(output)
+            return []
+
+        if self.__partial:
+            self.__partial.append(output)
+            output = "".join(self.__partial)
+
+        lines = output.split(sep)
+        last = lines.pop()
+        self.__partial = [last] if last else []
+        return lines
+
+    def remainder(self):
+        """
+        Return the incomplete last line, if any, once the output is complete.
+
+        :rtype: str
+        """
+        last = "".join(self.__partial)
+        self.__partial = []
+        return last
+
+
+class CancellationToken(object):
+    """
+    A token passed to one or more asynchronous operations, so that they can
+    all be cancelled at once, for instance when their result is no longer
+    needed::
+
+        token = CancellationToken()
+        p1 = ProcessWrapper([...], token=token)
+        p2 = ProcessWrapper([...], token=token)
+        token.cancel()    # terminates both processes
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self.__callbacks = []
+
+    def register(self, callback):
+        """
+        Call callback, with no argument, when the token is cancelled. It is
+        called immediately if the token has already been cancelled.
+        """
+        if self.cancelled:
+            callback()
+        else:
+            self.__callbacks.append(callback)
+
+    def unregister(self, callback):
+        """
+        Stop monitoring the token, once the operation has completed.
+        """
+        if callback in self.__callbacks:
+            self.__callbacks.remove(callback)
+
+    def cancel(self):
+        """
+        Cancel all the operations that use this token.
+        """
+        if not self.cancelled:
+            self.cancelled = True
+            callbacks = self.__callbacks
+            self.__callbacks = []
+
+            # Most recent first, so that cancelling running processes does
+            # not start the pending ones.
+            for cb in reversed(callbacks):
+                cb()
+
+
+class ScheduledJob(object):
+    """
+    A job waiting to be started by a ProcessScheduler, or running.
+    """
+
+    PENDING = 0
+    RUNNING = 1
+    DONE = 2
+
+    def __init__(self, scheduler, start, priority, key):
+        self.__scheduler = scheduler
+        self.start = start
+        self.priority = priority
+        self.key = key
+        self.state = ScheduledJob.PENDING
+
+        # The objects that are waiting for this job. There are several when
+        # identical jobs were submitted (see ProcessScheduler.submit).
+        self.listeners = []
+
+    def cancel(self):
+        """
+        Cancel the job if it has not started yet.
+        """
+        if self.state == ScheduledJob.PENDING:
+            self.state = ScheduledJob.DONE
+            self.__scheduler._forget(self)
+
+    def done(self):
+        """
+        Must be called when the job has finished running, to start the
+        next pending jobs.
+        """
+        if self.state == ScheduledJob.RUNNING:
+            self.state = ScheduledJob.DONE
+            self.__scheduler._forget(self)
+
+
+class ProcessScheduler(object):
+    """
+    Limits the number of external processes spawned by ProcessWrapper that
+    run at the same time in the background, so that plugins do not start
+    dozens of processes at once, for instance when a project is loaded.
+
+    INTERACTIVE jobs always start immediately and do not count toward the
+    limit, since the user is waiting for them, and some of them (a
+    connection to a board, a debugger, ...) run for the whole session.
+    BACKGROUND jobs start in the order they were submitted, when fewer
+    than max_running other BACKGROUND jobs are running.
+    """
+
+    INTERACTIVE = 0
+    """Priority of jobs started on behalf of the user"""
+
+    BACKGROUND = 1
+    """Priority of jobs that compute information in the background"""
+
+    max_running = 4
+    """Maximum number of BACKGROUND jobs running at the same time"""
+
+    def __init__(self):
+        self.__pending = []   # heap of (priority, sequence number, job)
+        self.__by_key = {}    # the pending jobs, indexed by their key
+        self.__running = set()   # the running BACKGROUND jobs
+        self.__sequence = itertools.count()
+
+    def submit(self, start, priority=INTERACTIVE, key=None, listener=None):
+        """
+        Run a job, immediately if it is INTERACTIVE, or as soon as fewer
+        than max_running BACKGROUND jobs are running.
+
+        :param start: called with the job as parameter when it starts.
+           The job is then considered running until its `done` method is
+           called.
+        :param int priority: INTERACTIVE or BACKGROUND.
+        :param key: if not None, and a job with the same key is still
+           pending, that job is returned instead of starting a new one. It
+           is started immediately if priority is INTERACTIVE.
+        :param listener: if not None, added to the listeners of the job
+           before it starts, so that it is notified even if the job
+           finishes immediately.
+        :returntype: ScheduledJob
+        """
+        job = self.__by_key.get(key) if key is not None else None
+        if job is not None:
+            if listener is not None:
+                job.listeners.append(listener)
+            if priority >= job.priority:
+                return job
+            job.priority = priority   # previous entry in heap is ignored
+        else:
+            job = ScheduledJob(self, start, priority, key)
+            if listener is not None:
+                job.listeners.append(listener)
+            if key is not None:
+                self.__by_key[key] = job
+
+        heapq.heappush(self.__pending, (priority, next(self.__sequence), job))
+        self.__start_pending()
+        return job
+
+    def _forget(self, job):
+        """
+        Called when a job is cancelled or has finished.
+        """
+        if self.__by_key.get(job.key) is job:
+            del self.__by_key[job.key]
+        if job in self.__running:
+            self.__running.remove(job)
+            self.__start_pending()
+
+    @property
+    def nb_running(self):
+        """The number of BACKGROUND jobs running"""
+        return len(self.__running)
+
+    def __start_pending(self):
+        while self.__pending and (
+                self.__pending[0][0] == ProcessScheduler.INTERACTIVE or
+                len(self.__running) < self.max_running):
+            priority, _, job = heapq.heappop(self.__pending)
+            if (job.state != ScheduledJob.PENDING or
+                    priority != job.priority):
+                continue   # cancelled, or an outdated entry in the heap
+
+            self._forget(job)
+            job.state = ScheduledJob.RUNNING
+            if priority != ProcessScheduler.INTERACTIVE:
+                self.__running.add(job)
+            try:
+                job.start(job)
+            except Exception:
+                GPS.Logger("PROMISES").log("Failed to start job")
+                job.done()
+
+
+process_scheduler = ProcessScheduler()
+
+
 class ProcessWrapper(object):
     """
     ProcessWrapper is an advanced process manager
@@ -446,7 +765,9 @@ class ProcessWrapper(object):
     """
 
     def __init__(self, cmdargs=[], spawn_console=False, directory=None,
-                 regexp='.+', single_line_regexp=True, block_exit=True):
+                 regexp='.+', single_line_regexp=True, block_exit=True,
+                 priority=ProcessScheduler.INTERACTIVE, token=None,
+                 dedup=False):
         """
         Initialize and run a process with no promises,
         no user-defined pattern to match,
@@ -469,6 +790,14 @@ class ProcessWrapper(object):
            the output at once.
         :param bool block_exit: whether the user should be asked when GPS
            exits and this process is still running.
+        :param int priority: BACKGROUND processes only start when few
+           other BACKGROUND processes are running. See ProcessScheduler.
+        :param CancellationToken token: if specified, the process is
+           terminated when the token is cancelled.
+        :param bool dedup: if True, and an identical process is waiting to
+           start, share its output rather than running the command again.
+           Only use this for commands that do not modify anything, like
+           queries of the status of files.
         """
 
         # __current_promise = about on waiting wish for match something
@@ -480,12 +809,25 @@ class ProcessWrapper(object):
         # __current_pattern = regexp that user waiting for in the output
         self.__current_pattern = None
 
-        # __output = a buffer for current output of self.__process
+        # __current_lines = when waiting for lines rather than a pattern,
+        # the maximum number of lines to return. __current_batch is whether
+        # they are returned as a list (see read_lines)
+        self.__current_lines = None
+        self.__current_batch = False
+
+        # __output = a buffer for current output of self.__process. The
+        # output before __pos has already been returned to the user, and is
+        # only removed from time to time, to avoid copying the buffer for
+        # each line.
         self.__output = ""
+        self.__pos = 0
 
         # __whether process has finished
         self.finished = False
 
+        # The exit status of the process, once it has terminated
+        self.__exit_status = None
+
         # handler of process will be created -> start running
         # Remove empty command line arguments
         self.__command = [c for c in cmdargs if c]
@@ -494,25 +836,30 @@ class ProcessWrapper(object):
         # Created only if spawn_console is set to True.
         self.__console = None
 
-        # Launch the command
-        try:
-            self.__process = GPS.Process(
-                command=self.__command,
-                directory=directory,
-                regexp=regexp,
-                single_line_regexp=single_line_regexp,
-                block_exit=block_exit,
-                on_match=self.__on_match,
-                on_exit=self.__on_exit)
-        except:
-            GPS.Logger("PROMISES").log(
-                "Failed to spawn %s" % (self.__command, ))
-            self.__process = None
-            return
+        self.__directory = directory
+        self.__regexp = regexp
+        self.__single_line_regexp = single_line_regexp
+        self.__block_exit = block_exit
 
-        # Save the start time
+        # The process, once it has been started by the scheduler
+        self.__process = None
         self.__start_time = time.time()
 
+        # Launch the command when the scheduler allows it
+        key = None
+        if dedup and spawn_console is False:
+            key = (tuple(self.__command), directory, regexp,
+                   single_line_regexp, block_exit)
+
+        # The wrapper listens to the job before it starts: the process
+        # might fail to spawn, and the job terminate, right away.
+        self.__token = token
+        self.__job = process_scheduler.submit(
+            self.__spawn, priority=priority, key=key, listener=self)
+
+        if token is not None and not self.finished:
+            token.register(self.terminate)
+
         # If requested, spawn a console to display the process output
         if spawn_console is not False:
             if isinstance(spawn_console, str):
@@ -557,18 +904,102 @@ class ProcessWrapper(object):
                 lambda out: self.__console.write("%s\n" % out),
                 oncompleted=__show_console_on_exit)
 
+    def __spawn(self, job):
+        """
+        Called by the scheduler to start the process, on behalf of all
+        the wrappers listening to job.
+        """
+        def on_match(process, match, unmatch):
+            for w in list(job.listeners):
+                w.__on_match(process, match, unmatch)
+
+        def on_exit(process, status, remaining_output):
+            job.done()
+            for w in list(job.listeners):
+                w.__on_exit(process, status, remaining_output)
+
+        try:
+            process = GPS.Process(
+                command=self.__command,
+                directory=self.__directory,
+                regexp=self.__regexp,
+                single_line_regexp=self.__single_line_regexp,
+                block_exit=self.__block_exit,
+                on_match=on_match,
+                on_exit=on_exit)
+        except Exception:
+            GPS.Logger("PROMISES").log(
+                "Failed to spawn %s" % (self.__command, ))
+            # Terminate as if the process had been interrupted, so that
+            # nobody waits for it forever.
+            on_exit(None, -1, "")
+            return
+
+        start_time = time.time()
+        self.__process = process
+        self.__start_time = start_time
+        for w in job.listeners:
+            w.__process = process
+            w.__start_time = start_time
+
+    def __detach(self):
+        """
+        Stop listening to the output of the job, and terminate as if the
+        process had been interrupted. The job is cancelled if it has not
+        started yet and no other wrapper needs it.
+        """
+        self.__job.listeners.remove(self)
+        if not self.__job.listeners:
+            self.__job.cancel()
+        self.__on_exit(self.__process, -1, "")
+
     def __on_match(self, process, match, unmatch):
         """
         Called by GPS everytime there's output coming
         """
         if self.__current_promise is not None:
-            self.__output += unmatch
-            self.__output += match
+            self.__append_output(unmatch + match)
             self.__check_pattern_and_resolve()
         if self.__stream is not None:
             self.__stream.emit(unmatch)
             self.__stream.emit(match)
 
+    def __append_output(self, output):
+        """
+        Add output to the buffer, after discarding the output already
+        returned to the user if it takes at least half of the buffer.
+        """
+        if self.__pos >= 4096 and self.__pos * 2 >= len(self.__output):
+            self.__compact()
+        self.__output += output
+
+    def __compact(self):
+        """
+        Discard the output already returned to the user.
+        """
+        if self.__pos:
+            self.__output = self.__output[self.__pos:]
+            self.__pos = 0
+
+    def __read_lines(self, max_lines):
+        """
+        Consume up to max_lines complete lines from the buffer.
+
+        :return: the lines, without their trailing \n
+        :rtype: list[str]
+        """
+        output = self.__output
+        pos = self.__pos
+        lines = []
+        while len(lines) < max_lines:
+            end = output.find("\n", pos)
+            if end < 0:
+                break
+            lines.append(output[pos:end])
+            pos = end + 1
+        self.__pos = pos
+        return lines
+
     def __resolve_promise(self, value):
         """
         Resolve the current promise with the given value.
@@ -584,11 +1015,23 @@ class ProcessWrapper(object):
         of the tool, and resolve the promise if possible.
         """
         if self.__current_promise is not None:
-            p = self.__current_pattern.search(self.__output)
-            if p:
-                self.__output = self.__output[p.end(0):]
-                self.__resolve_promise(p.group(0))
-            elif self.finished:
+            if self.__current_lines:
+                lines = self.__read_lines(self.__current_lines)
+                if lines:
+                    self.__resolve_promise(
+                        lines if self.__current_batch else lines[0])
+                    return
+            else:
+                # Patterns might use '^' or '\A', so must be matched from
+                # the start of the buffer.
+                self.__compact()
+                p = self.__current_pattern.search(self.__output)
+                if p:
+                    self.__pos = p.end(0)
+                    self.__resolve_promise(p.group(0))
+                    return
+
+            if self.finished:
                 # We will never be able to match anyway
                 self.__resolve_promise(None)
 
@@ -599,9 +1042,12 @@ class ProcessWrapper(object):
            Current_promise will be solved with False
         """
         self.finished = True
+        self.__exit_status = status
+        if self.__token is not None:
+            self.__token.unregister(self.terminate)
 
         if self.__current_promise is not None:
-            self.__output += remaining_output
+            self.__append_output(remaining_output)
             self.__check_pattern_and_resolve()
 
         if self.__stream is not None:
@@ -632,6 +1078,7 @@ class ProcessWrapper(object):
         else:
             self.__current_pattern = pattern
 
+        self.__current_lines = None
         p = self.__current_promise = Promise()
 
         # Can we resolve immediately ?
@@ -650,16 +1097,40 @@ class ProcessWrapper(object):
         does not include the trailing \n
         See documentation for `wait_until_match`.
 
-        :return: a promise
+        :return: a promise, resolved with None when the process has
+           terminated and all its complete lines have been returned.
         """
-        p = Promise()
+        return self.__wait_lines(1, batch=False)
 
-        s = self.wait_until_match("^.*\n")
-        if s is None:
-            p.resolve(None)   # already finished
-        else:
-            s.then(lambda line: p.resolve(line[:-1] if line else None))
+    def read_lines(self, max_n=1000):
+        """
+        Wait until at least one line is available, and return all the
+        lines received so far, up to max_n. This is much more efficient
+        than calling `wait_line` for each line of a large output::
+
+            while True:
+                lines = yield p.read_lines()
+                if lines is None:
+                    break
+                for line in lines:
+                    pass   # do something with the line
+
+        :param int max_n: the maximum number of lines to return.
+        :return: a promise, resolved with a non-empty list of lines without
+           their trailing \n, or with None when the process has terminated
+           and all its complete lines have been returned.
+        """
+        return self.__wait_lines(max_n, batch=True)
 
+    def __wait_lines(self, max_n, batch):
+        """
+        Implementation of `wait_line` and `read_lines`.
+        """
+        self.__current_pattern = None
+        self.__current_lines = max_n
+        self.__current_batch = batch
+        p = self.__current_promise = Promise()
+        self.__check_pattern_and_resolve()
         return p
 
     @property
@@ -682,6 +1153,10 @@ class ProcessWrapper(object):
         """
         if self.__stream is None:
             self.__stream = Stream()
+            if self.__exit_status is not None:
+                # The process has already terminated, for instance because
+                # it could not be spawned.
+                self.__stream.resolve(self.__exit_status)
         return self.__stream
 
     @property
@@ -723,24 +1198,69 @@ class ProcessWrapper(object):
 
         class map_to_line:
             def __init__(self):
-                self.buffer = ""
-                self.__re = re.compile('^.*\n')
+                self.splitter = _LineSplitter()
 
             def __call__(self, out_stream, output):
-                self.buffer += output
-                while True:
-                    p = self.__re.search(self.buffer)
-                    if not p:
-                        break
-                    out_stream.emit(p.group(0)[:-1])
-                    self.buffer = self.buffer[p.end(0):]
+                out_stream.emit_batch(self.splitter.split(output))
 
             def oncompleted(self, out_stream, status):
-                if self.buffer:
-                    out_stream.emit(self.buffer)
+                last = self.splitter.remainder()
+                if last:
+                    out_stream.emit(last)
 
         return self.stream.flatMap(map_to_line())
 
+    @property
+    def lines_batched(self):
+        """
+        Similar to `lines`, but emits lists of lines, one for each chunk of
+        output received from the process. This is more efficient for tools
+        that output a lot of lines, since subscribers are called once per
+        chunk::
+
+            def onlines(lines):
+                for line in lines:
+                    pass   # do something with the line
+
+            @run_as_workflow
+            def execute():
+                p = ProcessWrapper(...)
+                yield p.lines_batched.subscribe(onlines)
+
+        :returntype: a stream, which never emits empty lists.
+        """
+        return self.records_batched("\n")
+
+    def records_batched(self, separator):
+        """
+        Similar to `lines_batched`, but splits the output on separator
+        rather than on newlines. This is used for tools whose output is
+        made of NUL-terminated records, like "git status -z", which
+        can represent any file name::
+
+            p = ProcessWrapper(['git', 'status', '-z'])
+            yield p.records_batched("\0").subscribe(onrecords)
+
+        :param str separator: the character that terminates each record.
+        :returntype: a stream, which never emits empty lists.
+        """
+
+        class map_to_lines:
+            def __init__(self):
+                self.splitter = _LineSplitter(separator)
+
+            def __call__(self, out_stream, output):
+                lines = self.splitter.split(output)
+                if lines:
+                    out_stream.emit(lines)
+
+            def oncompleted(self, out_stream, status):
+                last = self.splitter.remainder()
+                if last:
+                    out_stream.emit([last])
+
+        return self.stream.flatMap(map_to_lines())
+
     def wait_until_terminate(self, show_if_error=False):
         """
         Called by user. Make a promise to them that:
@@ -773,6 +1293,7 @@ class ProcessWrapper(object):
         """
         self.__resolve_promise(None)
         self.__current_pattern = None
+        self.__current_lines = None
         return False
 
     def terminate(self):
@@ -785,9 +1306,13 @@ class ProcessWrapper(object):
         # get end timestamp
         end_time = time.time()
 
-        # Interrupt the process, if any
+        # Interrupt the process, if any. If it has not started yet, or
+        # is shared with other wrappers, only stop listening to it.
         if not self.finished:
-            self.__process.interrupt()
+            if self.__process is None or len(self.__job.listeners) > 1:
+                self.__detach()
+            else:
+                self.__process.interrupt()
             if self.__console:
                 self.__console.write(
                     "\n<^C> process interrupted (elapsed time: %s)\n" %
@@ -798,9 +1323,13 @@ class ProcessWrapper(object):
         Called when the console is being destroyed.
         Interrupt the attached process.
         """
-        self.__process.interrupt()
-        self.finished = True
         self.__console = None
+        if not self.finished:
+            if self.__process is None:
+                self.__detach()
+            else:
+                self.__process.interrupt()
+        self.finished = True
 
     def __relaunch(self):
         """
@@ -810,12 +1339,260 @@ class ProcessWrapper(object):
         """
 
         self.terminate()
-        self.__process = GPS.Process(
-            command=self.__command,
-            regexp=".+",
-            on_match=self.__on_match,
-            on_exit=self.__on_exit)
-        self.__start_time = time.time()
+
+        # Stop listening to the previous process, which might still be
+        # exiting.
+        if self in self.__job.listeners:
+            self.__job.listeners.remove(self)
+
+        self.finished = False
+        self.__process = None
+        self.__exit_status = None
+        self.__job = process_scheduler.submit(
+            self.__spawn, priority=ProcessScheduler.INTERACTIVE,
+            listener=self)
+
+
+def _serve_pool(conn):
+    """
+    The main loop of a worker process of a WorkerPool.
+
+    :param multiprocessing.Connection conn: the connection to GPS
+    """
+    while True:
+        try:
+            job_id, func, args, kwargs = conn.recv()
+        except EOFError:
+            return
+        except Exception:
+            # The function or its arguments could not be unpickled
+            conn.send((None, False, traceback.format_exc()))
+            continue
+
+        try:
+            result = (job_id, True, func(*args, **kwargs))
+        except Exception:
+            result = (job_id, False, traceback.format_exc())
+
+        try:
+            conn.send(result)
+        except Exception:
+            # The result could not be pickled
+            conn.send((job_id, False, traceback.format_exc()))
+
+
+class _PoolWorker(object):
+
+    def __init__(self, pool):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve_pool,
+                                               args=(child_conn, ))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+        self.job = None   # The job being processed, if any
+        self.watch_id = GLib.io_add_watch(
+            self.conn.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, pool._on_result, self)
+
+    def stop(self):
+        GLib.source_remove(self.watch_id)
+        self.conn.close()
+        self.process.terminate()
+
+
+class _PoolJob(object):
+
+    def __init__(self, func, args, kwargs, token):
+        self.id = None
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.token = token
+        self.promise = Promise()
+        self.cancel = None   # registered on token
+
+
+class WorkerPool(object):
+    """
+    Runs python functions in a bounded number of worker processes, so that
+    CPU-bound work does not block GPS. See `run_in_pool`.
+
+    Workers are forked on demand, so they know about all the modules loaded
+    so far. Results are read from the GLib main loop. When processes cannot
+    be forked (on Windows, or if a worker could not be started), functions
+    are run in GPS itself, from an idle callback.
+    """
+
+    size = 2
+    """Maximum number of worker processes"""
+
+    def __init__(self):
+        self.enabled = _can_fork
+        self.__workers = []
+        self.__queue = []    # jobs waiting for a worker
+        self.__ids = itertools.count()
+
+    def submit(self, func, args=(), kwargs={}, token=None):
+        """
+        Run func(*args, **kwargs) in a worker.
+
+        :param CancellationToken token: cancels the job when it is
+           cancelled.
+        :return: a promise resolved with the result of func, or rejected
+           with a string describing the error.
+        """
+        job = _PoolJob(func, args, kwargs, token)
+        job.id = next(self.__ids)
+
+        if token is not None:
+            job.cancel = lambda: self.__cancel(job)
+            token.register(job.cancel)
+
+        if job.promise._state != Promise.PENDING:
+            return job.promise   # token was already cancelled
+
+        self.__queue.append(job)
+        if self.enabled:
+            self.__dispatch()
+        else:
+            GLib.idle_add(self.__run_locally)
+        return job.promise
+
+    def __settle(self, job, success, value):
+        if job.token is not None:
+            job.token.unregister(job.cancel)
+        if success:
+            job.promise.resolve(value)
+        else:
+            job.promise.reject(value)
+
+    def __cancel(self, job):
+        if job in self.__queue:
+            self.__queue.remove(job)
+        for w in self.__workers:
+            if w.job is job:
+                # The function might never return: kill the worker
+                self.__workers.remove(w)
+                w.stop()
+                break
+        self.__settle(job, False, "cancelled")
+        self.__dispatch()
+
+    def __run_locally(self):
+        """
+        Run the next job in GPS itself.
+        """
+        if self.__queue:
+            job = self.__queue.pop(0)
+            try:
+                result = job.func(*job.args, **job.kwargs)
+            except Exception:
+                self.__settle(job, False, traceback.format_exc())
+            else:
+                self.__settle(job, True, result)
+        return False
+
+    def __dispatch(self):
+        while self.__queue and self.enabled:
+            idle = [w for w in self.__workers if w.job is None]
+            if idle:
+                worker = idle[0]
+            elif len(self.__workers) < self.size:
+                try:
+                    worker = _PoolWorker(self)
+                except Exception:
+                    GPS.Logger("PROMISES").log(
+                        "Cannot start worker processes: %s" % (
+                            traceback.format_exc(), ))
+                    self.enabled = False
+                    for _ in self.__queue:
+                        GLib.idle_add(self.__run_locally)
+                    return
+                self.__workers.append(worker)
+            else:
+                return
+
+            job = self.__queue.pop(0)
+            try:
+                worker.conn.send((job.id, job.func, job.args, job.kwargs))
+            except Exception:
+                # The function or its arguments cannot be pickled
+                self.__settle(job, False, traceback.format_exc())
+                continue
+            worker.job = job
+
+    def _on_result(self, fd, condition, worker):
+        """
+        Called from the main loop when a worker has sent a result, or died.
+        """
+        job = worker.job
+
+        try:
+            if not condition & GLib.IO_IN:
+                raise EOFError()
+            job_id, success, value = worker.conn.recv()
+        except Exception:
+            # The worker died, maybe because of the function it ran
+            if worker in self.__workers:
+                self.__workers.remove(worker)
+                worker.stop()
+            if job is not None:
+                self.__settle(job, False, "worker process died")
+            self.__dispatch()
+            return False
+
+        worker.job = None
+        self.__dispatch()
+        if job is not None:
+            self.__settle(job, success, value)
+        return True
+
+
+worker_pool = WorkerPool()
+
+
+def run_in_pool(func, *args, **kwargs):
+    """
+    This primitive runs CPU-bound python code in a separate process, so
+    that GPS remains responsive. The returned promise can be yielded from a
+    workflow, as for processes::
+
+        def check(text):    # at the top level of a module
+            ...
+            return messages
+
+        @run_as_workflow
+        def on_save(file):
+            messages = yield run_in_pool(check, file.path)
+            ...   # display the messages
+
+    func, its arguments and its result are pickled to be sent between GPS
+    and the worker, so:
+
+    - func must be defined at the top level of a module (not a lambda, a
+      nested function or a bound method).
+    - arguments and results must be simple python values (strings, numbers,
+      lists, dicts,...). GPS objects (GPS.File, GPS.EditorBuffer,...)
+      cannot be sent, and the GPS module cannot be used in the worker:
+      pass file names or the text of buffers instead.
+
+    At most `WorkerPool.size` functions run at the same time; others are
+    queued.
+
+    :param func: the function to call.
+    :param args: the arguments of func.
+    :param kwargs: the named arguments of func. The special argument
+       `token`, a CancellationToken, cancels the call when it is
+       cancelled, killing the worker if func is already running.
+    :return: a promise resolved with the result of func, or rejected with
+       a string (the traceback if func raised an exception, or "cancelled").
+       As for other promises, a workflow that yields a rejected promise is
+       not resumed: use `then` to handle errors.
+    """
+    token = kwargs.pop('token', None)
+    return worker_pool.submit(func, args, kwargs, token=token)
 
 
 class DebuggerWrapper(object):
@@ -0,0 +1,96 @@
+"""
+Micro-benchmark for workflows.promises.Promise and Stream. It measures how
+many events per second go through chains of map and flatMap, as used to
+process the output of tools line by line, and how fast long chains of
+promises are resolved. From the GPS Python console::
+
+    import workflows.promises_benchmark
+    workflows.promises_benchmark.run()
+
+Results are written to the Messages view.
+"""
+
+from time import time
+
+import GPS
+from workflows.promises import Promise, Stream
+
+
+def map_chain(nb_events, depth):
+    """Emit nb_events through depth successive calls to map"""
+    source = Stream()
+    out = source
+    for _ in range(depth):
+        out = out.map(lambda value: value + 1)
+    out.subscribe(lambda value: None)
+
+    for num in range(nb_events):
+        source.emit(num)
+    source.resolve(0)
+
+
+def flatmap_chain(nb_events, depth):
+    """Emit nb_events through depth successive calls to flatMap"""
+    def transform(out_stream, value):
+        out_stream.emit(value)
+
+    source = Stream()
+    out = source
+    for _ in range(depth):
+        out = out.flatMap(transform)
+    out.subscribe(lambda value: None)
+
+    for num in range(nb_events):
+        source.emit(num)
+    source.resolve(0)
+
+
+def batched(nb_events, batch_size):
+    """Emit nb_events as batches of batch_size, through a map"""
+    source = Stream()
+    source.map(lambda value: value + 1).subscribe(lambda value: None)
+
+    batch = list(range(batch_size))
+    for _ in range(nb_events // batch_size):
+        source.emit_batch(batch)
+    source.resolve(0)
+
+
+def promise_chain(nb_events, depth):
+    """Resolve a chain of depth promises built with then"""
+    for _ in range(nb_events // depth):
+        first = Promise()
+        last = first
+        for _ in range(depth):
+            last = last.then(lambda value: value + 1)
+        first.resolve(0)
+
+
+SCENARIOS = [
+    ("map x 1", map_chain, 1),
+    ("map x 5", map_chain, 5),
+    ("flatMap x 1", flatmap_chain, 1),
+    ("flatMap x 5", flatmap_chain, 5),
+    ("emit_batch 1000, map", batched, 1000),
+    ("then x 10", promise_chain, 10),
+    ("then x 10000", promise_chain, 10000),
+]
+
+
+def run(nb_events=200000):
+    """
+    Run all the scenarios, and report the number of events processed per
+    second.
+
+    :param int nb_events: the number of events sent in each scenario.
+    """
+    lines = ["%-24s %14s" % ("", "events/s")]
+    for label, fn, arg in SCENARIOS:
+        start = time()
+        fn(nb_events, arg)
+        elapsed = time() - start
+        lines.append("%-24s %14.0f" % (
+            label, nb_events / elapsed if elapsed else 0.0))
+
+    result = "\n".join(lines)
+    GPS.Console("Messages").write(result + "\n")
@@ -0,0 +1,373 @@
+"""
+Stand-ins for the modules that only exist inside GPS (GPS, pygps and the
+Gtk bindings), so that the Python support code of GPS can be tested with a
+regular Python 2 interpreter::
+
+    cd testsuite/python
+    python -m unittest discover
+
+Importing this module installs them, and makes the modules of share/
+importable. Only what the tested code relies on is emulated: the other
+functions of GPS do nothing, and return a Stub.
+"""
+
+import os
+import sys
+import types
+
+_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+for _dir in ('share/support/core', 'share/support/ui', 'share/plug-ins'):
+    sys.path.insert(0, os.path.join(_root, _dir))
+
+
+class _StubType(type):
+
+    def __getattr__(cls, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return Stub()
+
+
+class Stub(object):
+    """
+    Any object or function of GPS that the tests do not care about. Its
+    attributes are stubs, and calling it returns a stub.
+    """
+
+    __metaclass__ = _StubType
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __call__(self, *args, **kwargs):
+        return Stub()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return Stub()
+
+    def __iter__(self):
+        return iter(())
+
+    def __nonzero__(self):
+        return False
+
+
+class _StubModule(types.ModuleType):
+    """A module whose unknown attributes are new subclasses of Stub"""
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        cls = type(name, (Stub, ), {})
+        setattr(self, name, cls)
+        return cls
+
+
+#######
+# GPS #
+#######
+
+class File(object):
+    """A stand-in for GPS.File, which only knows its path"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def name(self):
+        return self.path
+
+    def __eq__(self, other):
+        return isinstance(other, File) and other.path == self.path
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return '<File %s>' % self.path
+
+
+class Process(object):
+    """
+    A stand-in for GPS.Process. The processes are not run: tests send their
+    output and their exit status with `output` and `exit`.
+    """
+
+    started = []
+    """The processes created so far"""
+
+    fail = False
+    """If True, creating a process raises an exception"""
+
+    def __init__(self, command, on_match=None, on_exit=None, **kwargs):
+        if Process.fail:
+            raise Exception('cannot spawn %s' % (command, ))
+        self.command = command
+        self.on_match = on_match
+        self.on_exit = on_exit
+        self.killed = False
+        Process.started.append(self)
+
+    def output(self, text):
+        if self.on_match:
+            self.on_match(self, text, '')
+
+    def exit(self, status=0):
+        if self.on_exit:
+            self.on_exit(self, status, '')
+
+    def kill(self):
+        self.killed = True
+        self.exit(-1)
+
+    interrupt = kill
+
+    @staticmethod
+    def reset():
+        Process.started = []
+        Process.fail = False
+
+
+class EditorLocation(object):
+    """A stand-in for GPS.EditorLocation, which only knows its offset"""
+
+    def __init__(self, buffer, offset):
+        self.__buffer = buffer
+        self.__offset = max(0, min(offset, len(buffer.text)))
+
+    def buffer(self):
+        return self.__buffer
+
+    def offset(self):
+        return self.__offset
+
+    def line(self):
+        return self.__buffer.text.count('\n', 0, self.__offset) + 1
+
+    def column(self):
+        return self.__offset - self.__buffer.text.rfind(
+            '\n', 0, self.__offset)
+
+    def end_of_line(self):
+        end = self.__buffer.text.find('\n', self.__offset)
+        return EditorLocation(
+            self.__buffer, len(self.__buffer.text) if end < 0 else end)
+
+    def __add__(self, nb_chars):
+        return EditorLocation(self.__buffer, self.__offset + nb_chars)
+
+    def __sub__(self, nb_chars):
+        return EditorLocation(self.__buffer, self.__offset - nb_chars)
+
+    def __eq__(self, other):
+        return self.__offset == other.offset()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<Location %d:%d>' % (self.line(), self.column())
+
+
+class EditorBuffer(object):
+    """
+    A stand-in for GPS.EditorBuffer. Overlays are only recorded, as the
+    (start offset, end offset) of the regions where they are applied.
+
+    If track_edits is True, edits made with `insert` and `delete` are
+    reported to the handlers connected to `gtk_buffer`, as Gtk would.
+    """
+
+    def __init__(self, text, path='test.adb', track_edits=False):
+        self.text = text
+        self.path = path
+        self.overlays = []
+        self.gtk_buffer = _GtkBuffer() if track_edits else None
+        self.view_list = []     # what views() returns
+        self.destroyed = False  # if True, views() raises an exception
+
+    @staticmethod
+    def list():
+        return []
+
+    def file(self):
+        return File(self.path)
+
+    def views(self):
+        if self.destroyed:
+            raise Exception('the buffer was destroyed')
+        return self.view_list
+
+    def lines_count(self):
+        return self.text.count('\n') + 1
+
+    def at(self, line, column):
+        offset = 0
+        for _ in range(line - 1):
+            offset = self.text.index('\n', offset) + 1
+        return EditorLocation(self, offset + column - 1)
+
+    def beginning_of_buffer(self):
+        return EditorLocation(self, 0)
+
+    def end_of_buffer(self):
+        return EditorLocation(self, len(self.text))
+
+    def get_chars(self, start=None, end=None):
+        """As in GPS, end is included"""
+        start = start.offset() if start else 0
+        end = end.offset() + 1 if end else len(self.text)
+        return self.text[start:end].encode('utf-8')
+
+    def create_overlay(self, name):
+        return Stub()
+
+    def apply_overlay(self, overlay, start, end):
+        self.overlays.append((start.offset(), end.offset()))
+
+    def insert(self, location, text):
+        if self.gtk_buffer:
+            self.gtk_buffer.emit(
+                'insert-text', _GtkIter(location), text, len(text))
+        offset = location.offset()
+        self.text = self.text[:offset] + text + self.text[offset:]
+
+    def delete(self, start, end):
+        """Delete the text from start to end, excluded"""
+        if self.gtk_buffer:
+            self.gtk_buffer.emit(
+                'delete-range', _GtkIter(start), _GtkIter(end))
+        self.text = self.text[:start.offset()] + self.text[end.offset():]
+
+
+class _GtkIter(object):
+
+    def __init__(self, location):
+        self.__line = location.line() - 1
+        self.__line_offset = location.column() - 1
+
+    def get_line(self):
+        return self.__line
+
+    def get_line_offset(self):
+        return self.__line_offset
+
+
+class _GtkBuffer(object):
+    """The signals of a Gtk.TextBuffer"""
+
+    def __init__(self):
+        self.__handlers = {}
+
+    def connect(self, signal, handler):
+        handler_id = len(self.__handlers) + 1
+        self.__handlers[handler_id] = (signal, handler)
+        return handler_id
+
+    def disconnect(self, handler_id):
+        del self.__handlers[handler_id]
+
+    def emit(self, signal, *args):
+        for name, handler in self.__handlers.values():
+            if name == signal:
+                handler(self, *args)
+
+
+GPS = _StubModule('GPS')
+GPS.File = File
+GPS.Process = Process
+GPS.EditorBuffer = EditorBuffer
+GPS.EditorLocation = EditorLocation
+GPS.Browsers = _StubModule('GPS.Browsers')
+sys.modules['GPS'] = GPS
+sys.modules['GPS.Browsers'] = GPS.Browsers
+
+
+########
+# GLib #
+########
+
+class GLib(object):
+    """
+    A stand-in for GLib, whose main loop is run by `run_main_loop`. Timeouts
+    are run like idle callbacks, whatever their delay.
+    """
+
+    PRIORITY_DEFAULT = 0
+    IO_IN = 1
+    IO_ERR = 8
+    IO_HUP = 16
+
+    _sources = []   # (id, callback, args) for each pending source
+    _ids = iter(xrange(1, sys.maxint))
+
+    @staticmethod
+    def idle_add(callback, *args):
+        source_id = next(GLib._ids)
+        GLib._sources.append((source_id, callback, args))
+        return source_id
+
+    @staticmethod
+    def timeout_add(msecs, callback, *args):
+        return GLib.idle_add(callback, *args)
+
+    @staticmethod
+    def io_add_watch(fd, priority, condition, callback, *args):
+        return next(GLib._ids)
+
+    @staticmethod
+    def source_remove(source_id):
+        GLib._sources = [s for s in GLib._sources if s[0] != source_id]
+
+
+def run_main_loop(max_iterations=10000):
+    """
+    Run the pending idle and timeout callbacks, and those they add, until
+    there are none left.
+    """
+    for _ in range(max_iterations):
+        if not GLib._sources:
+            return
+        iterate_main_loop()
+    raise AssertionError('the main loop is still busy')
+
+
+def iterate_main_loop():
+    """Run the first pending callback, if any"""
+    if GLib._sources:
+        source = GLib._sources.pop(0)
+        if source[1](*source[2]):
+            GLib._sources.append(source)
+
+
+def reset_main_loop():
+    GLib._sources = []
+
+
+gi = types.ModuleType('gi')
+gi.repository = types.ModuleType('gi.repository')
+gi.repository.GLib = GLib
+gi.require_version = lambda *args: None
+sys.modules['gi'] = gi
+sys.modules['gi.repository'] = gi.repository
+
+
+#########
+# pygps #
+#########
+
+pygps = types.ModuleType('pygps')
+pygps.process_all_events = lambda *args: None
+
+
+def get_gtk_buffer(buffer):
+    """Tests set the gtk_buffer of their buffers to emulate Gtk"""
+    return buffer.gtk_buffer
+
+
+pygps.get_gtk_buffer = get_gtk_buffer
+sys.modules['pygps'] = pygps
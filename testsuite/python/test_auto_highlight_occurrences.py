@@ -0,0 +1,106 @@
+"""
+Tests for the Word_Index of auto_highlight_occurrences.
+"""
+
+import unittest
+
+import support
+from auto_highlight_occurrences import Word_Index
+
+
+class CountingBuffer(support.EditorBuffer):
+    """Records the lines read by the index"""
+
+    def __init__(self, *args, **kwargs):
+        support.EditorBuffer.__init__(self, *args, **kwargs)
+        self.reads = []
+
+    def get_chars(self, start=None, end=None):
+        self.reads.append((start.line(), end.line()))
+        return support.EditorBuffer.get_chars(self, start, end)
+
+
+class TestWordIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.buffer = CountingBuffer(
+            u'Foo := Bar;\n'
+            u'Bar (Foo, Foo_2);\n'
+            u'\n'
+            u'Foo;\n',
+            track_edits=True)
+        self.index = Word_Index(self.buffer)
+
+    def test_query(self):
+        self.assertTrue(self.index.tracking)
+        self.assertEqual(self.index.query(u'Foo', 1, 4),
+                         [(1, 0), (2, 5), (4, 0)])
+        self.assertEqual(self.index.query(u'Bar', 2, 3), [(2, 0)])
+        self.assertEqual(self.index.query(u'Foo_2', 1, 4), [(2, 10)])
+        self.assertEqual(self.index.query(u'Baz', 1, 4), [])
+
+    def test_identifiers(self):
+        # Identifiers start with a letter
+        index = Word_Index(support.EditorBuffer(
+            u'_Foo 2Foo Foo2 F_2 __ 42 \xe9t\xe9 Foo\n'))
+        self.assertEqual(index.query(u'Foo', 1, 1), [(1, 1), (1, 6), (1, 29)])
+        self.assertEqual(index.query(u'Foo2', 1, 1), [(1, 10)])
+        self.assertEqual(index.query(u'F_2', 1, 1), [(1, 15)])
+        self.assertEqual(index.query(u'\xe9t\xe9', 1, 1), [(1, 25)])
+        self.assertEqual(index.query(u'_Foo', 1, 1), [])
+        self.assertEqual(index.query(u'2Foo', 1, 1), [])
+        self.assertEqual(index.query(u'42', 1, 1), [])
+
+    def test_lines_are_scanned_once(self):
+        self.index.query(u'Foo', 2, 3)
+        self.index.query(u'Foo', 1, 4)
+        self.index.query(u'Bar', 1, 4)
+        self.assertEqual(self.buffer.reads, [(2, 3), (1, 1), (4, 4)])
+
+    def test_insert_text(self):
+        b = self.buffer
+        self.index.query(u'Foo', 1, 4)
+        b.reads = []
+
+        b.insert(b.at(2, 1), u'Foo;\nBaz ')
+        self.assertEqual(self.index.query(u'Foo', 1, 5),
+                         [(1, 0), (2, 0), (3, 9), (5, 0)])
+        self.assertEqual(self.index.query(u'Baz', 1, 5), [(3, 0)])
+        self.assertEqual(b.reads, [(2, 3)])
+
+    def test_delete_range(self):
+        b = self.buffer
+        self.index.query(u'Foo', 1, 4)
+        b.reads = []
+
+        b.delete(b.at(1, 4), b.at(2, 5))
+        self.assertEqual(b.text.split('\n')[0], u'Foo(Foo, Foo_2);')
+        self.assertEqual(self.index.query(u'Foo', 1, 3),
+                         [(1, 0), (1, 4), (3, 0)])
+        self.assertEqual(self.index.query(u'Bar', 1, 3), [])
+        self.assertEqual(b.reads, [(1, 1)])
+
+    def test_lines_added_at_end(self):
+        b = self.buffer
+        self.index.query(u'Foo', 1, 4)
+        b.text += u'Foo\n'
+        self.assertEqual(self.index.query(u'Foo', 4, 5), [(4, 0), (5, 0)])
+
+    def test_detach(self):
+        b = self.buffer
+        self.index.query(u'Foo', 1, 4)
+        self.index.detach()
+        self.assertFalse(self.index.tracking)
+
+        # The index is no longer updated
+        b.insert(b.at(1, 1), u'Bar ')
+        self.assertEqual(self.index.query(u'Bar', 1, 1), [(1, 7)])
+
+    def test_no_gtk_buffer(self):
+        index = Word_Index(support.EditorBuffer(u'Foo Foo\n'))
+        self.assertFalse(index.tracking)
+        self.assertEqual(index.query(u'Foo', 1, 1), [(1, 0), (1, 4)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,324 @@
+"""
+Tests for gps_utils.highlighter.
+"""
+
+import re
+import unittest
+
+import support
+from gps_utils import highlighter
+from gps_utils.highlighter import (
+    find_all, OverlayStyle, Text_Highlighter, Background_Highlighter,
+    Location_Highlighter)
+
+
+def offsets(ranges):
+    return [(start.offset(), end.offset()) for start, end in ranges]
+
+
+class TestFindAll(unittest.TestCase):
+
+    def setUp(self):
+        self.buffer = support.EditorBuffer(
+            u'procedure Foo is\n'
+            u'   Foo_Bar : Integer := Foo;\n'
+            u'begin\n'
+            u'   null;\n'
+            u'end Foo;\n')
+
+    def test_locations(self):
+        b = self.buffer
+        ranges = find_all(re.compile('Foo'), b.beginning_of_buffer(),
+                          b.end_of_buffer())
+        self.assertEqual(
+            [(s.line(), s.column(), e.line(), e.column()) for s, e in ranges],
+            [(1, 11, 1, 13), (2, 4, 2, 6), (2, 25, 2, 27), (5, 5, 5, 7)])
+
+    def test_region(self):
+        # The end of the region is included
+        b = self.buffer
+        ranges = find_all(re.compile('Foo'), b.at(1, 12), b.at(2, 6))
+        self.assertEqual(offsets(ranges), [(20, 22)])
+        self.assertEqual(b.text[20:23], 'Foo')
+
+    def test_matches_across_end(self):
+        b = self.buffer
+        pattern = re.compile('Foo')
+        self.assertEqual(find_all(pattern, b.at(2, 1), b.at(2, 5)), [])
+
+        # Matches that start in the region are found in full, but not
+        # those that start after it.
+        ranges = find_all(pattern, b.at(2, 1), b.at(2, 5), overlap=10)
+        self.assertEqual(offsets(ranges), [(20, 22)])
+
+    def test_overlap_past_end_of_buffer(self):
+        b = self.buffer
+        ranges = find_all(re.compile('end Foo;'), b.at(5, 1), b.at(5, 2),
+                          overlap=100)
+        self.assertEqual(offsets(ranges), [(len(b.text) - 9,
+                                            len(b.text) - 2)])
+
+    def test_empty_matches_are_ignored(self):
+        b = self.buffer
+        ranges = find_all(re.compile('x*'), b.beginning_of_buffer(),
+                          b.end_of_buffer())
+        self.assertEqual(ranges, [])
+
+
+class Message(object):
+    """Records the messages created by OverlayStyle"""
+
+    created = []
+
+    def __init__(self, file, line, column, **kwargs):
+        self.line = line
+        self.column = column
+        self.length = None
+        Message.created.append(self)
+
+    def set_style(self, style, length=None):
+        self.length = length
+
+
+class Style(object):
+
+    def set_in_speedbar(self, speedbar):
+        pass
+
+
+class TestApplyRanges(unittest.TestCase):
+
+    def setUp(self):
+        self.buffer = support.EditorBuffer(u'0123456789\n0123456789\n')
+
+    def apply(self, style, ranges):
+        b = self.buffer
+        style.apply_ranges([(b.at(*start), b.at(*end))
+                            for start, end in ranges])
+
+    def test_merge_overlays(self):
+        self.apply(OverlayStyle(name='test'), [
+            ((1, 5), (1, 7)),
+            ((1, 1), (1, 2)),
+            ((1, 6), (1, 6)),    # included in the first range
+            ((1, 3), (1, 4)),    # touches the first two
+            ((1, 10), (2, 2)),   # across lines
+            ((2, 3), (2, 3)),
+            ((2, 8), (2, 9))])
+        self.assertEqual(self.buffer.overlays, [(0, 6), (9, 13), (18, 19)])
+
+    def test_no_ranges(self):
+        OverlayStyle(name='test').apply_ranges([])
+        self.assertEqual(self.buffer.overlays, [])
+
+    def test_messages_stay_on_one_line(self):
+        Message.created = []
+        old_message = support.GPS.Message
+        support.GPS.Message = Message
+        try:
+            self.apply(OverlayStyle(name='test', style=Style()), [
+                ((1, 4), (1, 5)),
+                ((1, 1), (1, 3)),
+                ((1, 9), (1, 11)),
+                ((2, 1), (2, 2))])
+        finally:
+            support.GPS.Message = old_message
+
+        self.assertEqual(
+            [(m.line, m.column, m.length) for m in Message.created],
+            [(1, 1, 5), (1, 9, 3), (2, 1, 2)])
+
+
+class TestTextHighlighter(unittest.TestCase):
+
+    def highlight(self, contents, start, end, **kwargs):
+        buffer = support.EditorBuffer(contents)
+        highlighter = Text_Highlighter(
+            style=OverlayStyle(name='test'), **kwargs)
+        highlighter.process(buffer.at(*start), buffer.at(*end))
+        return buffer.overlays
+
+    def test_whole_word(self):
+        contents = u'Foo FooBar Bar_Foo foo\n'
+        self.assertEqual(
+            self.highlight(contents, (1, 1), (1, 22), text='foo'),
+            [(0, 2), (4, 6), (15, 17), (19, 21)])
+        self.assertEqual(
+            self.highlight(contents, (1, 1), (1, 22), text='foo',
+                           whole_word=True),
+            [(0, 2), (19, 21)])
+
+    def test_word_ending_after_region(self):
+        # The character after the word is needed to know whether it is a
+        # whole word.
+        contents = u'a Foo b FooBar\n'
+        self.assertEqual(
+            self.highlight(contents, (1, 1), (1, 10), text='foo',
+                           whole_word=True),
+            [(2, 4)])
+        self.assertEqual(
+            self.highlight(contents, (1, 1), (1, 3), text='foo',
+                           whole_word=True),
+            [(2, 4)])
+
+    def test_change_text(self):
+        buffer = support.EditorBuffer(u'Foo Bar\n')
+        highlighter = Text_Highlighter(
+            text='foo', style=OverlayStyle(name='test'))
+        highlighter.text = 'bar'
+        highlighter.process(buffer.at(1, 1), buffer.at(1, 7))
+        self.assertEqual(buffer.overlays, [(4, 6)])
+
+
+class FileLocation(object):
+    """A stand-in for the GPS.FileLocation of a reference"""
+
+    def __init__(self, line, column):
+        self.__line = line
+        self.__column = column
+
+    def line(self):
+        return self.__line
+
+    def column(self):
+        return self.__column
+
+
+def find_refs(buffer, name):
+    """The references to name in buffer, as GPS.FileLocation"""
+    return [(name, FileLocation(start.line(), start.column()))
+            for start, _ in find_all(re.compile(name), buffer.at(1, 1),
+                                     buffer.end_of_buffer())]
+
+
+class Foo_Highlighter(Location_Highlighter):
+    """Highlights the references to Foo"""
+
+    def recompute_refs(self, buffer):
+        return find_refs(buffer, 'Foo')
+
+
+class TestReferenceIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.buffer = support.EditorBuffer(
+            u'Foo := Foo;\n'
+            u'X (Foo, Y, Foo);\n'
+            u'\n'
+            u'Foo;\n',
+            track_edits=True)
+        self.highlighter = Foo_Highlighter(style=OverlayStyle(name='test'))
+        self.highlighter.on_start_buffer(self.buffer)
+
+    def assertFollowsEdits(self):
+        """The index has the current location of all references"""
+        self.assertEqual(
+            [(line, column) for line, column, _, _ in
+             self.highlighter._refs.query(1, self.buffer.lines_count())],
+            [(ref.line(), ref.column())
+             for _, ref in find_refs(self.buffer, 'Foo')])
+
+    def test_query(self):
+        refs = self.highlighter._refs
+        self.assertEqual(len(refs), 5)
+        self.assertEqual([(line, column) for line, column, _, _ in
+                          refs.query(2, 3)], [(2, 4), (2, 12)])
+
+    def test_insert_in_line(self):
+        b = self.buffer
+        b.insert(b.at(2, 8), u'ab')
+        self.assertFollowsEdits()
+        b.insert(b.at(1, 1), u'Y := ')
+        self.assertFollowsEdits()
+
+    def test_insert_lines(self):
+        b = self.buffer
+        b.insert(b.at(2, 8), u'\n  ')
+        self.assertFollowsEdits()
+        b.insert(b.at(1, 8), u'\n\nZ; ')
+        self.assertFollowsEdits()
+        b.insert(b.at(4, 1), u'Y;\n')
+        self.assertFollowsEdits()
+
+    def test_delete_in_line(self):
+        b = self.buffer
+        b.delete(b.at(2, 3), b.at(2, 9))
+        self.assertFollowsEdits()
+        self.assertEqual(len(self.highlighter._refs), 4)
+
+    def test_delete_lines(self):
+        b = self.buffer
+        b.delete(b.at(1, 5), b.at(2, 6))
+        self.assertFollowsEdits()
+        b.delete(b.at(1, 8), b.at(3, 1))
+        self.assertFollowsEdits()
+
+
+class Line_Recorder(Background_Highlighter):
+    """Records the ranges of lines it processes"""
+
+    batch_size = 1
+    time_budget = 0
+    large_files = "full"
+
+    def __init__(self):
+        super(Line_Recorder, self).__init__(style=None)
+        self.ranges = []
+
+    def process(self, start, end):
+        self.ranges.append((start.buffer().path, start.line(), end.line()))
+
+    def processed(self, path):
+        return sorted(set(line for p, first, last in self.ranges
+                          for line in range(first, last + 1) if p == path))
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        support.reset_main_loop()
+        self.scheduler = highlighter.scheduler
+        highlighter.scheduler = highlighter.Highlighter_Scheduler()
+        # One batch per highlighter in each iteration of the main loop
+        highlighter.scheduler.frame_budget = 0
+        self.highlighter = Line_Recorder()
+
+    def tearDown(self):
+        highlighter.scheduler = self.scheduler
+        support.reset_main_loop()
+
+    def start(self, path, lines=3):
+        buffer = support.EditorBuffer(u'x\n' * lines, path=path)
+        self.highlighter.start_highlight(buffer, line=1)
+        return buffer
+
+    def test_never_shown(self):
+        # Buffers that are not displayed yet are highlighted
+        self.start('a.adb')
+        support.run_main_loop()
+        self.assertEqual(self.highlighter.processed('a.adb'), [1, 2, 3])
+        self.assertEqual(self.highlighter.pending_buffers(), [])
+
+    def test_hidden(self):
+        a = self.start('a.adb')
+        b = self.start('b.adb')
+        a.view_list = ['view']
+        support.iterate_main_loop()
+        a.view_list = []
+        support.run_main_loop()
+        self.assertEqual(self.highlighter.processed('a.adb'), [1])
+        self.assertEqual(self.highlighter.processed('b.adb'), [1, 2, 3])
+
+    def test_destroyed(self):
+        a = self.start('a.adb')
+        self.start('b.adb')
+        support.iterate_main_loop()
+        a.destroyed = True
+        support.run_main_loop()
+        self.assertEqual(self.highlighter.processed('a.adb'), [1])
+        self.assertEqual(self.highlighter.processed('b.adb'), [1, 2, 3])
+        self.assertEqual(self.highlighter.pending_buffers(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Tests for highlighter.stacks. The treap of HighlighterStacks is checked
+against the list of ListHighlighterStacks.
+"""
+
+import random
+import unittest
+
+import support
+from highlighter.stacks import HighlighterStacks, ListHighlighterStacks
+from highlighter.stacks_benchmark import ROOT, COMMENT, STRING
+
+STACKS = [[ROOT], [ROOT, COMMENT], [ROOT, STRING], [ROOT, COMMENT, STRING]]
+
+
+def expand(runs):
+    """The stack of each line, given runs of lines"""
+    return [stack for stack, length in runs for _ in range(length)]
+
+
+class TestHighlighterStacks(unittest.TestCase):
+
+    def assertSameStacks(self, treap, reference):
+        self.assertEqual(len(treap), len(reference))
+        for line in range(len(reference) + 1):
+            self.assertEqual(treap.get(line), reference.get(line))
+        self.assertEqual(expand(treap.runs()), expand(reference.runs()))
+        self.assertEqual(expand(reference.runs()), reference.stacks_list)
+
+    def test_random_edits(self):
+        rand = random.Random(0)
+        for _ in range(50):
+            treap = HighlighterStacks()
+            reference = ListHighlighterStacks()
+            for _ in range(200):
+                nb_lines = len(reference)
+                op = rand.random()
+                if op < 0.5:
+                    line = rand.randint(0, nb_lines)
+                    stack = rand.choice(STACKS)
+                    self.assertEqual(treap.set(line, stack),
+                                     reference.set(line, stack))
+                elif op < 0.75:
+                    nb, at = rand.randint(0, 5), rand.randint(0, nb_lines)
+                    treap.insert_newlines(nb, at)
+                    reference.insert_newlines(nb, at)
+                else:
+                    nb, at = rand.randint(0, 6), rand.randint(0, nb_lines)
+                    treap.delete_lines(nb, at)
+                    reference.delete_lines(nb, at)
+            self.assertSameStacks(treap, reference)
+
+    def test_set_reports_unchanged_stacks(self):
+        treap = HighlighterStacks()
+        for line in range(10):
+            self.assertFalse(treap.set(line, [ROOT]))
+        self.assertTrue(treap.set(5, [ROOT]))
+        self.assertFalse(treap.set(5, [ROOT, COMMENT]))
+        self.assertTrue(treap.set(5, [ROOT, COMMENT]))
+
+    def test_identical_lines_share_runs(self):
+        treap = HighlighterStacks()
+        for line in range(1000):
+            treap.set(line, STACKS[(line // 100) % 2])
+        runs = treap.runs()
+        self.assertEqual(len(runs), 10)
+        self.assertEqual([length for _, length in runs], [100] * 10)
+
+    def test_paste_and_delete(self):
+        for cls in (HighlighterStacks, ListHighlighterStacks):
+            stacks = cls()
+            for line in range(20):
+                stacks.set(line, [ROOT])
+            stacks.insert_newlines(3, 4)
+            self.assertEqual(len(stacks), 23)
+            self.assertEqual(stacks.get(5), ())
+            self.assertEqual(stacks.get(8), (ROOT, ))
+
+            stacks.delete_lines(3, 4)
+            self.assertEqual(len(stacks), 20)
+            self.assertEqual(stacks.get(5), (ROOT, ))
+            self.assertIsNone(stacks.get(20))
+            self.assertIsNone(stacks.get(-1))
+
+    def test_list_runs(self):
+        stacks = ListHighlighterStacks()
+        for line in range(1, 6):
+            stacks.set(line, STACKS[line // 3])
+        self.assertEqual(stacks.runs(), [
+            ((), 1), ((ROOT, ), 2), ((ROOT, COMMENT), 3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+"""
+Tests for the TokenizerPool of highlighter.worker. The worker processes
+are replaced by fakes, whose results and deaths are sent by the tests.
+"""
+
+import unittest
+
+import support
+from highlighter import worker
+
+
+class Fake_Connection(object):
+
+    def __init__(self):
+        self.sent = []
+        self.result = None    # what recv returns
+        self.broken = False   # if True, send raises an exception
+
+    def send(self, message):
+        if self.broken:
+            raise IOError('broken pipe')
+        self.sent.append(message)
+
+    def recv(self):
+        return self.result
+
+
+class Fake_Worker(object):
+    """Replaces worker._Worker, without forking a process"""
+
+    started = []         # all the workers started, in order
+    fail_start = False   # if True, starting a worker fails
+
+    def __init__(self, pool):
+        if Fake_Worker.fail_start:
+            raise OSError('cannot fork')
+        self.pool = pool
+        self.conn = Fake_Connection()
+        self.job = None
+        self.stopped = False
+        Fake_Worker.started.append(self)
+
+    def stop(self):
+        self.stopped = True
+
+    def reply(self, result):
+        """Send the result of the current job"""
+        self.conn.result = (self.job[0], result)
+        return self.pool._on_result(None, support.GLib.IO_IN, self)
+
+    def die(self):
+        return self.pool._on_result(None, support.GLib.IO_HUP, self)
+
+
+class TestTokenizerPool(unittest.TestCase):
+
+    def setUp(self):
+        support.reset_main_loop()
+        self.saved = (worker._Worker, worker.available, worker.time)
+        self.now = 1000.0
+        worker._Worker = Fake_Worker
+        worker.available = True
+        worker.time = lambda: self.now
+        Fake_Worker.started = []
+        Fake_Worker.fail_start = False
+
+        self.pool = worker.TokenizerPool()
+        self.results = []
+
+    def tearDown(self):
+        worker._Worker, worker.available, worker.time = self.saved
+        support.reset_main_loop()
+
+    def submit(self, text='text'):
+        return self.pool.submit(
+            'ada', text, 1, [0],
+            lambda result: self.results.append((text, result)))
+
+    def fail_workers(self, count):
+        for _ in range(count):
+            self.submit()
+            Fake_Worker.started[-1].die()
+        support.run_main_loop()
+
+    def test_result(self):
+        job_id = self.submit('a')
+        self.assertIsNotNone(job_id)
+        w = Fake_Worker.started[0]
+        self.assertEqual(w.conn.sent, [(job_id, 'ada', 'a', 1, [0])])
+        self.assertTrue(w.reply('tokens'))
+        self.assertEqual(self.results, [('a', 'tokens')])
+        self.assertIsNone(w.job)
+
+    def test_queue(self):
+        self.pool.size = 1
+        self.submit('a')
+        self.submit('b')
+        self.assertEqual(len(Fake_Worker.started), 1)
+        w = Fake_Worker.started[0]
+        w.reply('tokens a')
+        self.assertEqual(w.job[0], 1)   # b was sent to the same worker
+        w.reply('tokens b')
+        self.assertEqual(self.results, [('a', 'tokens a'), ('b', 'tokens b')])
+
+    def test_cancel_kills_worker(self):
+        self.pool.size = 1
+        a = self.submit('a')
+        self.submit('b')
+        first = Fake_Worker.started[0]
+        self.pool.cancel(a)
+        self.assertTrue(first.stopped)
+
+        # b does not wait for a: it is sent to a new worker
+        self.assertEqual(len(Fake_Worker.started), 2)
+        second = Fake_Worker.started[1]
+        self.assertEqual(second.conn.sent[0][2], 'b')
+
+        # A late result from the killed worker is ignored
+        self.assertFalse(first.reply('tokens a'))
+        second.reply('tokens b')
+        support.run_main_loop()
+        self.assertEqual(self.results, [('b', 'tokens b')])
+
+    def test_cancel_queued(self):
+        self.pool.size = 1
+        self.submit('a')
+        b = self.submit('b')
+        self.pool.cancel(b)
+        w = Fake_Worker.started[0]
+        self.assertFalse(w.stopped)
+        w.reply('tokens a')
+        self.assertIsNone(w.job)
+        self.assertEqual(self.results, [('a', 'tokens a')])
+
+    def test_dead_worker(self):
+        self.submit('a')
+        w = Fake_Worker.started[0]
+        self.assertFalse(w.die())
+        self.assertTrue(w.stopped)
+        self.assertEqual(self.results, [])   # reported from the main loop
+        support.run_main_loop()
+        self.assertEqual(self.results, [('a', None)])
+        self.assertTrue(self.pool.enabled)
+
+    def test_failure_to_start(self):
+        Fake_Worker.fail_start = True
+        self.assertIsNotNone(self.submit('a'))
+        self.assertEqual(self.results, [])
+        support.run_main_loop()
+        self.assertEqual(self.results, [('a', None)])
+
+    def test_failure_to_send(self):
+        self.pool.size = 1
+        self.submit('a')
+        w = Fake_Worker.started[0]
+        w.reply('tokens a')
+        w.conn.broken = True
+        self.submit('b')
+        self.assertTrue(w.stopped)
+        support.run_main_loop()
+        self.assertEqual(self.results, [('a', 'tokens a'), ('b', None)])
+
+    def test_disabled_after_max_failures(self):
+        self.fail_workers(self.pool.max_failures - 1)
+        self.assertTrue(self.pool.enabled)
+
+        # A success resets the count of failures
+        self.submit()
+        Fake_Worker.started[-1].reply('tokens')
+        self.fail_workers(self.pool.max_failures - 1)
+        self.assertTrue(self.pool.enabled)
+
+        self.fail_workers(1)
+        self.assertFalse(self.pool.enabled)
+        self.assertIsNone(self.submit())
+
+    def test_disable_fails_pending_jobs(self):
+        self.pool.size = 1
+        self.fail_workers(self.pool.max_failures - 1)
+        self.submit('a')
+        self.submit('b')
+        del self.results[:]
+        Fake_Worker.started[-1].die()
+        self.assertFalse(self.pool.enabled)
+        support.run_main_loop()
+        self.assertEqual(sorted(self.results), [('a', None), ('b', None)])
+
+    def test_retry_after_delay(self):
+        self.fail_workers(self.pool.max_failures)
+        self.now += self.pool.retry_delay - 1
+        self.assertFalse(self.pool.enabled)
+
+        self.now += 1
+        self.assertTrue(self.pool.enabled)
+        count = len(Fake_Worker.started)
+        self.assertIsNotNone(self.submit('a'))
+        self.assertEqual(len(Fake_Worker.started), count + 1)
+        Fake_Worker.started[-1].reply('tokens')
+        self.assertEqual(self.results[-1], ('a', 'tokens'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,270 @@
+"""
+Tests for the Request_Queue of the VCS engines, in vcs2.core.
+"""
+
+import unittest
+
+import support
+from workflows.promises import Promise, ProcessScheduler
+from vcs2 import core
+
+
+def merge_files(old, new):
+    return {'files': old['files'] + new['files']}
+
+
+def merge_refreshes(old, new):
+    return {'files': old['files'] + new['files'],
+            'from_user': old['from_user'] or new['from_user']}
+
+
+class Fake_VCS(object):
+    """
+    The part of core.VCS used by run_in_background. Each call waits for
+    a promise that the test resolves.
+    """
+
+    def __init__(self):
+        self.request_queue = core.Request_Queue(self)
+        self.calls = []       # (method, arguments), in the order of calls
+        self.waiting = []     # the promise each running call waits for
+        self.background = []  # the calls to set_run_in_background
+
+    def set_run_in_background(self, background):
+        self.background.append(background)
+
+    def wait(self):
+        p = Promise()
+        self.waiting.append(p)
+        return p
+
+    @core.run_in_background(merge=merge_files)
+    def status(self, files):
+        self.calls.append(('status', files))
+        result = yield self.wait()
+        yield result
+
+    @core.run_in_background(merge=core.merge_identical_requests,
+                            priority=core.from_user_priority)
+    def fetch(self, from_user=False):
+        self.calls.append(('fetch', from_user))
+        yield self.wait()
+
+    @core.run_in_background(merge=merge_refreshes,
+                            priority=core.from_user_priority)
+    def refresh(self, files, from_user=False):
+        self.calls.append(('refresh', files, from_user))
+        yield self.wait()
+
+    @core.run_in_background(merge=core.merge_identical_requests)
+    def fail(self):
+        self.calls.append(('fail', ))
+        raise ValueError('cannot start')
+
+    @core.run_in_background(merge=merge_files)
+    def immediate(self, files):
+        self.calls.append(('immediate', files))
+        return len(files)
+
+    @core.run_in_background
+    def unqueued(self):
+        self.calls.append(('unqueued', ))
+        yield self.wait()
+
+    def nested(self, name):
+        self.calls.append(('nested', name))
+        result = yield self.wait()
+        if result == 'error':
+            raise ValueError('nested failed')
+        yield result
+
+    @core.run_in_background(merge=merge_files)
+    def outer(self, files):
+        self.calls.append(('outer', files))
+        try:
+            result = yield self.nested(files[0])
+        except ValueError:
+            result = 'recovered'
+        yield result
+
+
+class TestRequestQueue(unittest.TestCase):
+
+    def setUp(self):
+        support.reset_main_loop()
+        self.vcs = Fake_VCS()
+        self.results = []
+
+    def tearDown(self):
+        support.reset_main_loop()
+
+    def record(self, promise):
+        promise.then(lambda value: self.results.append(('done', value)),
+                     lambda reason: self.results.append(('failed', reason)))
+
+    def finish(self, value=None):
+        """Resolve the promise the running call waits for"""
+        self.vcs.waiting.pop(0).resolve(value)
+        support.run_main_loop()
+
+    def test_merge(self):
+        queue = self.vcs.request_queue
+        for files in (['a'], ['b'], ['c']):
+            self.record(self.vcs.status(files))
+        self.assertTrue(queue.busy)
+        self.assertEqual(queue.depth, 1)
+        self.assertEqual(self.vcs.calls, [('status', ['a'])])
+
+        self.finish(1)
+        self.assertEqual(self.vcs.calls,
+                         [('status', ['a']), ('status', ['b', 'c'])])
+        self.assertEqual(self.results, [('done', 1)])
+
+        self.finish(2)
+        self.assertEqual(self.results, [('done', 1), ('done', 2),
+                                        ('done', 2)])
+        self.assertFalse(queue.busy)
+        self.assertEqual(queue.depth, 0)
+
+    def test_no_merge(self):
+        # Calls are only merged with those that have not started yet
+        self.vcs.fetch()
+        self.vcs.fetch()
+        self.vcs.fetch(from_user=True)
+        self.vcs.fetch(from_user=True)
+        self.vcs.fetch()
+        self.assertEqual(self.vcs.request_queue.depth, 2)
+        while self.vcs.waiting:
+            self.finish()
+        self.assertEqual(self.vcs.calls, [
+            ('fetch', False), ('fetch', True), ('fetch', False)])
+        self.assertFalse(self.vcs.request_queue.busy)
+
+    def test_priority(self):
+        self.vcs.status(['a'])
+        self.vcs.status(['b'])
+        self.vcs.fetch()
+        self.vcs.fetch(from_user=True)
+        while self.vcs.waiting:
+            self.finish()
+        self.assertEqual(self.vcs.calls, [
+            ('status', ['a']), ('fetch', True), ('status', ['b']),
+            ('fetch', False)])
+
+    def test_merge_raises_priority(self):
+        self.vcs.status(['a'])
+        self.vcs.fetch()
+        self.vcs.refresh(['b'])
+        self.vcs.refresh(['c'], from_user=True)   # merged, and run first
+        self.assertEqual(self.vcs.request_queue.depth, 2)
+        while self.vcs.waiting:
+            self.finish()
+        self.assertEqual(self.vcs.calls, [
+            ('status', ['a']), ('refresh', ['b', 'c'], True),
+            ('fetch', False)])
+
+    def test_function_that_fails(self):
+        self.record(self.vcs.status(['a']))
+        self.record(self.vcs.fail())
+        self.record(self.vcs.status(['b']))
+        self.finish(1)
+        self.assertEqual(self.results[0], ('done', 1))
+        self.assertEqual(self.results[1][0], 'failed')
+        self.assertIn('cannot start', self.results[1][1])
+        self.assertEqual(self.vcs.calls[-1], ('status', ['b']))
+
+        self.finish(2)
+        self.assertEqual(self.results[2], ('done', 2))
+        self.assertFalse(self.vcs.request_queue.busy)
+
+    def test_rejected_workflow(self):
+        self.record(self.vcs.status(['a']))
+        self.record(self.vcs.status(['b']))
+        self.vcs.waiting.pop(0).reject('status failed')
+        support.run_main_loop()
+        self.assertEqual(self.results[0][0], 'failed')
+
+        # The queue is released
+        self.assertEqual(self.vcs.calls[-1], ('status', ['b']))
+        self.finish(2)
+        self.assertEqual(self.results[1], ('done', 2))
+        self.assertFalse(self.vcs.request_queue.busy)
+
+    def test_rejected_nested_workflow(self):
+        self.record(self.vcs.outer(['a']))
+        self.record(self.vcs.status(['b']))
+        self.vcs.waiting.pop(0).reject('nested failed')
+        support.run_main_loop()
+        self.assertEqual(self.results, [('failed', 'nested failed')])
+        self.assertEqual(self.vcs.calls[-1], ('status', ['b']))
+        self.finish(2)
+        self.assertEqual(self.results[1], ('done', 2))
+
+    def test_nested_workflow(self):
+        # Values and exceptions go through the watched generators
+        self.record(self.vcs.outer(['a']))
+        self.record(self.vcs.outer(['b']))
+        self.finish('result')
+        self.assertEqual(self.results, [('done', 'result')])
+        self.finish('error')
+        self.assertEqual(self.results, [('done', 'result'),
+                                        ('done', 'recovered')])
+        self.assertFalse(self.vcs.request_queue.busy)
+        self.assertEqual(self.vcs.background, [True, False, True, False])
+
+    def test_not_a_generator(self):
+        self.record(self.vcs.immediate(['a', 'b']))
+        self.assertEqual(self.results, [('done', 2)])
+        self.assertFalse(self.vcs.request_queue.busy)
+        self.assertEqual(self.vcs.background, [])
+
+    def test_background(self):
+        self.vcs.status(['a'])
+        self.vcs.unqueued()
+        self.vcs.status(['b'])
+        self.assertEqual(self.vcs.background, [True])
+
+        self.finish()   # status(['a'])
+        self.finish()   # unqueued
+        self.assertEqual(self.vcs.background, [True])
+        self.finish()   # status(['b'])
+        self.assertEqual(self.vcs.background, [True, False])
+
+        self.vcs.unqueued()
+        self.finish()
+        self.assertEqual(self.vcs.background, [True, False, True, False])
+
+    def test_background_rejected(self):
+        self.vcs.unqueued()
+        self.vcs.unqueued()
+        self.vcs.waiting.pop(0).reject('failed')
+        self.assertEqual(self.vcs.background, [True])
+        self.vcs.waiting.pop(0).reject('failed')
+        self.assertEqual(self.vcs.background, [True, False])
+
+
+class TestMergeFunctions(unittest.TestCase):
+
+    def test_merge_file_status_requests(self):
+        self.assertEqual(
+            core.merge_file_status_requests(
+                {'all_files': ['a', 'b'], 'args': ['a', 'b']},
+                {'all_files': ['b', 'c'], 'args': ['b', 'c']}),
+            {'all_files': ['a', 'b', 'c'], 'args': ['a', 'b', 'c']})
+
+        # No arguments means all files
+        self.assertEqual(
+            core.merge_file_status_requests(
+                {'all_files': ['a'], 'args': ['a']},
+                {'all_files': [], 'args': []}),
+            {'all_files': ['a'], 'args': []})
+
+    def test_from_user_priority(self):
+        self.assertEqual(core.from_user_priority({'from_user': True}),
+                         ProcessScheduler.INTERACTIVE)
+        self.assertEqual(core.from_user_priority({}),
+                         ProcessScheduler.BACKGROUND)
+
+
+if __name__ == '__main__':
+    unittest.main()
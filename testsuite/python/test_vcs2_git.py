@@ -0,0 +1,127 @@
+"""
+Tests for the parsing of "git status" in vcs2.git.
+"""
+
+import unittest
+
+import support
+from workflows.promises import _LineSplitter
+from vcs2 import git
+from vcs2.git import _StatusParser, _StatusParserV1
+
+Status = git.GPS.VCS2.Status
+H = 'e69de29bb2d1d6434b8b29ae775ad8c2e48c5391'
+
+
+def parse_chunks(parser, output, cuts):
+    """
+    Parse output received in several chunks, split at the offsets in cuts.
+
+    :return: the names of the files, for each status
+    """
+    splitter = _LineSplitter('\0')
+    result = {}
+    for start, end in zip([0] + cuts, cuts + [len(output)]):
+        for status, files in parser.parse(
+                splitter.split(output[start:end])).items():
+            result.setdefault(status, []).extend(f.path for f in files)
+    return result
+
+
+class StatusTestCase(unittest.TestCase):
+
+    def assertParsedAtAnyBoundary(self, parser_class, output, expected):
+        for cut in range(len(output) + 1):
+            self.assertEqual(
+                parse_chunks(parser_class('/root'), output, [cut]),
+                expected, 'output split at %d' % cut)
+
+
+class TestStatusParser(StatusTestCase):
+
+    output = (
+        '1 .M N... 100644 100644 100644 %s %s src/main.adb\0'
+        '1 M. N... 100644 100644 100644 %s %s src/a file.adb\0'
+        '1 MD N... 100644 100644 000000 %s %s doc/gone.rst\0'
+        '2 R. N... 100644 100644 100644 %s %s R100 new name.adb\0'
+        'old name.adb\0'
+        '1 A. N... 000000 100644 100644 %s %s obj/main.o\0'
+        'u UU N... 100644 100644 100644 100644 %s %s %s conflict.adb\0'
+        '? notes.txt\0'
+        '! obj/main.ali\0'
+        '! obj/\0'
+    ) % ((H, ) * 13)
+
+    expected = {
+        Status.MODIFIED: ['/root/src/main.adb'],
+        Status.STAGED_MODIFIED: ['/root/src/a file.adb'],
+        Status.STAGED_MODIFIED | Status.DELETED: ['/root/doc/gone.rst'],
+        Status.STAGED_RENAMED: ['/root/new name.adb'],
+        Status.CONFLICT: ['/root/conflict.adb'],
+        Status.UNTRACKED: ['/root/notes.txt'],
+        Status.IGNORED: ['/root/obj/'],
+    }
+
+    def test_parse(self):
+        self.assertEqual(parse_chunks(_StatusParser('/root'), self.output, []),
+                         self.expected)
+
+    def test_chunk_boundaries(self):
+        self.assertParsedAtAnyBoundary(
+            _StatusParser, self.output, self.expected)
+
+    def test_rename_across_batches(self):
+        # The original name of a renamed file is in the next batch
+        parser = _StatusParser('/root')
+        self.assertEqual(
+            parser.parse(['2 R. N... 100644 100644 100644 %s %s R100 b.adb'
+                          % (H, H)]),
+            {Status.STAGED_RENAMED: [support.File('/root/b.adb')]})
+        self.assertEqual(parser.parse(['? a.adb', '? c.adb']),
+                         {Status.UNTRACKED: [support.File('/root/c.adb')]})
+
+    def test_invalid_records(self):
+        parser = _StatusParser('/root')
+        self.assertEqual(
+            parser.parse(['', '# branch.oid %s' % H, '1 .M N...', '? x']),
+            {Status.UNTRACKED: [support.File('/root/x')]})
+
+
+class TestStatusParserV1(StatusTestCase):
+
+    output = (
+        ' M src/main.adb\0'
+        'M  src/a file.adb\0'
+        'R  new name.adb\0'
+        'old name.adb\0'
+        'RM moved.adb\0'
+        'orig.adb\0'
+        'A  obj/main.o\0'
+        'UU conflict.adb\0'
+        'AA both.adb\0'
+        '?? notes.txt\0'
+        '!! obj/\0'
+    )
+
+    expected = {
+        Status.MODIFIED: ['/root/src/main.adb'],
+        Status.STAGED_MODIFIED: ['/root/src/a file.adb'],
+        Status.STAGED_RENAMED: ['/root/new name.adb'],
+        Status.STAGED_RENAMED | Status.MODIFIED: ['/root/moved.adb'],
+        Status.CONFLICT: ['/root/conflict.adb', '/root/both.adb'],
+        Status.UNTRACKED: ['/root/notes.txt'],
+        Status.IGNORED: ['/root/obj/'],
+    }
+
+    def test_parse(self):
+        self.assertEqual(
+            parse_chunks(_StatusParserV1('/root'), self.output, []),
+            self.expected)
+
+    def test_chunk_boundaries(self):
+        self.assertParsedAtAnyBoundary(
+            _StatusParserV1, self.output, self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
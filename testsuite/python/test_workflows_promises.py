@@ -0,0 +1,668 @@
+"""
+Tests for workflows.promises.
+"""
+
+import pickle
+import unittest
+
+import support
+from workflows import promises
+from workflows.promises import Promise, Stream, _LineSplitter, \
+    ProcessWrapper, ProcessScheduler, ScheduledJob, CancellationToken, \
+    process_scheduler, WorkerPool, run_in_pool
+
+
+class TestPromise(unittest.TestCase):
+
+    def setUp(self):
+        support.reset_main_loop()
+        self.calls = []
+
+    def record(self, name, result=None):
+        """A callback that records its name and value"""
+        def callback(value):
+            self.calls.append((name, value))
+            return result
+        return callback
+
+    def test_callbacks_in_order(self):
+        p = Promise()
+        p.then(self.record('a'))
+        p.then(self.record('b'), self.record('failed'))
+        p.then(failure=self.record('failed'))
+        p.resolve(1)
+        p.then(self.record('c'))
+        p.resolve(2)   # no effect
+        self.assertEqual(self.calls, [('a', 1), ('b', 1), ('c', 1)])
+
+    def test_chain(self):
+        p = Promise()
+        inner = Promise()
+        p.then(self.record('a', 2)) \
+         .then(self.record('b', inner)) \
+         .then(self.record('c')) \
+         .then(None, self.record('failed'))
+        p.resolve(1)
+        self.assertEqual(self.calls, [('a', 1), ('b', 2)])
+        inner.resolve(3)
+        self.assertEqual(self.calls, [('a', 1), ('b', 2), ('c', 3)])
+
+    def test_rejection(self):
+        p = Promise()
+        p.then(self.record('a')).then(self.record('b'), self.record('c', 3)) \
+         .then(self.record('d'), self.record('e'))
+        p.reject('reason')
+        self.assertEqual(self.calls, [('c', 'reason'), ('e', 3)])
+
+    def test_nested_callbacks_run_later(self):
+        # Promises settled from a callback only call their own callbacks
+        # once the current ones have returned.
+        p = Promise()
+        nested = Promise()
+        nested.then(self.record('nested'))
+
+        def first(value):
+            self.calls.append(('first', value))
+            nested.resolve(2)
+            p.then(self.record('then'))
+            self.calls.append(('first done', value))
+
+        p.then(first)
+        p.then(self.record('second'))
+        p.resolve(1)
+        self.assertEqual(self.calls, [
+            ('first', 1), ('first done', 1), ('second', 1), ('nested', 2),
+            ('then', 1)])
+
+    def test_long_chain(self):
+        # Callbacks are not called recursively, so this does not exhaust
+        # the stack.
+        first = p = Promise()
+        for _ in range(10000):
+            p = p.then(lambda value: value + 1)
+        p.then(self.record('last'))
+        first.resolve(0)
+        self.assertEqual(self.calls, [('last', 10000)])
+
+        promises = [Promise() for _ in range(10000)]
+        for p1, p2 in zip(promises, promises[1:]):
+            p2.then(p1.resolve)
+        promises[0].then(self.record('first'))
+        promises[-1].resolve('x')
+        self.assertEqual(self.calls, [('last', 10000), ('first', 'x')])
+
+    def test_exception_in_callback(self):
+        p = Promise()
+        other = Promise()
+        other.then(self.record('other'))
+
+        def fail(value):
+            other.resolve(2)
+            raise ValueError('bug in callback')
+
+        p.then(self.record('a'))
+        p.then(fail)
+        p.then(self.record('b'))
+        self.assertRaises(ValueError, p.resolve, 1)
+        self.assertEqual(self.calls, [('a', 1)])
+
+        # The remaining callbacks are called from the main loop
+        support.run_main_loop()
+        self.assertEqual(self.calls, [('a', 1), ('b', 1), ('other', 2)])
+
+        # And later promises are not affected
+        p3 = Promise()
+        p3.then(self.record('d'))
+        p3.resolve(3)
+        self.assertEqual(self.calls[-1], ('d', 3))
+
+    def test_stream(self):
+        s = Stream()
+        s.subscribe(lambda v: self.calls.append(('a', v)),
+                    oncompleted=self.record('done'))
+        s.emit_batch([1, 2])
+        s.subscribe(lambda v: self.calls.append(('b', v)))
+        s.emit_batch([3, 4])
+        s.emit(5)
+        s.resolve(0)
+        s.emit(6)   # no effect
+        self.assertEqual(self.calls, [
+            ('a', 1), ('a', 2), ('a', 3), ('b', 3), ('a', 4), ('b', 4),
+            ('a', 5), ('b', 5), ('done', 0)])
+
+
+class TestLineSplitter(unittest.TestCase):
+
+    def test_split(self):
+        s = _LineSplitter()
+        self.assertEqual(s.split('a\nb\n'), ['a', 'b'])
+        self.assertEqual(s.split(''), [])
+        self.assertEqual(s.split('\n\n'), ['', ''])
+        self.assertEqual(s.remainder(), '')
+
+    def test_lines_across_chunks(self):
+        s = _LineSplitter()
+        self.assertEqual(s.split('ab'), [])
+        self.assertEqual(s.split('cd'), [])
+        self.assertEqual(s.split('e\nf'), ['abcde'])
+        self.assertEqual(s.split('\n'), ['f'])
+        self.assertEqual(s.split('g\nh'), ['g'])
+        self.assertEqual(s.remainder(), 'h')
+        self.assertEqual(s.remainder(), '')
+
+    def test_separator(self):
+        s = _LineSplitter('\0')
+        self.assertEqual(s.split('a b\n\0c'), ['a b\n'])
+        self.assertEqual(s.split('\0'), ['c'])
+        self.assertEqual(s.split('d'), [])
+        self.assertEqual(s.remainder(), 'd')
+
+    def test_any_chunk_boundary(self):
+        output = 'first line\n\nthird\nlast'
+        for cut in range(len(output) + 1):
+            for cut2 in range(cut, len(output) + 1):
+                s = _LineSplitter()
+                lines = (s.split(output[:cut]) + s.split(output[cut:cut2]) +
+                         s.split(output[cut2:]))
+                self.assertEqual(lines + [s.remainder()],
+                                 output.split('\n'))
+
+
+class ProcessTestCase(unittest.TestCase):
+
+    def setUp(self):
+        support.Process.reset()
+        support.reset_main_loop()
+
+    def tearDown(self):
+        support.Process.reset()
+        support.reset_main_loop()
+
+    def start(self, **kwargs):
+        """
+        Start a ProcessWrapper.
+
+        :return: the wrapper, and the fake process it started.
+        """
+        wrapper = ProcessWrapper(['tool'], **kwargs)
+        return wrapper, support.Process.started[-1]
+
+
+class TestLines(ProcessTestCase):
+
+    def test_lines(self):
+        wrapper, process = self.start()
+        lines = []
+        wrapper.lines.subscribe(lines.append)
+        process.output('a\nb')
+        process.output('c\n\nd')
+        process.exit(0)
+        self.assertEqual(lines, ['a', 'bc', '', 'd'])
+
+    def test_records_batched(self):
+        wrapper, process = self.start()
+        batches = []
+        wrapper.records_batched('\0').subscribe(batches.append)
+        process.output('a\nb\0c')
+        process.output('d')
+        process.output('\0e\0f')
+        process.exit(0)
+        self.assertEqual(batches, [['a\nb'], ['cd', 'e'], ['f']])
+
+
+class TestReadLines(ProcessTestCase):
+
+    def wait(self, promise):
+        """The value of promise, or 'pending'"""
+        result = ['pending']
+        promise.then(lambda value: result.__setitem__(0, value))
+        return result[0]
+
+    def test_read_lines(self):
+        wrapper, process = self.start()
+        p = wrapper.read_lines()
+        process.output('a\nb')
+        self.assertEqual(self.wait(p), ['a'])
+
+        p = wrapper.read_lines()
+        self.assertEqual(self.wait(p), 'pending')
+        process.output('c\nd\ne\n')
+        self.assertEqual(self.wait(p), ['bc', 'd', 'e'])
+
+        p = wrapper.read_lines(max_n=1)
+        process.output('f\ng\n')
+        self.assertEqual(self.wait(p), ['f'])
+        self.assertEqual(self.wait(wrapper.read_lines()), ['g'])
+
+        p = wrapper.read_lines()
+        process.exit(0)
+        self.assertIsNone(self.wait(p))
+
+    def test_wait_line(self):
+        wrapper, process = self.start()
+        p = wrapper.wait_line()
+        process.output('a\nb\n')
+        self.assertEqual(self.wait(p), 'a')
+        self.assertEqual(self.wait(wrapper.wait_line()), 'b')
+
+        p = wrapper.wait_line()
+        process.exit(0)
+        self.assertIsNone(self.wait(p))
+
+    def test_last_line_at_exit(self):
+        wrapper, process = self.start()
+        p = wrapper.read_lines()
+        process.on_exit(process, 0, 'a\nb\n')
+        self.assertEqual(self.wait(p), ['a', 'b'])
+        self.assertIsNone(wrapper.wait_until_match('.'))
+
+    def test_match_after_lines(self):
+        # Patterns are only matched on the output that was not returned yet
+        wrapper, process = self.start()
+        p = wrapper.read_lines()
+        process.output('key=1\nkey=2\n')
+        self.assertEqual(self.wait(p), ['key=1', 'key=2'])
+
+        p = wrapper.wait_until_match('key=\\d')
+        process.output('other\nkey=3\n')
+        self.assertEqual(self.wait(p), 'key=3')
+
+    def test_compaction(self):
+        # The output already returned is discarded from time to time, so
+        # the buffer does not grow with the whole output of the process.
+        wrapper, process = self.start()
+        line = 'x' * 99
+        read = []
+        for _ in range(1000):
+            p = wrapper.read_lines()
+            process.output((line + '\n') * 10)
+            lines = self.wait(p)
+            read.extend(lines)
+            self.assertEqual(len(lines), 10)
+            self.assertLess(len(wrapper._ProcessWrapper__output), 10000)
+
+        self.assertEqual(read, [line] * 10000)
+
+
+class TestSpawnFailure(ProcessTestCase):
+
+    def spawn_fails(self, **kwargs):
+        support.Process.fail = True
+        token = CancellationToken()
+        wrapper = ProcessWrapper(['missing'], token=token, **kwargs)
+        support.Process.fail = False
+        self.assertTrue(wrapper.finished)
+
+        results = []
+        wrapper.wait_until_terminate().then(results.append)
+        wrapper.wait_line().then(results.append)
+        self.assertEqual(results, [(-1, ''), None])
+        token.cancel()   # no effect
+
+    def test_interactive(self):
+        self.spawn_fails()
+
+    def test_background(self):
+        self.spawn_fails(priority=ProcessScheduler.BACKGROUND)
+        self.assertEqual(process_scheduler.nb_running, 0)
+
+    def test_shared_process(self):
+        self.spawn_fails(priority=ProcessScheduler.BACKGROUND, dedup=True)
+
+        # The failed job is not reused
+        wrapper, process = self.start(
+            priority=ProcessScheduler.BACKGROUND, dedup=True)
+        self.assertFalse(wrapper.finished)
+        process.exit(0)
+        self.assertTrue(wrapper.finished)
+
+    def test_console(self):
+        # The console reports the failure
+        support.Process.fail = True
+        wrapper = ProcessWrapper(['missing'], spawn_console='')
+        self.assertTrue(wrapper.finished)
+        self.assertEqual(wrapper.stream._state, Promise.RESOLVED)
+
+
+class TestProcessScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = ProcessScheduler()
+        self.scheduler.max_running = 2
+        self.started = []
+
+    def submit(self, name, priority=ProcessScheduler.BACKGROUND, key=None):
+        return self.scheduler.submit(
+            lambda job: self.started.append(name), priority=priority, key=key)
+
+    def test_interactive_jobs_are_not_capped(self):
+        jobs = [self.submit(n, ProcessScheduler.INTERACTIVE)
+                for n in range(5)]
+        self.assertEqual(self.started, range(5))
+        self.assertEqual(self.scheduler.nb_running, 0)
+        self.assertTrue(all(j.state == ScheduledJob.RUNNING for j in jobs))
+
+    def test_background_jobs_are_capped(self):
+        jobs = [self.submit(n) for n in range(5)]
+        self.assertEqual(self.started, [0, 1])
+        self.assertEqual(self.scheduler.nb_running, 2)
+
+        # Interactive jobs do not wait for background ones
+        self.submit('interactive', ProcessScheduler.INTERACTIVE)
+        self.assertEqual(self.started, [0, 1, 'interactive'])
+
+        jobs[1].done()
+        self.assertEqual(self.started, [0, 1, 'interactive', 2])
+        jobs[1].done()   # no effect
+        jobs[0].done()
+        jobs[2].done()
+        self.assertEqual(self.started, [0, 1, 'interactive', 2, 3, 4])
+        self.assertEqual(self.scheduler.nb_running, 2)
+
+    def test_dedup(self):
+        running = [self.submit(n) for n in range(2)]
+        job = self.submit('a', key='a')
+        self.assertIs(self.submit('a2', key='a'), job)
+        other = self.submit('b', key='b')
+        self.assertEqual(self.started, [0, 1])
+
+        running[0].done()
+        self.assertEqual(self.started, [0, 1, 'a'])
+        self.assertEqual(job.state, ScheduledJob.RUNNING)
+
+        # Running jobs are not shared
+        self.assertIsNot(self.submit('a3', key='a'), job)
+        running[1].done()
+        self.assertEqual(self.started, [0, 1, 'a', 'b'])
+        self.assertIsNot(other, job)
+
+    def test_interactive_resubmit(self):
+        running = [self.submit(n) for n in range(2)]
+        first = self.submit('first')
+        job = self.submit('a', key='a')
+        self.assertIs(self.submit('a2', ProcessScheduler.INTERACTIVE,
+                                  key='a'), job)
+        self.assertEqual(self.started, [0, 1, 'a'])
+        self.assertEqual(self.scheduler.nb_running, 2)
+
+        # Its previous entry in the queue is ignored
+        running[0].done()
+        running[1].done()
+        job.done()
+        self.assertEqual(self.started, [0, 1, 'a', 'first'])
+
+    def test_cancel(self):
+        running = [self.submit(n) for n in range(2)]
+        pending = self.submit('pending', key='k')
+        pending.cancel()
+        self.assertEqual(pending.state, ScheduledJob.DONE)
+        self.assertIsNot(self.submit('new', key='k'), pending)
+
+        running[0].cancel()   # already running: no effect
+        self.assertEqual(running[0].state, ScheduledJob.RUNNING)
+        running[0].done()
+        self.assertEqual(self.started, [0, 1, 'new'])
+
+    def test_failure_to_start(self):
+        def fail(job):
+            raise Exception('cannot start')
+
+        self.submit(0)
+        failed = self.scheduler.submit(fail, ProcessScheduler.BACKGROUND)
+        self.submit(2)
+        self.assertEqual(failed.state, ScheduledJob.DONE)
+        self.assertEqual(self.started, [0, 2])
+
+
+class TestProcessDedup(ProcessTestCase):
+
+    def setUp(self):
+        ProcessTestCase.setUp(self)
+        process_scheduler.max_running = 0   # background jobs wait
+
+    def tearDown(self):
+        del process_scheduler.max_running
+        ProcessTestCase.tearDown(self)
+
+    def test_shared_process(self):
+        w1 = ProcessWrapper(['status'], priority=ProcessScheduler.BACKGROUND,
+                            dedup=True)
+        w2 = ProcessWrapper(['status'], priority=ProcessScheduler.BACKGROUND,
+                            dedup=True)
+        w3 = ProcessWrapper(['status'], priority=ProcessScheduler.BACKGROUND)
+        self.assertEqual(support.Process.started, [])
+
+        w4 = ProcessWrapper(['status'], dedup=True)
+        self.assertEqual(len(support.Process.started), 1)
+        process = support.Process.started[0]
+
+        results = []
+        for w in (w1, w2, w4):
+            w.wait_until_terminate().then(results.append)
+        process.output('M file\n')
+        process.exit(0)
+        self.assertEqual(results, [(0, 'M file\n')] * 3)
+        self.assertFalse(w3.finished)
+        w3.terminate()
+
+    def test_terminate_pending(self):
+        token = CancellationToken()
+        w1 = ProcessWrapper(['status'], priority=ProcessScheduler.BACKGROUND,
+                            dedup=True, token=token)
+        w2 = ProcessWrapper(['status'], priority=ProcessScheduler.BACKGROUND,
+                            dedup=True)
+        results = []
+        w1.wait_until_terminate().then(results.append)
+        token.cancel()
+        self.assertEqual(results, [(-1, '')])
+        self.assertFalse(w2.finished)
+
+        # The other wrappers still share the process
+        w3 = ProcessWrapper(['status'], dedup=True)
+        w2.wait_until_terminate().then(results.append)
+        w3.wait_until_terminate().then(results.append)
+        self.assertEqual(len(support.Process.started), 1)
+        support.Process.started[0].exit(0)
+        self.assertEqual(results, [(-1, ''), (0, ''), (0, '')])
+
+
+def add(a, b=0):
+    return a + b
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+class Fake_Pipe(object):
+    """
+    Both ends of the connection to a fake worker. Messages are pickled as
+    by multiprocessing.
+    """
+
+    def __init__(self):
+        self.sent = []       # messages sent to the worker, pickled
+        self.received = []   # messages sent by the worker
+
+    def send(self, message):
+        self.sent.append(pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+
+    def recv(self):
+        return self.received.pop(0)
+
+
+class Fake_Child_Connection(object):
+    """The end of a Fake_Pipe in the worker, for promises._serve_pool"""
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def recv(self):
+        if not self.pipe.sent:
+            raise EOFError()
+        return pickle.loads(self.pipe.sent.pop(0))
+
+    def send(self, message):
+        self.pipe.received.append(
+            pickle.loads(pickle.dumps(message, pickle.HIGHEST_PROTOCOL)))
+
+
+class Fake_Pool_Worker(object):
+    """
+    Replaces promises._PoolWorker, without forking a process. The jobs
+    only run when the test calls `run`.
+    """
+
+    started = []   # all the workers started, in order
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = Fake_Pipe()
+        self.job = None
+        self.stopped = False
+        Fake_Pool_Worker.started.append(self)
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        """Run the pending job in the worker, and send its result"""
+        promises._serve_pool(Fake_Child_Connection(self.conn))
+        return self.pool._on_result(None, support.GLib.IO_IN, self)
+
+    def die(self):
+        return self.pool._on_result(None, support.GLib.IO_HUP, self)
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        support.reset_main_loop()
+        self.saved = (promises._PoolWorker, promises.worker_pool)
+        promises._PoolWorker = Fake_Pool_Worker
+        Fake_Pool_Worker.started = []
+
+        promises.worker_pool = self.pool = WorkerPool()
+        self.pool.enabled = True
+        self.results = []
+
+    def tearDown(self):
+        promises._PoolWorker, promises.worker_pool = self.saved
+        support.reset_main_loop()
+
+    def record(self, promise):
+        promise.then(lambda value: self.results.append(('done', value)),
+                     lambda reason: self.results.append(('failed', reason)))
+
+    def test_result(self):
+        self.record(run_in_pool(add, 1, b=2))
+        self.assertEqual(len(Fake_Pool_Worker.started), 1)
+        self.assertEqual(self.results, [])
+        self.assertTrue(Fake_Pool_Worker.started[0].run())
+        self.assertEqual(self.results, [('done', 3)])
+
+    def test_exception(self):
+        self.record(run_in_pool(fail, 'wrong input'))
+        Fake_Pool_Worker.started[0].run()
+        self.assertEqual(self.results[0][0], 'failed')
+        self.assertIn('ValueError: wrong input', self.results[0][1])
+
+    def test_queue(self):
+        for value in range(3):
+            self.record(run_in_pool(add, value, b=10))
+        self.assertEqual(len(Fake_Pool_Worker.started), 2)
+        first = Fake_Pool_Worker.started[0]
+        first.run()
+        first.run()   # the third job was sent to the first worker
+        Fake_Pool_Worker.started[1].run()
+        self.assertEqual(self.results,
+                         [('done', 10), ('done', 12), ('done', 11)])
+
+    def test_cancel_kills_worker(self):
+        token = CancellationToken()
+        self.record(run_in_pool(add, 1, token=token))
+        self.record(run_in_pool(add, 2))
+        self.record(run_in_pool(add, 3))
+        w = Fake_Pool_Worker.started[0]
+
+        token.cancel()
+        self.assertTrue(w.stopped)
+        self.assertEqual(self.results, [('failed', 'cancelled')])
+
+        # The queued job is sent to a new worker
+        self.assertEqual(len(Fake_Pool_Worker.started), 3)
+        Fake_Pool_Worker.started[2].run()
+        self.assertEqual(self.results[1], ('done', 3))
+
+    def test_cancel_queued(self):
+        token = CancellationToken()
+        self.pool.size = 1
+        self.record(run_in_pool(add, 1))
+        self.record(run_in_pool(add, 2, token=token))
+        token.cancel()
+        w = Fake_Pool_Worker.started[0]
+        self.assertFalse(w.stopped)
+        w.run()
+        self.assertEqual(self.results, [('failed', 'cancelled'),
+                                        ('done', 1)])
+        self.assertEqual(w.conn.sent, [])
+
+    def test_cancelled_token(self):
+        token = CancellationToken()
+        token.cancel()
+        self.record(run_in_pool(add, 1, token=token))
+        self.assertEqual(self.results, [('failed', 'cancelled')])
+        self.assertEqual(Fake_Pool_Worker.started, [])
+
+    def test_function_cannot_be_pickled(self):
+        self.record(run_in_pool(lambda: 1))
+        self.assertEqual(self.results[0][0], 'failed')
+        self.assertIn('Error', self.results[0][1])
+
+        # The worker is still available
+        self.record(run_in_pool(add, 1))
+        self.assertEqual(len(Fake_Pool_Worker.started), 1)
+        Fake_Pool_Worker.started[0].run()
+        self.assertEqual(self.results[1], ('done', 1))
+
+    def test_dead_worker(self):
+        self.pool.size = 1
+        self.record(run_in_pool(add, 1))
+        self.record(run_in_pool(add, 2))
+        first = Fake_Pool_Worker.started[0]
+        self.assertFalse(first.die())
+        self.assertTrue(first.stopped)
+        self.assertEqual(self.results, [('failed', 'worker process died')])
+
+        # The next job runs in a new worker
+        Fake_Pool_Worker.started[1].run()
+        self.assertEqual(self.results[1], ('done', 2))
+
+    def test_disabled(self):
+        # Functions run in GPS itself, from the main loop
+        self.pool.enabled = False
+        self.record(run_in_pool(add, 1, b=2))
+        self.record(run_in_pool(fail, 'wrong input'))
+        self.record(run_in_pool(lambda: 'local'))
+        self.assertEqual(self.results, [])
+        support.run_main_loop()
+        self.assertEqual(Fake_Pool_Worker.started, [])
+        self.assertEqual(self.results[0], ('done', 3))
+        self.assertEqual(self.results[1][0], 'failed')
+        self.assertIn('ValueError: wrong input', self.results[1][1])
+        self.assertEqual(self.results[2], ('done', 'local'))
+
+    def test_worker_cannot_start(self):
+        def cannot_fork(pool):
+            raise OSError('cannot fork')
+
+        promises._PoolWorker = cannot_fork
+        self.record(run_in_pool(add, 1))
+        self.record(run_in_pool(add, 2))
+        self.assertFalse(self.pool.enabled)
+        support.run_main_loop()
+        self.assertEqual(self.results, [('done', 1), ('done', 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()